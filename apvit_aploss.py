@@ -14,8 +14,10 @@ from copy import deepcopy
 import yaml
 from modules.ViT import ViT
 from modules.AdaptivePatching import AdaptivePatching
-from modules.InterpolatePosEmbeds import interpolate_pos_embeds
-from modules.PerturbTransformParams import perturb_transform_params
+from modules.HierarchicalPatching import HierarchicalPatching
+from modules.ActivationCheckpointing import apply_activation_checkpointing
+from modules.PatchSamplers import sample_and_embed
+from modules.PerturbTransformParams import perturb_transform_param_sets
 from modules.ValueScheduler import ValueScheduler
 from timm.data import Mixup, create_transform
 
@@ -30,34 +32,136 @@ class APViT(nn.Module):
         stochastic_depth,
         scaling,
         max_scale,
-        rotating
+        rotating,
+        embed_mode='strip', # 'strip', 'fused', 'dense'
+        img_size=32,
+        pos_embed_levels=1, # grids in the positional embedding pyramid, picked by patch scale
+        selector_feature_size=None, # pool the selector's features to this size to accept any input size
+        selector_thumbnail_size=None, # predict transform params from images resized to this size
+        mip_sampling=False, # sample scaled patches from a mip pyramid of the images
+        selector_regions=None, # place patches within this many regions picked from a thumbnail, see HierarchicalPatching
+        selector_region_scale=0.25, # side of a region relative to the image side
+        selector_region_size=16 # side of the crop of each region patches are placed from
     ):
         super(APViT, self).__init__()
-        self.patch_selector = AdaptivePatching(
-            in_channels=3,
-            hidden_channels=hidden_channels, channel_height=32,
-            channel_width=32,
-            num_patches=num_patches,
-            patch_size=patch_size,
-            scaling=scaling,
-            max_scale=max_scale,
-            rotating=rotating
-        )
+        # img_size is an int for square images or (height, width)
+        img_height, img_width = (img_size, img_size) if isinstance(img_size, int) else img_size
+        if selector_regions is None:
+            self.patch_selector = AdaptivePatching(
+                in_channels=3,
+                hidden_channels=hidden_channels, channel_height=img_height,
+                channel_width=img_width,
+                num_patches=num_patches,
+                patch_size=patch_size,
+                scaling=scaling,
+                max_scale=max_scale,
+                rotating=rotating,
+                feature_size=selector_feature_size,
+                thumbnail_size=selector_thumbnail_size,
+                mip_sampling=mip_sampling
+            )
+        else:
+            # the thumbnail size is the coarse stage's input size, 16x16 by default
+            assert selector_feature_size is None, 'The hierarchical selector does not pool features'
+            self.patch_selector = HierarchicalPatching(
+                in_channels=3,
+                hidden_channels=hidden_channels, channel_height=img_height,
+                channel_width=img_width,
+                num_patches=num_patches,
+                patch_size=patch_size,
+                scaling=scaling,
+                max_scale=max_scale,
+                rotating=rotating,
+                mip_sampling=mip_sampling,
+                num_regions=selector_regions,
+                region_scale=selector_region_scale,
+                coarse_size=selector_thumbnail_size or 16,
+                region_size=selector_region_size
+            )
+        assert embed_mode in ['strip', 'fused', 'dense'], 'Embed mode must be one of "strip", "fused", or "dense"'
+        if embed_mode == 'dense':
+            assert self.patch_selector.translation_only, 'Dense embedding requires scaling=None and rotating=False'
+        self.embed_mode = embed_mode
+        if pos_embed_levels > 1:
+            assert scaling, 'A positional embedding pyramid requires scaling'
         self.vit = ViT(
-            img_size=32,
+            img_size=img_size,
             patch_size=patch_size,
             in_channels=3,
             embed_dim=embed_dim,
             attn_heads=4,
             num_transformer_layers=num_transformer_layers,
-            stochastic_depth=stochastic_depth
+            stochastic_depth=stochastic_depth,
+            pos_embed_levels=pos_embed_levels
         )
 
+    def embed_patches(self, x, transform_params, dense_embeds=None):
+        # 'strip' samples patches and embeds them as one (C, P, P*N) strip
+        # 'fused' samples and projects each patch in a single sample_and_embed call
+        # 'dense' gathers tokens from a stride-1 embedding of the whole image, which
+        # can be computed once and shared by several sets of transform params
+        # transform params of shape (S, B, N, 5) hold S sets of patches per image, which are
+        # laid out along the patch dim so that every set is sampled in one call, and the
+        # tokens and transforms are returned set-major as (S*B, N, ...)
+        b = x.size(0)
+        n = transform_params.size(-2)
+        sets = transform_params.size(0) if transform_params.dim() == 4 else 1
+        if transform_params.dim() == 4:
+            transform_params = transform_params.transpose(0, 1).reshape(b, sets * n, -1) # (B, S*N, 5)
+
+        patch_embed = self.vit.patch_embed
+        if self.embed_mode == 'dense':
+            if dense_embeds is None:
+                dense_embeds = patch_embed.dense_embed(x)
+            tokens = patch_embed.gather_embeds(dense_embeds, transform_params[..., :2])
+            affine_transforms = self.patch_selector.translated_affine_transforms(transform_params, x.size(2), x.size(3))
+        elif self.embed_mode == 'fused':
+            affine_transforms = self.patch_selector.compute_affine_transforms(transform_params, x.size(2), x.size(3))
+            tokens = sample_and_embed(
+                x,
+                affine_transforms,
+                patch_embed.proj.weight,
+                patch_embed.proj.bias,
+                base_grid=self.patch_selector.base_grid,
+                translation_only=self.patch_selector.translation_only,
+                mip_levels=self.patch_selector.mip_levels(x.size(2), x.size(3))
+            )
+        else:
+            patches, affine_transforms = self.patch_selector.sample_patches(x, transform_params)
+            _, _, c, p, _ = patches.size()
+            tokens = patch_embed(patches.reshape(b * sets, c, p, p * n))
+
+        if sets > 1:
+            tokens = tokens.reshape(b, sets, n, -1).transpose(0, 1).reshape(sets * b, n, -1)
+            affine_transforms = affine_transforms.reshape(b, sets, n, 2, 3).transpose(0, 1).reshape(sets * b, n, 2, 3)
+        return tokens, affine_transforms
+
+    def forward(self, x, transform_params, dense_embeds=None):
+        # classifies the patches of one or more sets of transform params, returning
+        # set-major logits of shape (S*B, 10) as embed_patches does for tokens
+        tokens, affine_transforms = self.embed_patches(x, transform_params, dense_embeds)
+        levels = self.patch_selector.patch_levels(affine_transforms) if len(self.vit.pos_embed_pyramid) else None
+        pos_embeds = self.vit.lookup_pos_embeds(affine_transforms[..., -1], levels)
+        return self.vit.forward_tokens(tokens, pos_embeds)
+
 def load_config(config_file):
     with open(config_file, "r") as file:
         config = yaml.safe_load(file)
     return config
 
+def build_optimizer(module, lr, weight_decay, device):
+    # the fused step updates every parameter of a group at once on CPU (torch>=2.4) and CUDA,
+    # elsewhere fall back to the multi-tensor implementation
+    if device.type in ['cpu', 'cuda']:
+        implementation = {'fused': True}
+    else:
+        implementation = {'foreach': True}
+
+    return torch.optim.AdamW([
+        {'params': [p for n, p in module.named_parameters() if 'bias' not in n]},
+        {'params': [p for n, p in module.named_parameters() if 'bias' in n], 'weight_decay': 0.0}
+    ], lr=lr, weight_decay=weight_decay, **implementation)
+
 def get_dataloaders(
         batch_size,
         num_workers=2,
@@ -123,15 +227,7 @@ def evaluate(
         for inputs, labels in test_loader:
             inputs, labels = inputs.to(device), labels.to(device)
             transform_params = model.patch_selector(inputs)
-            patches, affine_transforms = model.patch_selector.sample_patches(inputs, transform_params)
-            batches, num_patches, channels, patch_size, _ = patches.size()
-            patches = patches.reshape(batches, channels, patch_size, patch_size * num_patches)
-            pos_embeds = model.vit.pos_embeds.squeeze(0)
-            interpolated_pos_embeds = interpolate_pos_embeds(
-                pos_embeds,
-                affine_transforms[..., -1]
-            ).reshape(batches, -1, pos_embeds.size(-1))
-            outputs = model.vit(patches, interpolated_pos_embeds)
+            outputs = model(inputs, transform_params)
             loss = criterion(outputs, labels).mean()
             running_loss += loss.item()
             _, predicted = outputs.max(1)
@@ -143,6 +239,69 @@ def evaluate(
 
     return test_loss, accuracy
 
+def patch_set_losses(model, images, labels, params_tensor, criterion, dense_embeds=None):
+    """
+    Forwards one or more sets of transform params through the ViT and returns the
+    unreduced loss of every image under every set.
+
+    Shape:
+        - params_tensor: (num_sets, batch_size, num_patches, 5)
+        - Output: (num_sets, batch_size)
+    """
+    sets, batches = params_tensor.size(0), params_tensor.size(1)
+
+    # forward pass through the ViT and compute cross entropy without reduction
+    outputs = model(images, params_tensor, dense_embeds)
+    repeated_labels = torch.cat([labels for _ in range(sets)], dim=0)
+    return criterion(outputs, repeated_labels).view(sets, batches)
+
+def search_min_params(
+        model,
+        images,
+        labels,
+        transform_params,
+        criterion,
+        perturbed_patch_sets,
+        min_perturb,
+        max_perturb,
+        no_grad_scoring=True
+    ):
+    """
+    Scores randomly perturbed sets of transform params against the original set and
+    returns the per-image losses of the original set along with the lowest-loss
+    params of each image, which are the regression target of the AP loss.
+
+    Shape:
+        - transform_params: (batch_size, num_patches, 5)
+        - Output: losses (batch_size,) and params (batch_size, num_patches, 5)
+    """
+    # generate the perturbed transform params and stack them behind the original set
+    perturbed_params = perturb_transform_param_sets(
+        transform_params.detach(),
+        perturbed_patch_sets,
+        min_perturb=min_perturb,
+        max_perturb=max_perturb
+    ) # (K, B, N, 5)
+    params_tensor = torch.cat([transform_params.unsqueeze(0), perturbed_params], dim=0) # (K+1, B, N, 5)
+
+    if no_grad_scoring:
+        # the perturbed sets only pick the regression target, so they are scored without
+        # building a graph and only the original set is differentiated
+        dense_embeds = model.vit.patch_embed.dense_embed(images) if model.embed_mode == 'dense' else None
+        orig_losses = patch_set_losses(model, images, labels, transform_params.unsqueeze(0), criterion, dense_embeds)
+        with torch.no_grad():
+            perturbed_losses = patch_set_losses(model, images, labels, perturbed_params, criterion, dense_embeds)
+        loss_tensor = torch.cat([orig_losses, perturbed_losses], dim=0) # (K+1, B)
+    else:
+        # sample, embed and forward all K+1 sets of patches in one batch
+        loss_tensor = patch_set_losses(model, images, labels, params_tensor, criterion) # (K+1, B)
+
+    # select the best set of transform params per image based on lowest loss from perturbed sets
+    _, min_indices = torch.min(loss_tensor.detach(), dim=0)
+    min_params = params_tensor.detach()[min_indices, torch.arange(images.size(0))] # (B, N, 5)
+
+    return loss_tensor[0], min_params
+
 def train(
         model,
         train_loader,
@@ -153,24 +312,29 @@ def train(
         warmup_epochs,
         epoch,
         accumulation_steps,
-        scalers,
+        scaler,
         mixup_fn,
         ap_loss_weight_sched,
         perturbed_patch_sets,
         min_perturb,
         max_perturb,
-        device
+        device,
+        no_grad_scoring=True,
+        single_backward=False
     ):
 
     ap_crit, vit_crit = criterions
     ap_opt, vit_opt = optimizers
     ap_sched, vit_sched = schedulers
     ap_wsched, vit_wsched = warmup_schedulers
-    ap_scaler, vit_scaler = scalers
 
     model.train()
     running_vit_loss = 0.0
     running_ap_loss = 0.0
+    ap_loss_weight = ap_loss_weight_sched.current_value.item()
+    # with no AP loss weight the AP loss is the ViT loss, so a second pass over the retained graph
+    # would only repeat the first, and the summed loss is backpropagated once instead
+    single_backward = single_backward or ap_loss_weight == 0
 
     with tqdm(train_loader, unit="batch") as tepoch:
         for i, (images, labels) in enumerate(tepoch):
@@ -183,69 +347,51 @@ def train(
 
             with autocast(device_type=device.type):
                 transform_params = model.patch_selector(images)
-                patches, predicted_transforms = model.patch_selector.sample_patches(images, transform_params)
-                batches, num_patches, channels, patch_size, _ = patches.size()
-
-                # generate a set of randomly perturbed transform params and patches
-                perturbed_transforms = []
-                perturbed_patches = []
-                for _ in range(perturbed_patch_sets):
-                    params = perturb_transform_params(
-                        transform_params.clone().detach(),
-                        min_perturb=min_perturb,
-                        max_perturb=max_perturb
+
+                if ap_loss_weight > 0 and perturbed_patch_sets > 0:
+                    orig_losses, min_params = search_min_params(
+                        model,
+                        images,
+                        labels,
+                        transform_params,
+                        vit_crit,
+                        perturbed_patch_sets,
+                        min_perturb,
+                        max_perturb,
+                        no_grad_scoring
                     )
-                    p_patches, transforms = model.patch_selector.sample_patches(images, params)
-                    perturbed_transforms.append(transforms)
-                    perturbed_patches.append(p_patches)
-
-                # combine original and perturbed params and patches for batch processing
-                perturbed_transforms = torch.cat(perturbed_transforms, dim=0)
-                affine_transforms = torch.cat([predicted_transforms, perturbed_transforms], dim=0)
-                perturbed_patches = torch.cat(perturbed_patches, dim=0)
-                patches = torch.cat([patches, perturbed_patches], dim=0)
-                patches = patches.reshape(batches * (perturbed_patch_sets + 1), channels, patch_size, patch_size * num_patches)
-
-                # interpolate pos embeds for each set of transform params
-                pos_embeds = model.vit.pos_embeds
-                interpolated_pos_embeds = interpolate_pos_embeds(
-                    pos_embeds,
-                    affine_transforms[..., -1]
-                ).reshape(batches * (perturbed_patch_sets + 1), -1, pos_embeds.size(-1))
-
-                # forward pass through the ViT and compute cross entropy without reduction
-                outputs = model.vit(patches, interpolated_pos_embeds)
-                repeated_labels = torch.cat([labels for _ in range(perturbed_patch_sets + 1)], dim=0)
-                losses = vit_crit(outputs, repeated_labels)
-
-                # select the best set of transform params per image based on lowest loss from perturbed sets
-                loss_tensor = losses.view(perturbed_patch_sets + 1, images.size(0))
-                _, min_indices = torch.min(loss_tensor, dim=0)
-                params_tensor = transform_params.view(images.size(0), perturbed_patch_sets + 1, -1, 5)
-                min_params = params_tensor[torch.arange(images.size(0)), min_indices, :, :]
-                orig_params = params_tensor[:, 0, :, :]
+                else:
+                    # with no AP loss weight the regression target is unused, so the perturbation search is skipped
+                    orig_losses = patch_set_losses(model, images, labels, transform_params.unsqueeze(0), vit_crit)[0]
+                    min_params = transform_params.detach()
 
                 # compute the mean cross entropy on the original set of transform params for ViT
                 # compute MSE between original and best set of transform params for AP, and use weighted sum as loss
-                vit_loss = loss_tensor[0].mean()
-                ap_loss_weight = ap_loss_weight_sched.current_value.item()
-                ap_loss = ap_crit(min_params, orig_params) * 1000
+                vit_loss = orig_losses.mean()
+                ap_loss = ap_crit(min_params, transform_params) * 1000
                 ap_loss = ap_loss * ap_loss_weight + vit_loss * (1 - ap_loss_weight)
 
             if torch.isnan(ap_loss) or torch.isnan(vit_loss):
                 raise ValueError("Loss is NaN")
 
-            scaled_ap_loss = ap_loss / accumulation_steps
-            ap_scaler.scale(scaled_ap_loss).backward(retain_graph=True)
+            if single_backward:
+                # both losses reach every parameter, so backpropagating their sum accumulates the same
+                # gradients as two separate passes without retaining the graph
+                scaled_loss = (ap_loss + vit_loss) / accumulation_steps
+                scaler.scale(scaled_loss).backward()
+            else:
+                scaled_ap_loss = ap_loss / accumulation_steps
+                scaler.scale(scaled_ap_loss).backward(retain_graph=True)
 
-            scaled_vit_loss = vit_loss / accumulation_steps
-            vit_scaler.scale(scaled_vit_loss).backward()
+                scaled_vit_loss = vit_loss / accumulation_steps
+                scaler.scale(scaled_vit_loss).backward()
 
             if (i + 1) % accumulation_steps == 0 or (i + 1) == len(train_loader):
-                ap_scaler.step(ap_opt)
-                ap_scaler.update()
-                vit_scaler.step(vit_opt)
-                vit_scaler.update()
+                # both losses reach both optimizers' parameters, so a single scaler unscales them
+                # and skips or takes the step of both together
+                scaler.step(ap_opt)
+                scaler.step(vit_opt)
+                scaler.update()
 
             tepoch.set_postfix(loss=running_vit_loss / (i + 1))
             running_vit_loss += vit_loss.item()
@@ -287,6 +433,9 @@ def main():
     mixup_switch_prob = config.get("mixup_switch_prob", 0.5)
     label_smoothing = config.get("label_smoothing", 0.05)
     perturbed_patch_sets = config.get("perturbed_patch_sets", 3)
+    min_perturbed_patch_sets = config.get("min_perturbed_patch_sets", perturbed_patch_sets)
+    no_grad_scoring = config.get("no_grad_scoring", True)
+    single_backward = config.get("single_backward", False)
 
     lr = 0.0005 * batch_size * accumulation_steps / 512
     lr_min = lr * 0.1
@@ -295,6 +444,10 @@ def main():
     min_perturb = config.get("min_perturb", 0.01)
     max_perturb = config.get("max_perturb", 0.05)
     ap_loss_weight = config.get("ap_loss_weight", 1.0)
+    embed_mode = config.get("embed_mode", "strip")
+    activation_checkpointing = config.get("activation_checkpointing", "none")
+    compile_model = config.get("compile_model", False)
+    pos_embed_lut = config.get("pos_embed_lut", 0)
 
     trainloader, testloader = get_dataloaders(
         batch_size,
@@ -314,21 +467,33 @@ def main():
             stochastic_depth=stochastic_depth,
             scaling=None,
             max_scale=0.4,
-            rotating=False
+            rotating=False,
+            embed_mode=embed_mode,
+            img_size=32,
+            pos_embed_levels=1,
+            selector_feature_size=None,
+            selector_thumbnail_size=None,
+            mip_sampling=False,
+            selector_regions=None,
+            selector_region_scale=0.25,
+            selector_region_size=16
         ).to(device)
+        apply_activation_checkpointing(model, activation_checkpointing)
+        model.vit.pos_embed_lut_resolution = pos_embed_lut
+        if compile_model:
+            # the selector and the set forward each compile to a single graph, in place so that
+            # state dict keys are unchanged (see utils/check_graph_breaks.py)
+            model.patch_selector.compile()
+            model.compile()
 
         ap_crit = nn.MSELoss()
         vit_crit = nn.CrossEntropyLoss(reduction='none')
         criterions = (ap_crit, vit_crit)
 
-        ap_opt = torch.optim.AdamW([
-            {'params': [p for n, p in model.named_parameters() if 'bias' not in n]},
-            {'params': [p for n, p in model.named_parameters() if 'bias' in n], 'weight_decay': 0.0}
-        ], lr=lr, weight_decay=weight_decay)
-        vit_opt = torch.optim.AdamW([
-            {'params': [p for n, p in model.named_parameters() if 'bias' not in n]},
-            {'params': [p for n, p in model.named_parameters() if 'bias' in n], 'weight_decay': 0.0}
-        ], lr=lr, weight_decay=weight_decay)
+        # the AP objective steps the patch selector and the ViT objective steps the ViT, so every
+        # parameter holds a single set of AdamW moments and is updated once per step
+        ap_opt = build_optimizer(model.patch_selector, lr, weight_decay, device)
+        vit_opt = build_optimizer(model.vit, lr, weight_decay, device)
         optimizers = (ap_opt, vit_opt)
 
         ap_sched = CosineAnnealingLR(
@@ -359,7 +524,14 @@ def main():
             steps=epochs
         )
 
-        scalers = (GradScaler(), GradScaler())
+        # the number of perturbed sets ramps over the same steps as the AP loss weight
+        perturbed_sets_sched = ValueScheduler(
+            start=min_perturbed_patch_sets,
+            end=perturbed_patch_sets,
+            steps=epochs
+        )
+
+        scaler = GradScaler()
 
         mixup_fn = Mixup(
             mixup_alpha=mixup_alpha,
@@ -384,14 +556,17 @@ def main():
                 warmup_epochs,
                 epoch,
                 accumulation_steps,
-                scalers,
+                scaler,
                 mixup_fn,
                 ap_loss_weight_sched,
-                perturbed_patch_sets,
+                round(perturbed_sets_sched.current_value.item()),
                 min_perturb,
                 max_perturb,
-                device
+                device,
+                no_grad_scoring,
+                single_backward
             )
+            perturbed_sets_sched.step()
 
             vit_test_loss, accuracy = evaluate(
                 model,
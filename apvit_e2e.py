@@ -14,7 +14,9 @@ import yaml
 from copy import deepcopy
 from modules.ViT import ViT
 from modules.AdaptivePatching import AdaptivePatching
-from modules.InterpolatePosEmbeds import interpolate_pos_embeds
+from modules.HierarchicalPatching import HierarchicalPatching
+from modules.ActivationCheckpointing import apply_activation_checkpointing
+from modules.PatchSamplers import sample_and_embed
 from timm.data import Mixup, create_transform
 
 class APViT(nn.Module):
@@ -31,20 +33,59 @@ class APViT(nn.Module):
         hidden_channels=16,
         scaling=None,
         max_scale=0.3,
-        rotating=False
+        rotating=False,
+        embed_mode='strip', # 'strip', 'fused', 'dense'
+        pos_embed_levels=1, # grids in the positional embedding pyramid, picked by patch scale
+        selector_feature_size=None, # pool the selector's features to this size to accept any input size
+        selector_thumbnail_size=None, # predict transform params from images resized to this size
+        mip_sampling=False, # sample scaled patches from a mip pyramid of the images
+        selector_regions=None, # place patches within this many regions picked from a thumbnail, see HierarchicalPatching
+        selector_region_scale=0.25, # side of a region relative to the image side
+        selector_region_size=16 # side of the crop of each region patches are placed from
     ):
         super(APViT, self).__init__()
-        self.patch_selector = AdaptivePatching(
-            in_channels=in_channels,
-            hidden_channels=hidden_channels,
-            channel_height=img_size,
-            channel_width=img_size,
-            num_patches=num_patches,
-            patch_size=patch_size,
-            scaling=scaling,
-            max_scale=max_scale,
-            rotating=rotating
-        )
+        # img_size is an int for square images or (height, width)
+        img_height, img_width = (img_size, img_size) if isinstance(img_size, int) else img_size
+        if selector_regions is None:
+            self.patch_selector = AdaptivePatching(
+                in_channels=in_channels,
+                hidden_channels=hidden_channels,
+                channel_height=img_height,
+                channel_width=img_width,
+                num_patches=num_patches,
+                patch_size=patch_size,
+                scaling=scaling,
+                max_scale=max_scale,
+                rotating=rotating,
+                feature_size=selector_feature_size,
+                thumbnail_size=selector_thumbnail_size,
+                mip_sampling=mip_sampling
+            )
+        else:
+            # the thumbnail size is the coarse stage's input size, 16x16 by default
+            assert selector_feature_size is None, 'The hierarchical selector does not pool features'
+            self.patch_selector = HierarchicalPatching(
+                in_channels=in_channels,
+                hidden_channels=hidden_channels,
+                channel_height=img_height,
+                channel_width=img_width,
+                num_patches=num_patches,
+                patch_size=patch_size,
+                scaling=scaling,
+                max_scale=max_scale,
+                rotating=rotating,
+                mip_sampling=mip_sampling,
+                num_regions=selector_regions,
+                region_scale=selector_region_scale,
+                coarse_size=selector_thumbnail_size or 16,
+                region_size=selector_region_size
+            )
+        assert embed_mode in ['strip', 'fused', 'dense'], 'Embed mode must be one of "strip", "fused", or "dense"'
+        if embed_mode == 'dense':
+            assert self.patch_selector.translation_only, 'Dense embedding requires scaling=None and rotating=False'
+        self.embed_mode = embed_mode
+        if pos_embed_levels > 1:
+            assert scaling, 'A positional embedding pyramid requires scaling'
         self.vit = ViT(
             img_size=img_size,
             num_patches=num_patches,
@@ -53,19 +94,70 @@ class APViT(nn.Module):
             embed_dim=embed_dim,
             attn_heads=attn_heads,
             num_transformer_layers=num_transformer_layers,
-            stochastic_depth=stochastic_depth
+            stochastic_depth=stochastic_depth,
+            pos_embed_levels=pos_embed_levels
         )
 
+    def embed_patches(self, x, transform_params, dense_embeds=None):
+        # 'strip' samples patches and embeds them as one (C, P, P*N) strip
+        # 'fused' samples and projects each patch in a single sample_and_embed call
+        # 'dense' gathers tokens from a stride-1 embedding of the whole image, which
+        # can be computed once and shared by several sets of transform params
+        patch_embed = self.vit.patch_embed
+        if self.embed_mode == 'dense':
+            if dense_embeds is None:
+                dense_embeds = patch_embed.dense_embed(x)
+            tokens = patch_embed.gather_embeds(dense_embeds, transform_params[..., :2])
+            affine_transforms = self.patch_selector.translated_affine_transforms(transform_params, x.size(2), x.size(3))
+        elif self.embed_mode == 'fused':
+            affine_transforms = self.patch_selector.compute_affine_transforms(transform_params, x.size(2), x.size(3))
+            tokens = sample_and_embed(
+                x,
+                affine_transforms,
+                patch_embed.proj.weight,
+                patch_embed.proj.bias,
+                base_grid=self.patch_selector.base_grid,
+                translation_only=self.patch_selector.translation_only,
+                mip_levels=self.patch_selector.mip_levels(x.size(2), x.size(3))
+            )
+        else:
+            patches, affine_transforms = self.patch_selector.sample_patches(x, transform_params)
+            b, n, c, p, _ = patches.size()
+            tokens = patch_embed(patches.view(b, c, p, p * n))
+        return tokens, affine_transforms
+
     def forward(self, x):
         transform_params = self.patch_selector(x)
-        patches, affine_transforms = self.patch_selector.sample_patches(x, transform_params)
-        b, n, c, p, _ = patches.size()
-        patches = patches.view(b, c, p, p * n)
-        pos_embeds = interpolate_pos_embeds(
-            self.vit.pos_embeds,
-            affine_transforms[..., -1]
-        )
-        return self.vit(patches, pos_embeds)
+        tokens, affine_transforms = self.embed_patches(x, transform_params)
+        levels = self.patch_selector.patch_levels(affine_transforms) if len(self.vit.pos_embed_pyramid) else None
+        pos_embeds = self.vit.lookup_pos_embeds(affine_transforms[..., -1], levels)
+        return self.vit.forward_tokens(tokens, pos_embeds)
+
+    def forward_tiled(self, sources):
+        """
+        Classifies a batch of TiledImage sources of one size, see modules/TiledImage.py.
+        The patch selector sees their stored thumbnails, resized to its thumbnail size or,
+        without a thumbnail or feature size, to the image size it was built for, and
+        patches are sampled from only the tiles under them, so the images are never
+        loaded whole.
+        """
+        assert self.embed_mode == 'strip', 'Tiled sources require embed_mode="strip"'
+        thumbnails = torch.stack([source.thumbnail for source in sources])
+        selector = self.patch_selector
+        if selector.thumbnail_size is None and selector.feature_size is None and tuple(thumbnails.shape[-2:]) != selector.image_size:
+            # the selector's layers are sized for its image size, and forward only resizes to a thumbnail size
+            thumbnails = nn.functional.interpolate(
+                thumbnails,
+                size=selector.image_size,
+                mode='bilinear',
+                align_corners=False,
+                antialias=True
+            )
+        transform_params = self.patch_selector(thumbnails, image_size=sources[0].size)
+        tokens, affine_transforms = self.embed_patches(sources, transform_params)
+        levels = self.patch_selector.patch_levels(affine_transforms) if len(self.vit.pos_embed_pyramid) else None
+        pos_embeds = self.vit.lookup_pos_embeds(affine_transforms[..., -1], levels)
+        return self.vit.forward_tokens(tokens, pos_embeds)
 
 def load_config(config_file):
     with open(config_file, "r") as file:
@@ -229,6 +321,10 @@ def main():
     attn_embed_dim = config.get("attn_embed_dim", 256)
     num_transformer_layers = config.get("num_transformer_layers", 8)
     hidden_channels = config.get("hidden_channels", 24)
+    embed_mode = config.get("embed_mode", "strip")
+    activation_checkpointing = config.get("activation_checkpointing", "none")
+    compile_model = config.get("compile_model", False)
+    pos_embed_lut = config.get("pos_embed_lut", 0)
 
     trainloader, testloader = get_dataloaders(
         batch_size,
@@ -251,15 +347,29 @@ def main():
             hidden_channels=hidden_channels,
             scaling=None,
             max_scale=0.3,
-            rotating=False
+            rotating=False,
+            embed_mode=embed_mode,
+            pos_embed_levels=1,
+            selector_feature_size=None,
+            selector_thumbnail_size=None,
+            mip_sampling=False,
+            selector_regions=None,
+            selector_region_scale=0.25,
+            selector_region_size=16
         ).to(device)
+        apply_activation_checkpointing(model, activation_checkpointing)
+        model.vit.pos_embed_lut_resolution = pos_embed_lut
+        if compile_model:
+            # the forward compiles to a single graph, in place so that state dict keys are
+            # unchanged (see utils/check_graph_breaks.py)
+            model.compile()
 
         criterion = nn.CrossEntropyLoss()
 
         optimizer = torch.optim.AdamW([
             {'params': [p for n, p in model.named_parameters() if 'bias' not in n]},
             {'params': [p for n, p in model.named_parameters() if 'bias' in n], 'weight_decay': 0.0}
-        ], lr=lr, weight_decay=weight_decay)
+        ], lr=lr, weight_decay=weight_decay, fused=device.type in ['cpu', 'cuda'])
 
         scheduler = CosineAnnealingLR(
             optimizer,
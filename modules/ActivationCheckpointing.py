@@ -0,0 +1,36 @@
+# © 2024 Alec Fessler
+# MIT License
+# See LICENSE file in the project root for full license information.
+
+from modules.ConvSelfAttn import ConvSelfAttn
+from modules.ViT import ViT
+
+def apply_activation_checkpointing(model, policy):
+    """
+    Sets which transformer layers of model recompute their activations in backward
+    instead of keeping them, trading compute for activation memory. This applies to
+    the ViT and to the ConvSelfAttn stacks of the patch selector.
+
+    policy is one of:
+        - 'none': keep every activation
+        - 'all': checkpoint every layer
+        - 'selector': checkpoint every layer of the patch selector only
+        - k (int): checkpoint every k-th layer, starting with the first
+    """
+    assert policy in ['none', 'all', 'selector'] or (isinstance(policy, int) and policy >= 0), \
+        'Activation checkpointing must be "none", "all", "selector" or a non-negative integer'
+
+    for module in model.modules():
+        if isinstance(module, (ViT, ConvSelfAttn)):
+            module.checkpoint_every = 0
+
+    if policy == 'none':
+        return
+    if policy == 'selector':
+        modules, every = model.patch_selector.modules(), 1
+    else:
+        modules, every = model.modules(), 1 if policy == 'all' else policy
+
+    for module in modules:
+        if isinstance(module, (ViT, ConvSelfAttn)):
+            module.checkpoint_every = every
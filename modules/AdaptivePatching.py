@@ -2,11 +2,15 @@
 # MIT License
 # See LICENSE file in the project root for full license information.
 
+import math
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 from modules.ConvBlock import ConvBlock
 from modules.ConvSelfAttn import ConvSelfAttn
+from modules.PatchSamplers import mip_sample_patches, translate_patches, make_base_grid, translation_offsets
+from modules.TiledImage import sample_tiled_patches
 
 class AdaptivePatching(nn.Module):
     def __init__(
@@ -19,7 +23,10 @@ class AdaptivePatching(nn.Module):
         patch_size,
         scaling=None, # 'isotropic', 'anisotropic', None
         max_scale=0.3, # max 0.7071 if rotating=True, else max 1
-        rotating=False
+        rotating=False,
+        feature_size=None, # int or (height, width) to pool conv1 features to, accepting any input size
+        thumbnail_size=None, # int or (height, width) to resize images to before predicting params
+        mip_sampling=False # sample scaled patches from a mip pyramid of the images
         ):
         super(AdaptivePatching, self).__init__()
         assert scaling in ['isotropic', 'anisotropic', None], 'Scaling must be one of "isotropic", "anisotropic", or None'
@@ -34,7 +41,48 @@ class AdaptivePatching(nn.Module):
         self.scaling = scaling
         self.max_scale = max_scale
         self.rotating = rotating
+        self.translation_only = scaling is None and not rotating
+        self.image_size = (channel_height, channel_width)
+        self.mip_sampling = mip_sampling
 
+        # constants used to build transforms and sampling grids, kept out of the state dict
+        # so that checkpoints are unaffected. patch_scale is the scale of an unscaled patch
+        # at the configured image size, (patch_size / width, patch_size / height)
+        patch_scale = torch.tensor([patch_size / channel_width, patch_size / channel_height])
+        self.register_buffer('patch_scale', patch_scale, persistent=False)
+        self.register_buffer('patch_scale_matrix', torch.diag(patch_scale), persistent=False)
+        self.register_buffer('zero_rotation', torch.zeros(1, 1, 1), persistent=False)
+        self.register_buffer('base_grid', make_base_grid(patch_size), persistent=False)
+
+        # with thumbnail_size set, params are predicted from a copy of the images resized to it,
+        # which the layers below are built for, and patches are still sampled from the images
+        if thumbnail_size is not None:
+            channel_height, channel_width = (thumbnail_size, thumbnail_size) if isinstance(thumbnail_size, int) else thumbnail_size
+            self.thumbnail_size = (channel_height, channel_width)
+        else:
+            self.thumbnail_size = None
+
+        # with feature_size set, the conv1 features are average pooled to a fixed grid, so
+        # that every layer after conv1 is sized by the grid rather than by the image. images
+        # over twice the grid are average pooled by an integer stride before conv1 as well
+        if feature_size is not None:
+            channel_height, channel_width = (feature_size, feature_size) if isinstance(feature_size, int) else feature_size
+            self.feature_size = (channel_height, channel_width)
+            self.pool = nn.AdaptiveAvgPool2d(self.feature_size)
+        else:
+            self.feature_size = None
+            self.pool = None
+
+        num_transform_params = 2
+        if scaling == 'anisotropic': num_transform_params += 2
+        if scaling == 'isotropic': num_transform_params += 1
+        if rotating: num_transform_params += 1
+        self.build_layers(in_channels, hidden_channels, channel_height, channel_width, num_transform_params)
+
+    def build_layers(self, in_channels, hidden_channels, channel_height, channel_width, num_transform_params):
+        # the conv and attention stack predicting the transform params of every patch
+        # from channel_height x channel_width inputs
+        num_patches, patch_size = self.num_patches, self.patch_size
         self.conv1 = ConvBlock(
             in_channels=in_channels,
             out_channels=hidden_channels,
@@ -72,16 +120,89 @@ class AdaptivePatching(nn.Module):
         half_channel = channel_height // 2 * channel_width // 2
         self.fc1 = nn.Linear(half_channel, half_channel // 2)
         self.relu = nn.ReLU()
-
-        num_transform_params = 2
-        if scaling == 'anisotropic': num_transform_params += 2
-        if scaling == 'isotropic': num_transform_params += 1
-        if rotating: num_transform_params += 1
         self.fc2 = nn.Linear(half_channel // 2, num_transform_params)
 
     def sample_patches(self, x, transform_params):
+        if isinstance(x, (list, tuple)):
+            return self.sample_tiled_patches(x, transform_params)
+        if self.translation_only:
+            return self.sample_translated_patches(x, transform_params)
+        return self.sample_affine_patches(x, transform_params)
+
+    def sample_tiled_patches(self, sources, transform_params):
+        """
+        Samples the patches of a batch of TiledImage sources of one size, reading only
+        the tiles under the patches rather than whole images, see modules/TiledImage.py.
+        Patches are sampled bilinearly, without mip levels even with mip_sampling.
+        """
+        h, w = sources[0].size
+        affine_transforms = self.compute_affine_transforms(transform_params, h, w) # (B, N, 2, 3)
+        patches = torch.stack([
+            sample_tiled_patches(source, transforms.float().cpu(), self.base_grid.cpu())
+            for source, transforms in zip(sources, affine_transforms)
+        ]) # (B, N, C, P, P)
+        return patches.to(transform_params), affine_transforms
+
+    def translated_affine_transforms(self, transform_params, h, w):
+        """
+        Affine transforms for translation-only patches, without building the full
+        scaling and rotation matrices of general_affine_transforms.
+        """
+        b, n, _ = transform_params.size()
+
+        if (h, w) == self.image_size:
+            patch_scale, patch_scale_matrix = self.patch_scale, self.patch_scale_matrix
+        else:
+            patch_scale = transform_params.new_tensor([self.patch_size / w, self.patch_size / h])
+            patch_scale_matrix = torch.diag(patch_scale)
+
+        # scale translation parameters by patch extents, as in general_affine_transforms
+        translate_params = transform_params[:, :, :2] * (1 - patch_scale) # (B, N, 2)
+
+        return torch.cat([
+            patch_scale_matrix.expand(b, n, 2, 2),
+            translate_params.unsqueeze(-1)
+        ], dim=-1) # (B, N, 2, 3)
+
+    def sample_translated_patches(self, x, transform_params):
+        """
+        Without scaling or rotation every patch is a P x P crop at a fractional pixel
+        offset, so all of its samples share the same bilinear weights. The crops are
+        sampled directly by gathering a (P+1) x (P+1) window per patch and interpolating
+        between its shifted rows and columns. This matches sample_affine_patches in value
+        and in gradient w.r.t. the translation params (scale and rotation are constant).
+        """
         b, c, h, w = x.size()
+        p = self.patch_size
 
+        affine_transforms = self.translated_affine_transforms(transform_params, h, w) # (B, N, 2, 3)
+
+        # top-left corner of each patch in pixel coordinates
+        offsets = translation_offsets(affine_transforms, p, h, w) # (B, N, 2)
+        patches = translate_patches(x, offsets.to(x.dtype), p) # (B, N, C, P, P)
+
+        return patches, affine_transforms
+
+    def patch_extents(self, transform_params):
+        """
+        Extents of the patches along x and y, relative to the images and clamped to
+        [0, 1], from their bounded scale and rotation params. Translations are scaled
+        by 1 minus the extents, so that patches stay within the images. Without scaling
+        or rotation these are the patch_scale of translated_affine_transforms.
+
+        Shape:
+            - transform_params: (B, N, 5)
+            - Output: (B, N, 2)
+        """
+        scale_params = transform_params[:, :, 2:4] # (B, N, 2)
+        cos_theta = torch.abs(torch.cos(transform_params[:, :, 4])) # (B, N)
+        sin_theta = torch.abs(torch.sin(transform_params[:, :, 4])) # (B, N)
+
+        x_extent = scale_params[:, :, 0] * cos_theta + scale_params[:, :, 1] * sin_theta
+        y_extent = scale_params[:, :, 0] * sin_theta + scale_params[:, :, 1] * cos_theta
+        return torch.clamp(torch.stack([x_extent, y_extent], dim=-1), max=1)
+
+    def general_affine_transforms(self, transform_params):
         translate_params = transform_params[:, :, :2] # (B, N, 2)
         scale_params = transform_params[:, :, 2:4] # (B, N, 2)
         rotate_params = transform_params[:, :, 4] # (B, N)
@@ -89,46 +210,84 @@ class AdaptivePatching(nn.Module):
         cos_theta = torch.cos(rotate_params).squeeze(-1) # (B, N)
         sin_theta = torch.sin(rotate_params).squeeze(-1) # (B, N)
 
-        # calculate patch extents based on scaling and rotation and clamp to [0, 1]
-        x_extent = scale_params[:, :, 0] * torch.abs(cos_theta) + scale_params[:, :, 1] * torch.abs(sin_theta)
-        y_extent = scale_params[:, :, 0] * torch.abs(sin_theta) + scale_params[:, :, 1] * torch.abs(cos_theta)
-        x_extent = torch.clamp(x_extent, max=1)
-        y_extent = torch.clamp(y_extent, max=1)
-
         # scale translation parameters by patch extents
-        translation_scale = 1 - torch.stack([x_extent, y_extent], dim=-1)
-        translate_params = translate_params * translation_scale
-
-        # calculate affine transformation matrices
-        ta = scale_params[:, :, 0] * cos_theta
-        tb = -scale_params[:, :, 0] * sin_theta
-        tc = scale_params[:, :, 1] * sin_theta
-        td = scale_params[:, :, 1] * cos_theta
-        tx = translate_params[:, :, 0]
-        ty = translate_params[:, :, 1]
-
-        affine_transforms = torch.stack([
-            torch.stack([ta, tb, tx], dim=-1),
-            torch.stack([tc, td, ty], dim=-1)
-        ], dim=-2) # (B, N, 2, 3)
-
-        grid = nn.functional.affine_grid(
-            affine_transforms.view(-1, 2, 3), # (B*N, 2, 3)
-            [b * self.num_patches, 1, self.patch_size, self.patch_size],
-            align_corners=False
-        ) # (B*N, P, P, 2)
-
-        patches = nn.functional.grid_sample(
-            x.unsqueeze(1).expand(-1, self.num_patches, -1, -1, -1).reshape(-1, c, h, w), # (B*N, C, H, W)
-            grid,
-            align_corners=False
-        ).view(b, self.num_patches, c, self.patch_size, self.patch_size) # (B, N, C, P, P)
+        translate_params = translate_params * (1 - self.patch_extents(transform_params))
+
+        # calculate affine transformation matrices as scale * rotation, with the translation appended
+        rotation = torch.stack([cos_theta, -sin_theta, sin_theta, cos_theta], dim=-1).view(*cos_theta.shape, 2, 2)
+        affine_transforms = torch.cat([
+            scale_params.unsqueeze(-1) * rotation,
+            translate_params.unsqueeze(-1)
+        ], dim=-1) # (B, N, 2, 3)
+
+        return affine_transforms
+
+    def compute_affine_transforms(self, transform_params, h, w):
+        if self.translation_only:
+            return self.translated_affine_transforms(transform_params, h, w)
+        return self.general_affine_transforms(transform_params)
+
+    def patch_levels(self, affine_transforms):
+        """
+        Pyramid level of each patch, log2 of its side relative to an unscaled patch at
+        the configured image size, from the area its affine transform covers. Patches
+        no larger than an unscaled one are at level 0.
+
+        Shape:
+            - affine_transforms: (*, 2, 3)
+            - Output: (*)
+        """
+        area = (affine_transforms[..., 0, 0] * affine_transforms[..., 1, 1] - affine_transforms[..., 0, 1] * affine_transforms[..., 1, 0]).abs()
+        relative_area = area.clamp(min=1e-12) / (self.patch_scale[0] * self.patch_scale[1])
+        return (0.5 * torch.log2(relative_area)).clamp(min=0)
+
+    def mip_levels(self, h, w):
+        """
+        Levels of the mip pyramid that scaled patches of h x w images are sampled from,
+        enough for the sample spacing of the largest patch, or 1 without mip_sampling.
+        """
+        if not self.mip_sampling or not self.scaling:
+            return 1
+        # a patch of scale s spans s * size pixels along each axis, over patch_size samples
+        max_spacing = self.max_scale * max(h, w) / self.patch_size
+        return 1 + max(0, math.ceil(math.log2(max_spacing)))
+
+    def sample_affine_patches(self, x, transform_params):
+        b, c, h, w = x.size()
+        affine_transforms = self.general_affine_transforms(transform_params) # (B, N, 2, 3)
+
+        # all N patch grids of an image are stacked along the height axis so each image
+        # is sampled once rather than expanded into N copies before grid_sample
+        patches = mip_sample_patches(
+            x, # (B, C, H, W)
+            affine_transforms,
+            self.base_grid,
+            self.mip_levels(h, w)
+        ).view(b, c, affine_transforms.size(1), self.patch_size, self.patch_size) # (B, C, N, P, P)
+        patches = patches.transpose(1, 2).contiguous() # (B, N, C, P, P)
 
         return patches, affine_transforms
 
-    def forward(self, x):
+    def thumbnail(self, x):
+        # copy of the images resized to thumbnail_size, anti-aliased when downsampling
+        if self.thumbnail_size is None or tuple(x.shape[-2:]) == self.thumbnail_size:
+            return x
+        return F.interpolate(x, size=self.thumbnail_size, mode='bilinear', align_corners=False, antialias=True)
+
+    def forward(self, x, image_size=None):
+        # image_size is the (height, width) of the images when x is already a thumbnail of them
         b, c, h, w = x.size()
-        features = self.conv1(x)
+        if image_size is not None:
+            h, w = image_size
+        x = self.thumbnail(x)
+        if self.pool is not None:
+            # conv1 runs on at least a 2x2 window of pixels per cell of the pooled grid,
+            # so its cost stays constant for images larger than that
+            stride = min(x.size(2) // (2 * self.feature_size[0]), x.size(3) // (2 * self.feature_size[1]))
+            features = self.conv1(F.avg_pool2d(x, stride) if stride > 1 else x)
+            features = self.pool(features)
+        else:
+            features = self.conv1(x)
         features = self.norm1(features)
         features = self.attn1(features)
         features = self.maxpool(features)
@@ -141,11 +300,20 @@ class AdaptivePatching(nn.Module):
         transform_params = self.relu(transform_params) # (B, N, C*P*P/2)
         transform_params = self.fc2(transform_params) # (B, N, num_transform_params)
 
+        return self.bound_transform_params(transform_params, h, w)
+
+    def bound_transform_params(self, transform_params, h, w):
+        """
+        Bounds the raw params predicted for each patch and fills in those not predicted,
+        returning (translate_x, translate_y, scale_x, scale_y, rotation) per patch for
+        h x w images.
+        """
+        b = transform_params.size(0)
         param_num = 2
         translate_params = transform_params[:, :, :param_num] # (B, N, 2)
         if self.scaling:
             if self.scaling == 'anisotropic':
-                scale_params = transform_params[:, :, param_num:param_num+3] # (B, N, 2)
+                scale_params = transform_params[:, :, param_num:param_num+2] # (B, N, 2)
                 param_num += 2
             elif self.scaling == 'isotropic':
                 scale_params = transform_params[:, :, param_num:param_num+1] # (B, N, 1)
@@ -162,15 +330,16 @@ class AdaptivePatching(nn.Module):
             scale_params = torch.sigmoid(scale_params) * self.max_scale
             if self.scaling == 'isotropic':
                 scale_params = scale_params.repeat(1, 1, 2) # (B, N, 2)
+        elif (h, w) == self.image_size:
+            scale_params = self.patch_scale.expand(b, self.num_patches, 2) # (B, N, 2)
         else:
-            scale_params = torch.tensor([self.patch_size / w, self.patch_size / h], device=x.device)
-            scale_params = scale_params.view(1, 1, 2).expand(b, self.num_patches, 2) # (B, N, 2)
+            scale_params = transform_params.new_tensor([self.patch_size / w, self.patch_size / h]).expand(b, self.num_patches, 2)
 
         # bound rotation to [-pi, pi] or assign 0s if not rotating
         if self.rotating:
             rotate_params = torch.tanh(rotate_params) * torch.pi
         else:
-            rotate_params = torch.zeros(b, self.num_patches, 1, device=x.device) # (B, N, 1)
+            rotate_params = self.zero_rotation.expand(b, self.num_patches, 1) # (B, N, 1)
 
         transform_params = torch.cat([translate_params, scale_params, rotate_params], dim=-1)
 
@@ -2,8 +2,10 @@
 # MIT License
 # See LICENSE file in the project root for full license information.
 
+import torch
 import torch.nn as nn
 import torch.nn.init as init
+from torch.utils.checkpoint import checkpoint
 
 from modules.SelfAttn import SelfAttn
 
@@ -28,6 +30,9 @@ class ConvSelfAttn(nn.Module):
         self.activation = nn.GELU()
         self.dropout = nn.Dropout(dropout)
 
+        # recompute the activations of every k-th transformer layer in backward, 0 to keep them all
+        self.checkpoint_every = 0
+
         self.init_weights()
 
     def init_weights(self):
@@ -38,10 +43,14 @@ class ConvSelfAttn(nn.Module):
         b, c, h, w = x.size()
         residual = x
 
+        # each image attends over its channels, with batch-first (B, C, E) tokens
         x = x.view(b, c, -1)
         x = self.encode(x)
-        for layer in self.transformer_layers:
-            x, _ = layer(x, mask)
+        for i, layer in enumerate(self.transformer_layers):
+            if self.checkpoint_every and i % self.checkpoint_every == 0 and torch.is_grad_enabled():
+                x, _ = checkpoint(layer, x, mask, use_reentrant=False)
+            else:
+                x, _ = layer(x, mask)
         x = self.decode(x)
         x = self.activation(x)
         x = self.dropout(x)
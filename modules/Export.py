@@ -0,0 +1,47 @@
+# © 2024 Alec Fessler
+# MIT License
+# See LICENSE file in the project root for full license information.
+
+import torch
+from torch.export import Dim, export
+
+def export_program(model, example_input, max_batch_size=4096):
+    """
+    Exports the eval forward of model as a single-graph torch.export ExportedProgram
+    with a dynamic batch dimension. Patch sampling, positional embedding interpolation
+    and attention are traced to aten ops (grid_sample, gather and
+    scaled_dot_product_attention), so the program runs without the Python modules
+    and is the input of export_onnx.
+
+    Shape:
+        - example_input: (batch_size, in_channels, img_size, img_size)
+    """
+    batch = Dim('batch', min=1, max=max_batch_size)
+    return export(model.eval(), (example_input,), dynamic_shapes={'x': {0: batch}})
+
+def export_torchscript(model, example_input):
+    """
+    Traces the eval forward of model to a frozen TorchScript module. The batch size of
+    the traced graph follows its input, the image size is fixed to that of example_input.
+    """
+    with torch.no_grad():
+        traced = torch.jit.trace(model.eval(), example_input)
+    return torch.jit.freeze(traced)
+
+def export_onnx(model, example_input, path, opset_version=18, max_batch_size=4096):
+    """
+    Writes the eval forward of model to an ONNX file with a dynamic batch dimension,
+    using the torch.export based exporter, which requires the onnx and onnxscript
+    packages. grid_sample maps to the GridSample operator of opset 16 and later.
+    """
+    batch = Dim('batch', min=1, max=max_batch_size)
+    torch.onnx.export(
+        model.eval(),
+        (example_input,),
+        path,
+        input_names=['x'],
+        output_names=['logits'],
+        dynamic_shapes={'x': {0: batch}},
+        opset_version=opset_version,
+        dynamo=True
+    )
@@ -0,0 +1,195 @@
+# © 2024 Alec Fessler
+# MIT License
+# See LICENSE file in the project root for full license information.
+
+import torch
+import torch.nn as nn
+
+from modules.AdaptivePatching import AdaptivePatching
+from modules.ConvBlock import ConvBlock
+from modules.ConvSelfAttn import ConvSelfAttn
+from modules.PatchSamplers import grid_sample_patches, make_base_grid
+
+class SelectorStage(nn.Module):
+    """
+    The conv and attention stack of AdaptivePatching, predicting num_params params for
+    each of num_outputs outputs from channel_height x channel_width inputs. The features
+    of the first attention block are returned as well, for a later stage to reuse.
+    """
+    def __init__(
+        self,
+        in_channels,
+        hidden_channels,
+        channel_height,
+        channel_width,
+        num_outputs,
+        num_params,
+        embed_dim
+        ):
+        super(SelectorStage, self).__init__()
+        self.num_outputs = num_outputs
+        self.conv1 = ConvBlock(
+            in_channels=in_channels,
+            out_channels=hidden_channels,
+            kernel_size=3,
+            stride=1,
+            padding=1,
+            bn = False
+        )
+        self.norm1 = nn.LayerNorm([channel_height, channel_width])
+        self.attn1 = ConvSelfAttn(
+            channel_height=channel_height,
+            channel_width=channel_width,
+            embed_dim=embed_dim,
+            num_heads=4,
+            num_transformer_layers=2
+        )
+        self.maxpool = nn.MaxPool2d(kernel_size=2, stride=2)
+        self.conv2 = ConvBlock(
+            in_channels=hidden_channels,
+            out_channels=num_outputs,
+            kernel_size=3,
+            stride=1,
+            padding=1,
+            bn = False
+        )
+        self.norm2 = nn.LayerNorm([channel_height // 2, channel_width // 2])
+        self.attn2 = ConvSelfAttn(
+            channel_height=channel_height // 2,
+            channel_width=channel_width // 2,
+            embed_dim=embed_dim,
+            num_heads=4,
+            num_transformer_layers=2
+        )
+
+        half_channel = channel_height // 2 * channel_width // 2
+        self.fc1 = nn.Linear(half_channel, half_channel // 2)
+        self.relu = nn.ReLU()
+        self.fc2 = nn.Linear(half_channel // 2, num_params)
+
+    def forward(self, x):
+        b = x.size(0)
+        features = self.conv1(x)
+        features = self.norm1(features)
+        features = self.attn1(features) # (B, hidden_channels, H, W)
+
+        params = self.maxpool(features)
+        params = self.conv2(params)
+        params = self.norm2(params)
+        params = self.attn2(params)
+        params = params.view(b, self.num_outputs, -1)
+        params = self.fc1(params)
+        params = self.relu(params)
+        params = self.fc2(params) # (B, num_outputs, num_params)
+        return params, features
+
+class HierarchicalPatching(AdaptivePatching):
+    """
+    A two stage patch selector. The coarse stage picks num_regions regions from a
+    coarse_size thumbnail of the images. The fine stage then places num_patches //
+    num_regions patches within each region, from a region_size crop of the images
+    stacked with the coarse stage's features cropped to the same region. Only the
+    coarse thumbnail and the crops are processed, so the selector's cost grows with
+    the number of regions rather than with the image size.
+
+    Regions span region_scale of the image along each axis. Patches keep the params of
+    AdaptivePatching, scales relative to the image, and are centered by translation within
+    their region, the first num_patches // num_regions in the first region and so on.
+    Crops are sampled bilinearly without anti-aliasing, so region_size should not fall
+    far below region_scale times the image size.
+    """
+    def __init__(
+        self,
+        in_channels,
+        hidden_channels,
+        channel_height,
+        channel_width,
+        num_patches,
+        patch_size,
+        scaling=None, # 'isotropic', 'anisotropic', None
+        max_scale=0.3, # max 0.7071 if rotating=True, else max 1
+        rotating=False,
+        mip_sampling=False, # sample scaled patches from a mip pyramid of the images
+        num_regions=4,
+        region_scale=0.25, # side of a region relative to the image side
+        coarse_size=16, # int or (height, width) of the thumbnail regions are picked from
+        region_size=16 # side of the crop patches are placed from
+        ):
+        assert num_patches % num_regions == 0, 'Number of patches must be divisible by the number of regions'
+        assert 0 < region_scale <= 1, 'Region scale must be in (0, 1]'
+        # read by build_layers, which AdaptivePatching.__init__ calls with the coarse size
+        self.num_regions = num_regions
+        self.region_scale = region_scale
+        self.region_size = region_size
+        super(HierarchicalPatching, self).__init__(
+            in_channels=in_channels,
+            hidden_channels=hidden_channels,
+            channel_height=channel_height,
+            channel_width=channel_width,
+            num_patches=num_patches,
+            patch_size=patch_size,
+            scaling=scaling,
+            max_scale=max_scale,
+            rotating=rotating,
+            thumbnail_size=coarse_size,
+            mip_sampling=mip_sampling
+        )
+        self.register_buffer('region_scale_matrix', torch.eye(2) * region_scale, persistent=False)
+        self.register_buffer('region_grid', make_base_grid(region_size), persistent=False)
+
+    def build_layers(self, in_channels, hidden_channels, channel_height, channel_width, num_transform_params):
+        embed_dim = self.patch_size * self.patch_size * in_channels
+        self.coarse = SelectorStage(
+            in_channels=in_channels,
+            hidden_channels=hidden_channels,
+            channel_height=channel_height,
+            channel_width=channel_width,
+            num_outputs=self.num_regions,
+            num_params=2,
+            embed_dim=embed_dim
+        )
+        self.fine = SelectorStage(
+            in_channels=in_channels + hidden_channels,
+            hidden_channels=hidden_channels,
+            channel_height=self.region_size,
+            channel_width=self.region_size,
+            num_outputs=self.num_patches // self.num_regions,
+            num_params=num_transform_params,
+            embed_dim=embed_dim
+        )
+
+    def crop_regions(self, x, regions):
+        # region_size x region_size crop of every region, regions stacked along the batch
+        b, c = x.size(0), x.size(1)
+        s = self.region_size
+        crops = grid_sample_patches(x, regions.to(x.dtype), self.region_grid.to(x.dtype)) # (B, C, R*S, S)
+        return crops.view(b, c, self.num_regions, s, s).transpose(1, 2).reshape(b * self.num_regions, c, s, s)
+
+    def forward(self, x, image_size=None):
+        # image_size is the (height, width) of the images when x is already a thumbnail of them
+        b, c, h, w = x.size()
+        if image_size is not None:
+            h, w = image_size
+
+        # region centers bounded so that regions stay within the images
+        region_params, features = self.coarse(self.thumbnail(x)) # (B, R, 2), (B, hidden, coarse_h, coarse_w)
+        centers = torch.tanh(region_params) * (1 - self.region_scale) # (B, R, 2)
+        regions = torch.cat([
+            self.region_scale_matrix.expand(b, self.num_regions, 2, 2),
+            centers.unsqueeze(-1)
+        ], dim=-1) # (B, R, 2, 3)
+
+        # regions are learned through the positions of their patches, as gradients through
+        # the crops swamp those of the patch positions and keep the coarse stage from localizing
+        regions = regions.detach()
+        crops = torch.cat([self.crop_regions(x, regions), self.crop_regions(features, regions)], dim=1) # (B*R, C+hidden, S, S)
+        transform_params, _ = self.fine(crops) # (B*R, N/R, num_transform_params)
+        transform_params = self.bound_transform_params(transform_params.reshape(b, self.num_patches, -1), h, w)
+
+        # patch centers in [-1, 1] within a region, moved to its center. the affine transforms
+        # scale translations by 1 minus the patch extents, which is divided out so that the
+        # centers stay within their regions, and larger patches may overhang the images
+        patch_centers = centers.repeat_interleave(self.num_patches // self.num_regions, dim=1) \
+            + self.region_scale * transform_params[:, :, :2] # (B, N, 2)
+        translate_params = patch_centers / torch.clamp(1 - self.patch_extents(transform_params), min=1e-6)
+        return torch.cat([translate_params, transform_params[:, :, 2:]], dim=-1)
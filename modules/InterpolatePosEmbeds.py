@@ -3,8 +3,13 @@
 # See LICENSE file in the project root for full license information.
 
 import torch
+import torch.nn.functional as F
 
-def interpolate_pos_embeds(pos_embeds, coords):
+# largest embedding grid interpolated through a dense interpolation matrix, beyond
+# which gathering the corner embeddings is cheaper
+MAX_DENSE_EMBEDS = 256
+
+def interpolate_pos_embeds(pos_embeds, coords, grid_shape=None):
     """
     Interpolate positional embeddings for use with the AdaptivePatching module.
 
@@ -13,18 +18,21 @@ def interpolate_pos_embeds(pos_embeds, coords):
     positional encoding for dynamically selected patches.
 
     Assumptions:
-    - Input positional embeddings form a square grid
+    - Input positional embeddings form a row-major grid of grid_shape, square if
+      grid_shape is not given
     - Coordinates are normalized to the range [-1, 1], where (-1, -1) is the
       top-left corner and (1, 1) is the bottom-right corner of the grid
 
     Args:
         pos_embeds (torch.Tensor): Grid of positional embeddings
-        coords (torch.Tensor): Normalized coordinates for interpolation
+        coords (torch.Tensor): Normalized coordinates for interpolation, as (x, y)
+        grid_shape (tuple, optional): (grid_height, grid_width) of the embedding grid
 
     Shape:
         - pos_embeds: (num_embeds, embedding_dim)
-        - coords: (batch_size, num_patches, 2)
-        - Output: (batch_size, num_patches, embedding_dim)
+        - coords: (*, 2), any leading shape, e.g. (batch_size, num_patches, 2) or
+          (num_sets, batch_size, num_patches, 2) for several sets of patches at once
+        - Output: (*, embedding_dim)
 
     Returns:
         torch.Tensor: Interpolated embeddings for the given coordinates
@@ -34,34 +42,97 @@ def interpolate_pos_embeds(pos_embeds, coords):
         compute appropriate positional embeddings for the selected patches.
         It ensures that the positional information accurately reflects the
         patches' locations, even when they don't align with the original grid.
+
+        The four corners of every coordinate are found at once as stacked flat indices
+        and bilinear weights. For grids of up to MAX_DENSE_EMBEDS embeddings they are
+        scattered into a dense (*, num_embeds) interpolation matrix, so that forward and
+        both backward products are matrix multiplies. Larger grids fetch the corner
+        embeddings with a single gather and blend them with one batched matrix multiply,
+        so that backward is a single index-add into pos_embeds. Both run in the dtype
+        of pos_embeds, also under autocast.
     """
     num_embeds, embedding_dim = pos_embeds.size()
-    grid_size = int(num_embeds ** 0.5)
-    pos_embeds = pos_embeds.view(grid_size, grid_size, embedding_dim)
+    if grid_shape is None:
+        grid_shape = (int(num_embeds ** 0.5),) * 2
+    grid_height, grid_width = grid_shape
+    assert grid_height * grid_width == num_embeds, 'grid_shape must hold num_embeds embeddings'
 
-    coords = (coords + 1) * (grid_size - 1) / 2
-    coords_floor = torch.floor(coords)
-    delta = coords - coords_floor
+    # (x, y) coordinates scale with the grid width and height respectively
+    coords = coords.to(pos_embeds.dtype)
+    x = (coords[..., 0:1] + 1) * (grid_width - 1) / 2
+    y = (coords[..., 1:2] + 1) * (grid_height - 1) / 2
+    x_floor, y_floor = torch.floor(x), torch.floor(y)
+    delta_x, delta_y = x - x_floor, y - y_floor # (*, 1)
 
-    x0y0 = coords_floor.long().clamp(0, grid_size - 1)
-    x1y1 = (x0y0 + 1).clamp(0, grid_size - 1)
+    x0 = x_floor.squeeze(-1).long().clamp(0, grid_width - 1)
+    y0 = y_floor.squeeze(-1).long().clamp(0, grid_height - 1)
+    x1 = (x0 + 1).clamp(0, grid_width - 1)
+    y1 = (y0 + 1).clamp(0, grid_height - 1)
 
-    embed00 = pos_embeds[x0y0[..., 1], x0y0[..., 0]]
-    embed01 = pos_embeds[x1y1[..., 1], x0y0[..., 0]]
-    embed10 = pos_embeds[x0y0[..., 1], x1y1[..., 0]]
-    embed11 = pos_embeds[x1y1[..., 1], x1y1[..., 0]]
+    # flat indices and bilinear weights of the corners 00, 01, 10 and 11, as (x, y)
+    corner_idx = torch.stack([y0 * grid_width + x0, y1 * grid_width + x0, y0 * grid_width + x1, y1 * grid_width + x1], dim=-1) # (*, 4)
+    weights = torch.cat([1 - delta_x, 1 - delta_x, delta_x, delta_x], dim=-1) \
+        * torch.cat([1 - delta_y, delta_y, 1 - delta_y, delta_y], dim=-1) # (*, 4)
 
-    delta_x, delta_y = delta[..., 0], delta[..., 1]
-    w00 = (1 - delta_x) * (1 - delta_y)
-    w01 = (1 - delta_x) * delta_y
-    w10 = delta_x * (1 - delta_y)
-    w11 = delta_x * delta_y
+    with torch.autocast(device_type=pos_embeds.device.type, enabled=False):
+        if num_embeds <= MAX_DENSE_EMBEDS:
+            # corners clamped onto the same embedding add up their weights
+            interp_matrix = weights.new_zeros(*weights.shape[:-1], num_embeds).scatter_add(-1, corner_idx, weights) # (*, num_embeds)
+            interpolated = interp_matrix @ pos_embeds # (*, D)
+        else:
+            corner_embeds = F.embedding(corner_idx, pos_embeds) # (*, 4, D)
+            interpolated = (weights.unsqueeze(-2) @ corner_embeds).squeeze(-2) # (*, D)
 
-    w00 = w00.unsqueeze(-1)
-    w01 = w01.unsqueeze(-1)
-    w10 = w10.unsqueeze(-1)
-    w11 = w11.unsqueeze(-1)
+    return interpolated
 
-    interpolated = (w00 * embed00) + (w01 * embed01) + (w10 * embed10) + (w11 * embed11)
+def upsample_pos_embeds(pos_embeds, resolution, grid_shape=None):
+    """
+    Bilinearly interpolates the positional embedding grid at every point of a
+    resolution x resolution lattice spanning [-1, 1], for nearest lookups with
+    lookup_pos_embeds. grid_shape is that of interpolate_pos_embeds.
 
+    Shape:
+        - pos_embeds: (num_embeds, embedding_dim)
+        - Output: (resolution * resolution, embedding_dim), row-major as (y, x)
+    """
+    points = torch.linspace(-1, 1, resolution, dtype=pos_embeds.dtype, device=pos_embeds.device)
+    grid_y, grid_x = torch.meshgrid(points, points, indexing='ij')
+    lattice = torch.stack([grid_x, grid_y], dim=-1).view(-1, 2) # (R*R, 2) as (x, y)
+    return interpolate_pos_embeds(pos_embeds, lattice, grid_shape)
+
+def lookup_pos_embeds(lut, coords):
+    """
+    Positional embeddings at the lattice points of an upsample_pos_embeds table
+    nearest to the given normalized coordinates. The lookup is off the bilinear
+    interpolation by at most half a lattice step in each direction.
+
+    Shape:
+        - lut: (resolution * resolution, embedding_dim)
+        - coords: (*, 2)
+        - Output: (*, embedding_dim)
+    """
+    resolution = int(lut.size(0) ** 0.5)
+    idx = torch.round((coords + 1) * (resolution - 1) / 2).long().clamp(0, resolution - 1)
+    return F.embedding(idx[..., 1] * resolution + idx[..., 0], lut)
+
+def interpolate_pos_embed_pyramid(pyramid, grid_shapes, coords, levels):
+    """
+    Interpolates a pyramid of positional embedding grids, from the finest grid at
+    level 0 to coarser grids for larger patches, at fractional levels. Each
+    coordinate blends its bilinear interpolations in the two levels around it
+    linearly, as trilinear filtering does over mip levels, so the embeddings vary
+    smoothly with the patch scale.
+
+    Shape:
+        - pyramid: list of (num_embeds_l, embedding_dim) grids
+        - grid_shapes: list of (grid_height_l, grid_width_l)
+        - coords: (*, 2)
+        - levels: (*), clamped to [0, len(pyramid) - 1]
+        - Output: (*, embedding_dim)
+    """
+    levels = levels.clamp(0, len(pyramid) - 1).unsqueeze(-1)
+    interpolated = 0
+    for level, (pos_embeds, grid_shape) in enumerate(zip(pyramid, grid_shapes)):
+        weights = (1 - (levels - level).abs()).clamp(min=0) # (*, 1), nonzero for two levels at most
+        interpolated = interpolated + weights.to(pos_embeds.dtype) * interpolate_pos_embeds(pos_embeds, coords, grid_shape)
     return interpolated
@@ -0,0 +1,92 @@
+# © 2024 Alec Fessler
+# MIT License
+# See LICENSE file in the project root for full license information.
+
+import math
+import torch
+from torch import nn
+import torch.nn.functional as F
+import torch.nn.init as init
+
+class MultiheadSelfAttn(nn.Module):
+    """
+    Multi-head self-attention with a fused QKV projection, computed with
+    scaled_dot_product_attention. The parameters are named and initialized as in
+    nn.MultiheadAttention, so state dicts of either module load into the other.
+
+    Attention weights are only materialized when need_weights is set, in which case
+    they are averaged over heads as nn.MultiheadAttention does by default. Inputs are
+    batch-first, as with nn.MultiheadAttention(batch_first=True).
+
+    Shape:
+        - x: (batch_size, seq_len, embed_dim)
+        - key_padding_mask: (batch_size, seq_len), True for keys to ignore
+        - Output: (batch_size, seq_len, embed_dim) and, if need_weights is set,
+          attention weights (batch_size, seq_len, seq_len), otherwise None
+    """
+    def __init__(
+        self,
+        embed_dim,
+        num_heads
+    ):
+        super(MultiheadSelfAttn, self).__init__()
+        self.embed_dim = embed_dim
+        self.num_heads = num_heads
+        self.head_dim = embed_dim // num_heads
+        assert embed_dim % num_heads == 0, f"embed_dim must be divisible by num_heads"
+
+        self.in_proj_weight = nn.Parameter(torch.empty(3 * embed_dim, embed_dim))
+        self.in_proj_bias = nn.Parameter(torch.empty(3 * embed_dim))
+        self.out_proj = nn.Linear(embed_dim, embed_dim)
+
+        # set by linear_in_proj, in which case the QKV projection runs through this module
+        self.in_proj = None
+
+        self.init_weights()
+
+    def init_weights(self):
+        init.xavier_uniform_(self.in_proj_weight)
+        init.zeros_(self.in_proj_bias)
+        init.zeros_(self.out_proj.bias)
+
+    def linear_in_proj(self):
+        """
+        Moves the fused QKV projection into an nn.Linear submodule, so that module swaps
+        such as dynamic quantization reach it. The parameters are renamed from
+        in_proj_weight and in_proj_bias to in_proj.weight and in_proj.bias.
+        """
+        in_proj = nn.Linear(self.embed_dim, 3 * self.embed_dim, device=self.in_proj_weight.device)
+        with torch.no_grad():
+            in_proj.weight.copy_(self.in_proj_weight)
+            in_proj.bias.copy_(self.in_proj_bias)
+        del self.in_proj_weight, self.in_proj_bias
+        self.in_proj = in_proj
+
+    def forward(self, x, key_padding_mask=None, need_weights=False):
+        b, l, e = x.size()
+
+        # project queries, keys and values at once and split them into heads
+        if self.in_proj is not None:
+            qkv = self.in_proj(x) # (B, L, 3E)
+        else:
+            qkv = F.linear(x, self.in_proj_weight, self.in_proj_bias) # (B, L, 3E)
+        qkv = qkv.view(b, l, 3, self.num_heads, self.head_dim).permute(2, 0, 3, 1, 4) # (3, B, H, L, D)
+        q, k, v = qkv.unbind(0)
+
+        attn_mask = None
+        if key_padding_mask is not None:
+            attn_mask = ~key_padding_mask.view(b, 1, 1, l).bool() # True where attention is allowed
+
+        attn_weights = None
+        if need_weights:
+            scores = q @ k.transpose(-2, -1) / math.sqrt(self.head_dim) # (B, H, L, L)
+            if attn_mask is not None:
+                scores = scores.masked_fill(~attn_mask, float('-inf'))
+            attn_weights = scores.softmax(dim=-1)
+            attn_output = attn_weights @ v
+            attn_weights = attn_weights.mean(dim=1) # (B, L, L)
+        else:
+            attn_output = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask) # (B, H, L, D)
+
+        attn_output = attn_output.transpose(1, 2).reshape(b, l, e)
+        return self.out_proj(attn_output), attn_weights
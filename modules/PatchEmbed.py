@@ -25,3 +25,35 @@ class PatchEmbed(nn.Module):
         x = x.flatten(2)
         x = x.transpose(1, 2)
         return x
+
+    def dense_embed(self, x):
+        """
+        Embeds every patch_size x patch_size window of the input at stride 1.
+
+        Shape:
+            - x: (batch_size, in_channels, height, width)
+            - Output: (batch_size, embed_dim, height - patch_size + 1, width - patch_size + 1)
+        """
+        return nn.functional.conv2d(x, self.proj.weight, self.proj.bias)
+
+    def gather_embeds(self, dense_embeds, coords):
+        """
+        Bilinearly samples patch embeddings from a dense embedding map.
+
+        The projection is linear, so embedding a bilinearly sampled, axis-aligned patch
+        equals the bilinear blend of the dense embeddings at its four neighbouring
+        integer offsets. Coordinates are normalized to [-1, 1] over the range of valid
+        patch offsets, which is exactly the translation param predicted by the
+        AdaptivePatching module before it is scaled by the patch extent.
+
+        Shape:
+            - dense_embeds: (batch_size, embed_dim, dense_height, dense_width)
+            - coords: (batch_size, num_patches, 2)
+            - Output: (batch_size, num_patches, embed_dim)
+        """
+        embeds = nn.functional.grid_sample(
+            dense_embeds,
+            coords.unsqueeze(2).to(dense_embeds.dtype), # (B, N, 1, 2)
+            align_corners=True
+        ) # (B, D, N, 1)
+        return embeds.squeeze(-1).transpose(1, 2)
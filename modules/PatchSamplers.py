@@ -0,0 +1,377 @@
+# © 2024 Alec Fessler
+# MIT License
+# See LICENSE file in the project root for full license information.
+
+import contextlib
+import torch
+import torch.nn as nn
+
+def make_base_grid(patch_size):
+    """
+    Normalized sampling coordinates of a patch_size x patch_size patch in homogeneous
+    form, matching affine_grid with align_corners=False.
+
+    Shape:
+        - Output: (patch_size, patch_size, 3), holding (x, y, 1) at each position
+    """
+    coords = (torch.arange(patch_size, dtype=torch.float32) * 2 + 1) / patch_size - 1
+    grid_y, grid_x = torch.meshgrid(coords, coords, indexing='ij')
+    return torch.stack([grid_x, grid_y, torch.ones_like(grid_x)], dim=-1)
+
+def patch_grid(affine_transforms, base_grid):
+    """
+    Builds one sampling grid per image holding the grids of all of its patches
+    stacked along the height axis, as base_grid . A^T in a single einsum.
+
+    Shape:
+        - affine_transforms: (batch_size, num_patches, 2, 3)
+        - base_grid: (patch_size, patch_size, 3)
+        - Output: (batch_size, num_patches * patch_size, patch_size, 2)
+    """
+    b, n, _, _ = affine_transforms.size()
+    p = base_grid.size(0)
+    return torch.einsum('hwk,bnjk->bnhwj', base_grid, affine_transforms).reshape(b, n * p, p, 2)
+
+def translation_offsets(affine_transforms, patch_size, height, width):
+    """
+    Top-left pixel corner of each translation-only patch, as (x, y).
+
+    With a scale of patch_size / width (and height), a patch sampled by grid_sample
+    at translation t starts at pixel ((t + 1) * width - patch_size) / 2.
+
+    Shape:
+        - affine_transforms: (batch_size, num_patches, 2, 3)
+        - Output: (batch_size, num_patches, 2)
+    """
+    translate_x = affine_transforms[..., 0, 2] # (B, N)
+    translate_y = affine_transforms[..., 1, 2] # (B, N)
+    return torch.stack([(translate_x + 1) * (width / 2), (translate_y + 1) * (height / 2)], dim=-1) - patch_size / 2
+
+def gather_windows(x, offsets, patch_size):
+    """
+    Gathers the (P+1) x (P+1) pixel window under each translated patch along with
+    the fractional part of its offset, which is shared by every sample in the patch.
+
+    Shape:
+        - x: (batch_size, channels, height, width)
+        - offsets: (batch_size, num_patches, 2), top-left corners in pixels as (x, y)
+        - Output: windows (batch_size, num_patches, channels, P+1, P+1), the flat
+          window indices into x and the fractional offsets (batch_size, num_patches, 2)
+    """
+    b, c, h, w = x.size()
+    n = offsets.size(1)
+
+    corner = offsets.floor()
+    delta = offsets - corner
+
+    window = torch.arange(patch_size + 1, device=x.device)
+    cols = (corner[..., 0].long().unsqueeze(-1) + window).clamp(0, w - 1) # (B, N, P+1)
+    rows = (corner[..., 1].long().unsqueeze(-1) + window).clamp(0, h - 1) # (B, N, P+1)
+    window_idx = (rows.unsqueeze(-1) * w + cols.unsqueeze(-2)).view(b, n, 1, -1).expand(-1, -1, c, -1)
+
+    windows = torch.gather(
+        x.reshape(b, 1, c, h * w).expand(-1, n, -1, -1), # (B, N, C, H*W)
+        3,
+        window_idx # (B, N, C, (P+1)*(P+1))
+    ).view(b, n, c, patch_size + 1, patch_size + 1)
+
+    return windows, window_idx, delta
+
+def interpolate_windows(windows, delta):
+    """
+    Bilinearly interpolates each gathered window at its fractional offset.
+
+    Shape:
+        - windows: (batch_size, num_patches, channels, P+1, P+1)
+        - delta: (batch_size, num_patches, 2)
+        - Output: (batch_size, num_patches, channels, P, P)
+    """
+    delta_x = delta[..., 0, None, None, None] # (B, N, 1, 1, 1)
+    delta_y = delta[..., 1, None, None, None] # (B, N, 1, 1, 1)
+    patches = torch.lerp(windows[..., :-1, :], windows[..., 1:, :], delta_y) # (B, N, C, P, P+1)
+    return torch.lerp(patches[..., :-1], patches[..., 1:], delta_x) # (B, N, C, P, P)
+
+def sampling_dtype(x, affine_transforms):
+    # float32, or float64 when either input is float64
+    return torch.promote_types(torch.promote_types(x.dtype, affine_transforms.dtype), torch.float32)
+
+def autocast_enabled(x):
+    # autocast is never enabled on devices it does not support, such as meta
+    return torch.amp.is_autocast_available(x.device.type) and torch.is_autocast_enabled(x.device.type)
+
+def autocast_disabled(x):
+    # disables autocast on the device of x, where it is supported
+    if torch.amp.is_autocast_available(x.device.type):
+        return torch.autocast(device_type=x.device.type, enabled=False)
+    return contextlib.nullcontext()
+
+def sample_patch_grids(x, affine_transforms, base_grid):
+    """
+    grid_samples the patch grids of affine_transforms from x with autocast disabled,
+    building the grid in float32 as well as sampling in it. Autocast would sample in
+    float32 but build the grid from a lower precision einsum, at other points than
+    AffinePatchSampler's backward rebuilds outside of autocast. The output is float32
+    under autocast, as that of grid_sample, and in the dtype of x otherwise.
+    """
+    dtype = sampling_dtype(x, affine_transforms)
+    output_dtype = dtype if autocast_enabled(x) else x.dtype
+    with autocast_disabled(x):
+        grid = patch_grid(affine_transforms.to(dtype), base_grid.to(dtype))
+        return nn.functional.grid_sample(x.to(dtype), grid, align_corners=False).to(output_dtype)
+
+class AffinePatchSampler(torch.autograd.Function):
+    """
+    Samples patches with grid_sample while saving only the input and the affine
+    transforms for backward. The sampling grid is rebuilt in backward and only the
+    gradients that are needed are computed, which is usually just the gradient
+    w.r.t. the affine transforms as the input image is not differentiated.
+
+    Shape:
+        - x: (batch_size, channels, height, width)
+        - affine_transforms: (batch_size, num_patches, 2, 3)
+        - base_grid: (patch_size, patch_size, 3), see make_base_grid
+        - Output: (batch_size, channels, num_patches * patch_size, patch_size)
+    """
+    @staticmethod
+    def forward(ctx, x, affine_transforms, base_grid):
+        ctx.save_for_backward(x, affine_transforms, base_grid)
+        return sample_patch_grids(x, affine_transforms, base_grid)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        x, affine_transforms, base_grid = ctx.saved_tensors
+        b, n, _, _ = affine_transforms.size()
+        p = base_grid.size(0)
+
+        # the grid is rebuilt in the dtype forward sampled in, whatever the dtype of
+        # grad_output, so that the gradients are taken at the same sampling points
+        dtype = sampling_dtype(x, affine_transforms)
+        with autocast_disabled(x):
+            base_grid = base_grid.to(dtype)
+            # bilinear interpolation, zeros padding, align_corners=False
+            grad_x, grad_grid = torch.ops.aten.grid_sampler_2d_backward(
+                grad_output.to(dtype).contiguous(),
+                x.to(dtype),
+                patch_grid(affine_transforms.to(dtype), base_grid),
+                0,
+                0,
+                False,
+                [ctx.needs_input_grad[0], True]
+            )
+
+            # the grid is linear in the affine transforms
+            grad_affine_transforms = torch.einsum('bnhwj,hwk->bnjk', grad_grid.view(b, n, p, p, 2), base_grid)
+
+        if grad_x is not None:
+            grad_x = grad_x.to(x.dtype)
+        return grad_x, grad_affine_transforms.to(affine_transforms.dtype), None
+
+class TranslatedPatchSampler(torch.autograd.Function):
+    """
+    Samples axis-aligned P x P patches at fractional pixel offsets. Only the input
+    and the offsets are saved for backward, where the pixel windows are gathered
+    again and the gradient w.r.t. the offsets is computed in closed form.
+
+    Shape:
+        - x: (batch_size, channels, height, width)
+        - offsets: (batch_size, num_patches, 2), top-left corners in pixels as (x, y)
+        - Output: (batch_size, num_patches, channels, patch_size, patch_size)
+    """
+    @staticmethod
+    def forward(ctx, x, offsets, patch_size):
+        ctx.save_for_backward(x, offsets)
+        ctx.patch_size = patch_size
+
+        windows, _, delta = gather_windows(x, offsets, patch_size)
+        return interpolate_windows(windows, delta)
+
+    @staticmethod
+    def backward(ctx, grad_patches):
+        x, offsets = ctx.saved_tensors
+        b, c, h, w = x.size()
+
+        windows, window_idx, delta = gather_windows(x, offsets, ctx.patch_size)
+        delta_x = delta[..., 0, None, None, None] # (B, N, 1, 1, 1)
+        delta_y = delta[..., 1, None, None, None] # (B, N, 1, 1, 1)
+
+        grad_x = grad_offsets = None
+        if ctx.needs_input_grad[1]:
+            rows = torch.lerp(windows[..., :-1, :], windows[..., 1:, :], delta_y) # (B, N, C, P, P+1)
+            row_diffs = windows[..., 1:, :] - windows[..., :-1, :] # (B, N, C, P, P+1)
+            grad_offsets = torch.stack([
+                (grad_patches * (rows[..., 1:] - rows[..., :-1])).sum(dim=(2, 3, 4)),
+                (grad_patches * torch.lerp(row_diffs[..., :-1], row_diffs[..., 1:], delta_x)).sum(dim=(2, 3, 4))
+            ], dim=-1) # (B, N, 2)
+
+        if ctx.needs_input_grad[0]:
+            # spread the patch gradients back over the window, then onto the input pixels
+            grad_rows = nn.functional.pad(grad_patches * (1 - delta_x), (0, 1)) + nn.functional.pad(grad_patches * delta_x, (1, 0))
+            grad_windows = nn.functional.pad(grad_rows * (1 - delta_y), (0, 0, 0, 1)) + nn.functional.pad(grad_rows * delta_y, (0, 0, 1, 0))
+            grad_x = torch.zeros(b, c, h * w, dtype=x.dtype, device=x.device).scatter_add_(
+                2,
+                window_idx.transpose(1, 2).reshape(b, c, -1),
+                grad_windows.transpose(1, 2).reshape(b, c, -1)
+            ).view(b, c, h, w)
+
+        return grad_x, grad_offsets, None
+
+def grid_sample_patches(x, affine_transforms, base_grid):
+    """
+    AffinePatchSampler while gradients are recorded, otherwise the grid_sample of its
+    forward, so that traced and exported graphs hold no Python autograd function.
+    """
+    if torch.is_grad_enabled():
+        return AffinePatchSampler.apply(x, affine_transforms, base_grid)
+    return sample_patch_grids(x, affine_transforms, base_grid)
+
+def translate_patches(x, offsets, patch_size):
+    """
+    TranslatedPatchSampler while gradients are recorded, otherwise the window gather
+    and interpolation of its forward, as with grid_sample_patches.
+    """
+    if torch.is_grad_enabled():
+        return TranslatedPatchSampler.apply(x, offsets, patch_size)
+    windows, _, delta = gather_windows(x, offsets, patch_size)
+    return interpolate_windows(windows, delta)
+
+def halve(x):
+    """
+    2x2 average pooling, as avg_pool2d(x, 2) dropping odd last rows and columns,
+    written as two strided additions, which run several times faster on CPU.
+    """
+    h, w = x.size(2) // 2 * 2, x.size(3) // 2 * 2
+    rows = x[..., 0:h:2, :w] + x[..., 1:h:2, :w]
+    return (rows[..., 0::2] + rows[..., 1::2]) * 0.25
+
+def build_mip_atlas(x, num_levels):
+    """
+    Packs levels 1 to num_levels - 1 of the mip pyramid of x, each 2x2 average pooled
+    from the one before it, side by side into one image. Each level is surrounded by a
+    border of zeros one pixel wide, so that a single grid_sample call can read every
+    level with the zeros padding of sampling it alone. Level 0 is x itself, which is
+    sampled directly rather than copied into the atlas.
+
+    Shape:
+        - x: (batch_size, channels, height, width)
+        - Output: the atlas (batch_size, channels, height // 2 + 2, atlas_width) and the
+          left pixel offset, width and height of each level in it, from level 1
+    """
+    levels = [halve(x)]
+    for _ in range(2, num_levels):
+        levels.append(halve(levels[-1]))
+
+    lefts = [1]
+    for level in levels[:-1]:
+        lefts.append(lefts[-1] + level.size(3) + 1)
+    widths = [level.size(3) for level in levels]
+    heights = [level.size(2) for level in levels]
+
+    atlas = x.new_zeros(x.size(0), x.size(1), heights[0] + 2, lefts[-1] + widths[-1] + 1)
+    for level, left in zip(levels, lefts):
+        atlas[:, :, 1:1 + level.size(2), left:left + level.size(3)] = level
+    return atlas, lefts, widths, heights
+
+def mip_sample_patches(x, affine_transforms, base_grid, num_levels):
+    """
+    Samples patches from a mip pyramid of x, reading each patch from the two levels
+    around the one whose pixels match its sample spacing and blending them linearly,
+    as trilinear texture filtering does. Patches larger than P x P pixels are thereby
+    area averaged rather than aliased, at three times the cost of sampling them
+    bilinearly whatever their scale, plus building the pyramid once per batch. The
+    level follows the longer sample spacing of the two patch axes, so that neither
+    aliases. With num_levels = 1 this is grid_sample_patches.
+
+    Shape:
+        - x: (batch_size, channels, height, width)
+        - affine_transforms: (batch_size, num_patches, 2, 3)
+        - base_grid: (patch_size, patch_size, 3), see make_base_grid
+        - Output: (batch_size, channels, num_patches * patch_size, patch_size)
+    """
+    if num_levels == 1:
+        return grid_sample_patches(x, affine_transforms, base_grid)
+
+    # as in sample_patch_grids, the grid, and the levels and atlas coordinates taken from it,
+    # are computed in float32 with autocast disabled rather than from a lower precision einsum
+    dtype = sampling_dtype(x, affine_transforms)
+    output_dtype = dtype if autocast_enabled(x) else x.dtype
+    x, affine_transforms, base_grid = x.to(dtype), affine_transforms.to(dtype), base_grid.to(dtype)
+    with autocast_disabled(x):
+        b, c, h, w = x.size()
+        n = affine_transforms.size(1)
+        p = base_grid.size(0)
+        atlas, lefts, widths, heights = build_mip_atlas(x, num_levels)
+
+        # pixel distance between neighbouring samples along each patch axis, whose log2 is
+        # the level. the columns of A map patch axes onto normalized image coordinates
+        spacing = torch.stack([
+            affine_transforms[..., 0, :2] * (w / p),
+            affine_transforms[..., 1, :2] * (h / p)
+        ], dim=-2).norm(dim=-2) # (B, N, 2)
+        level = torch.log2(spacing.amax(dim=-1).clamp(min=1)).clamp(max=num_levels - 1) # (B, N)
+        lower = level.detach().floor().long().clamp(max=num_levels - 2)
+        blend = level - lower
+
+        # patches between levels 0 and 1 read level 0 from x, all others read both of their
+        # levels from the atlas, whose first level is level 1
+        from_x = (lower == 0).to(x.dtype)
+        weights = torch.stack([(1 - blend) * from_x, (1 - blend) * (1 - from_x), blend]).view(3, b, 1, n, 1, 1)
+        atlas_levels = torch.stack([lower.clamp(min=1), lower + 1]) - 1 # (2, B, N)
+
+        # normalized coordinates of every sample, moved into the pixels of both of its levels
+        # in the atlas. clamping to one pixel past the level keeps reads inside its zero border
+        grid = patch_grid(affine_transforms, base_grid) # (B, N*P, P, 2)
+        level_grid = grid.view(1, b, n, p, p, 2)
+        left = x.new_tensor(lefts)[atlas_levels][..., None, None] # (2, B, N, 1, 1)
+        width = x.new_tensor(widths)[atlas_levels][..., None, None]
+        height = x.new_tensor(heights)[atlas_levels][..., None, None]
+        u = torch.minimum(((level_grid[..., 0] + 1) * width - 1) / 2, width).clamp(min=-1) + left
+        v = torch.minimum(((level_grid[..., 1] + 1) * height - 1) / 2, height).clamp(min=-1) + 1
+        atlas_grid = torch.stack([
+            (2 * u + 1) / atlas.size(3) - 1,
+            (2 * v + 1) / atlas.size(2) - 1
+        ], dim=-1) # (2, B, N, P, P, 2)
+
+        # both atlas levels of all N patches of an image are sampled in one call, stacked along height
+        atlas_samples = nn.functional.grid_sample(
+            atlas,
+            atlas_grid.transpose(0, 1).reshape(b, 2 * n * p, p, 2),
+            align_corners=False
+        ).view(b, c, 2, n, p, p)
+        x_samples = nn.functional.grid_sample(x, grid, align_corners=False).view(b, c, n, p, p)
+
+        patches = weights[0] * x_samples + weights[1] * atlas_samples[:, :, 0] + weights[2] * atlas_samples[:, :, 1]
+    return patches.view(b, c, n * p, p).to(output_dtype)
+
+def sample_and_embed(x, affine_transforms, weight, bias=None, base_grid=None, translation_only=False, mip_levels=1):
+    """
+    Samples patches and projects each one with the PatchEmbed convolution weights,
+    producing patch tokens directly instead of sampling (B, N, C, P, P) patches,
+    reshaping them into a strip and running the strided convolution over it.
+
+    The sampled patches are already laid out as contiguous (C, P, P) blocks, so the
+    projection is a single matrix multiply against the flattened kernel. Each token
+    equals PatchEmbed applied to its patch as a P x P image.
+
+    Shape:
+        - x: (batch_size, channels, height, width)
+        - affine_transforms: (batch_size, num_patches, 2, 3)
+        - weight: (embed_dim, channels, patch_size, patch_size)
+        - bias: (embed_dim,)
+        - base_grid: (patch_size, patch_size, 3), built on the fly if not given
+        - mip_levels: levels of the mip pyramid sampled by mip_sample_patches, 1 to sample x
+        - Output: (batch_size, num_patches, embed_dim)
+    """
+    b, c, h, w = x.size()
+    n = affine_transforms.size(1)
+    d, _, p, _ = weight.size()
+
+    if translation_only:
+        offsets = translation_offsets(affine_transforms, p, h, w)
+        patches = translate_patches(x, offsets.to(x.dtype), p) # (B, N, C, P, P)
+        return nn.functional.linear(patches.view(b, n, -1), weight.view(d, -1), bias)
+
+    if base_grid is None:
+        base_grid = make_base_grid(p).to(x.device)
+    patches = mip_sample_patches(x, affine_transforms, base_grid, mip_levels).view(b, c, n, p * p) # (B, C, N, P*P)
+    tokens = torch.einsum('bcnk,dck->bnd', patches, weight.view(d, c, p * p))
+    return tokens + bias if bias is not None else tokens
@@ -4,27 +4,51 @@
 
 import torch
 
-def perturb_transform_params(transform_params, min_perturb=0.01, max_perturb=0.05, perturb_scale=False, perturb_rotate=False):
+def perturb_transform_param_sets(transform_params, num_sets, min_perturb=0.01, max_perturb=0.05, perturb_scale=False, perturb_rotate=False):
+    """
+    Generates num_sets randomly perturbed copies of transform_params in one batched
+    pass. The input is left untouched.
+
+    Shape:
+        - transform_params: (batch_size, num_patches, 5)
+        - Output: (num_sets, batch_size, num_patches, 5)
+    """
     # scale params to 0, 1 (scale already is)
-    transform_params[:, :, :2] = (transform_params[:, :, :2] + 1) / 2
-    transform_params[:, :, 4:5] = (transform_params[:, :, 4:5] / torch.pi + 1) / 2
+    transform_params = torch.cat([
+        (transform_params[..., :2] + 1) / 2,
+        transform_params[..., 2:4],
+        (transform_params[..., 4:5] / torch.pi + 1) / 2
+    ], dim=-1)
 
-    perturbs = torch.rand_like(transform_params) * (max_perturb - min_perturb) + min_perturb
-    if not perturb_scale:
-        perturbs[:, :, 2:4] = 0
-    if not perturb_rotate:
-        perturbs[:, :, 4:5] = 0
+    perturbs = torch.rand(num_sets, *transform_params.shape, dtype=transform_params.dtype, device=transform_params.device)
+    perturbs = perturbs * (max_perturb - min_perturb) + min_perturb
+    perturbs = torch.cat([
+        perturbs[..., :2],
+        perturbs[..., 2:4] * perturb_scale,
+        perturbs[..., 4:5] * perturb_rotate
+    ], dim=-1)
 
     # if param is more positive, liklihood of negative perturb is higher, and vice versa
-    sign_flip_rolls = torch.rand_like(transform_params)
+    sign_flip_rolls = torch.rand_like(perturbs)
     signs = torch.where(sign_flip_rolls > transform_params, 1, -1)
     perturbs = perturbs * signs
 
-    transform_params = transform_params + perturbs
+    transform_params = transform_params + perturbs # (K, B, N, 5)
     transform_params = torch.clamp(transform_params, 0, 1)
 
     # scale params back to original range
-    transform_params[:, :, :2] = transform_params[:, :, :2] * 2 - 1
-    transform_params[:, :, 4:5] = (transform_params[:, :, 4:5] * 2 - 1) * torch.pi
+    return torch.cat([
+        transform_params[..., :2] * 2 - 1,
+        transform_params[..., 2:4],
+        (transform_params[..., 4:5] * 2 - 1) * torch.pi
+    ], dim=-1)
 
-    return transform_params
+def perturb_transform_params(transform_params, min_perturb=0.01, max_perturb=0.05, perturb_scale=False, perturb_rotate=False):
+    return perturb_transform_param_sets(
+        transform_params,
+        1,
+        min_perturb=min_perturb,
+        max_perturb=max_perturb,
+        perturb_scale=perturb_scale,
+        perturb_rotate=perturb_rotate
+    )[0]
@@ -0,0 +1,29 @@
+# © 2024 Alec Fessler
+# MIT License
+# See LICENSE file in the project root for full license information.
+
+from copy import deepcopy
+import torch
+import torch.nn as nn
+from torch.ao.quantization import quantize_dynamic
+
+from modules.MultiheadSelfAttn import MultiheadSelfAttn
+
+def quantize_for_inference(model):
+    """
+    Returns an int8 dynamically quantized copy of model for CPU inference.
+
+    Every nn.Linear is swapped for a dynamically quantized one with int8 weights and
+    activations quantized per batch. This covers the QKV, output and MLP projections
+    of SelfAttn, the encode and decode projections of ConvSelfAttn, the fc1 and fc2
+    head of the patch selector and the classifier. Convolutions, layer norms, patch
+    sampling with grid_sample and positional embedding interpolation stay in float,
+    so the transform params and patch locations are computed as in the float model.
+
+    The original model is left unchanged.
+    """
+    model = deepcopy(model).cpu().eval()
+    for module in model.modules():
+        if isinstance(module, MultiheadSelfAttn):
+            module.linear_in_proj()
+    return quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
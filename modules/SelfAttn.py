@@ -5,6 +5,7 @@
 from torch import nn
 import torch.nn.init as init
 from timm.models.layers import DropPath
+from modules.MultiheadSelfAttn import MultiheadSelfAttn
 
 class SelfAttn(nn.Module):
     def __init__(
@@ -21,7 +22,7 @@ class SelfAttn(nn.Module):
         self.norm = nn.LayerNorm(embed_dim)
         self.drop_path = DropPath(stochastic_depth) if stochastic_depth > 0.0 else nn.Identity()
 
-        self.attn = nn.MultiheadAttention(embed_dim, num_heads)
+        self.attn = MultiheadSelfAttn(embed_dim, num_heads)
         self.fc1 = nn.Linear(embed_dim, embed_dim * 4)
         self.activation = nn.GELU()
         self.fc2 = nn.Linear(embed_dim * 4, embed_dim)
@@ -32,10 +33,10 @@ class SelfAttn(nn.Module):
         init.xavier_uniform_(self.fc1.weight)
         init.xavier_uniform_(self.fc2.weight)
 
-    def forward(self, x, mask=None):
+    def forward(self, x, mask=None, need_weights=False):
         residual = x
         x = self.norm(x)
-        attn_output, attn_weights = self.attn(x, x, x, key_padding_mask=mask)
+        attn_output, attn_weights = self.attn(x, key_padding_mask=mask, need_weights=need_weights)
 
         x = x + attn_output
         x = self.norm(x)
@@ -0,0 +1,145 @@
+# © 2024 Alec Fessler
+# MIT License
+# See LICENSE file in the project root for full license information.
+
+import json
+import os
+import time
+import numpy as np
+import torch
+
+from modules.PatchSamplers import patch_grid
+
+class TiledImage:
+    """
+    An image stored on disk as a memory-mapped grid of square tiles, along with a small
+    thumbnail for the patch selector, for images too large to be loaded as one tensor.
+    Tiles are read only when a patch needs them, and the tiles, bytes and time spent
+    reading are counted in stats.
+
+    Tiles are read as stored, and sampled pixels are scaled to [0, 1] when stored as uint8.
+
+    The directory holds tiles.npy, (tiles_y, tiles_x, C, tile_size, tile_size) with the
+    last row and column of tiles zero padded, thumbnail.npy, (C, thumb_h, thumb_w) in
+    float32, and meta.json with the image height and width.
+    """
+    def __init__(self, path):
+        with open(os.path.join(path, 'meta.json')) as file:
+            meta = json.load(file)
+        self.path = path
+        self.height, self.width = meta['height'], meta['width']
+        self.tiles = np.load(os.path.join(path, 'tiles.npy'), mmap_mode='r')
+        self.tile_size = self.tiles.shape[-1]
+        self.channels = self.tiles.shape[2]
+        self.scale = 1 / 255 if self.tiles.dtype == np.uint8 else 1
+        self.thumbnail = torch.from_numpy(np.load(os.path.join(path, 'thumbnail.npy')))
+        self.reset_stats()
+
+    @property
+    def size(self):
+        return (self.height, self.width)
+
+    def reset_stats(self):
+        self.stats = {'tiles': 0, 'bytes': 0, 'read_seconds': 0.0}
+
+    def read_tile(self, tile_y, tile_x):
+        # the tile as stored, (channels, tile_size, tile_size)
+        start = time.perf_counter()
+        tile = np.array(self.tiles[tile_y, tile_x]) # copies the tile out of the memory map
+        self.stats['read_seconds'] += time.perf_counter() - start
+        self.stats['tiles'] += 1
+        self.stats['bytes'] += tile.nbytes
+        return torch.from_numpy(tile)
+
+    @staticmethod
+    def write(path, image, tile_size=256, thumbnail_size=64, dtype=np.uint8):
+        """
+        Writes image to path as a TiledImage, a tile at a time, so that image can be a
+        memory map itself or anything else sliced as image[:, y0:y1, x0:x1]. Values in
+        [0, 1] are stored as uint8 by default. The thumbnail averages the pixels falling
+        in each of its cells, also accumulated a tile at a time.
+
+        Shape:
+            - image: (channels, height, width)
+        """
+        channels, height, width = image.shape
+        thumb_h, thumb_w = (thumbnail_size, thumbnail_size) if isinstance(thumbnail_size, int) else thumbnail_size
+        tiles_y, tiles_x = -(-height // tile_size), -(-width // tile_size)
+
+        os.makedirs(path, exist_ok=True)
+        tiles = np.lib.format.open_memmap(
+            os.path.join(path, 'tiles.npy'), mode='w+', dtype=dtype,
+            shape=(tiles_y, tiles_x, channels, tile_size, tile_size)
+        )
+        sums = torch.zeros(channels, thumb_h * thumb_w, dtype=torch.float64)
+        counts = torch.zeros(thumb_h * thumb_w, dtype=torch.float64)
+        for tile_y in range(tiles_y):
+            for tile_x in range(tiles_x):
+                y0, x0 = tile_y * tile_size, tile_x * tile_size
+                tile = torch.as_tensor(np.asarray(image[:, y0:y0 + tile_size, x0:x0 + tile_size]), dtype=torch.float32)
+                h, w = tile.shape[1:]
+                stored = tile * 255 if dtype == np.uint8 else tile
+                tiles[tile_y, tile_x, :, :h, :w] = stored.round().clamp(0, 255).numpy() if dtype == np.uint8 else stored.numpy()
+
+                # thumbnail cell of every pixel of the tile
+                rows = (torch.arange(y0, y0 + h) * thumb_h // height).view(-1, 1)
+                cols = (torch.arange(x0, x0 + w) * thumb_w // width).view(1, -1)
+                cells = (rows * thumb_w + cols).flatten()
+                sums.index_add_(1, cells, tile.reshape(channels, -1).double())
+                counts.index_add_(0, cells, torch.ones(cells.size(0), dtype=torch.float64))
+        tiles.flush()
+        del tiles
+
+        thumbnail = (sums / counts).view(channels, thumb_h, thumb_w).float()
+        if dtype == np.uint8:
+            thumbnail = (thumbnail * 255).round() / 255 # as if pooled from the stored pixels
+        np.save(os.path.join(path, 'thumbnail.npy'), thumbnail.numpy())
+        with open(os.path.join(path, 'meta.json'), 'w') as file:
+            json.dump({'height': height, 'width': width}, file)
+        return TiledImage(path)
+
+def sample_tiled_patches(source, affine_transforms, base_grid):
+    """
+    Samples the patches of one TiledImage as grid_sample_patches samples them from the
+    whole image, reading only the tiles under the bilinear neighbours of the samples,
+    each once. Every sample gathers its four neighbours from the stacked tiles and
+    blends them, samples outside the image reading zeros as with zeros padding, so
+    the cost grows with the number of samples and tiles touched rather than with the
+    area the patches cover. Gradients flow to affine_transforms as with grid_sample.
+
+    Shape:
+        - affine_transforms: (num_patches, 2, 3)
+        - base_grid: (patch_size, patch_size, 3), see make_base_grid
+        - Output: (num_patches, channels, patch_size, patch_size)
+    """
+    n = affine_transforms.size(0)
+    p = base_grid.size(0)
+    h, w, t = source.height, source.width, source.tile_size
+    tiles_x = source.tiles.shape[1]
+
+    # sample positions in pixels, where pixel i spans [i, i + 1) and is sampled at i + 0.5
+    grid = patch_grid(affine_transforms.unsqueeze(0), base_grid).view(-1, 2)
+    u = ((grid[:, 0] + 1) * w - 1) / 2
+    v = ((grid[:, 1] + 1) * h - 1) / 2
+    x0, y0 = u.detach().floor(), v.detach().floor()
+    du, dv = u - x0, v - y0
+
+    # the four neighbours of each sample and their bilinear weights, (4, num_samples)
+    xs = torch.stack([x0, x0 + 1, x0, x0 + 1]).long()
+    ys = torch.stack([y0, y0, y0 + 1, y0 + 1]).long()
+    weights = torch.stack([(1 - du) * (1 - dv), du * (1 - dv), (1 - du) * dv, du * dv])
+    inside = (xs >= 0) & (xs < w) & (ys >= 0) & (ys < h)
+    xs, ys = xs.clamp(0, w - 1), ys.clamp(0, h - 1)
+
+    # neighbours outside the image read any tile, weighted by zero
+    tile_ids = (ys // t) * tiles_x + xs // t
+    needed, index = torch.unique(tile_ids[inside], return_inverse=True)
+    if needed.numel() == 0:
+        return grid.new_zeros(n, source.channels, p, p)
+    tile_index = torch.zeros_like(tile_ids)
+    tile_index[inside] = index
+
+    tiles = torch.stack([source.read_tile(i // tiles_x, i % tiles_x) for i in needed.tolist()]) # (K, C, T, T)
+    neighbours = tiles[tile_index, :, ys % t, xs % t].to(grid.dtype) * source.scale # (4, num_samples, C)
+    samples = (neighbours * (weights * inside).unsqueeze(-1)).sum(dim=0) # (num_samples, C)
+    return samples.view(n, p, p, -1).permute(0, 3, 1, 2).contiguous() # (N, C, P, P)
@@ -4,8 +4,10 @@
 
 import torch
 import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
 from modules.SelfAttn import SelfAttn
 from modules.PatchEmbed import PatchEmbed
+from modules.InterpolatePosEmbeds import interpolate_pos_embeds, upsample_pos_embeds, lookup_pos_embeds, interpolate_pos_embed_pyramid
 
 class ViT(nn.Module):
     def __init__(
@@ -17,7 +19,8 @@ class ViT(nn.Module):
         embed_dim=256,
         attn_heads=4,
         num_transformer_layers=6,
-        stochastic_depth=0.1
+        stochastic_depth=0.1,
+        pos_embed_levels=1
     ):
         super(ViT, self).__init__()
         self.num_patches = num_patches
@@ -27,7 +30,20 @@ class ViT(nn.Module):
             embed_dim=embed_dim
         )
 
-        self.pos_embeds = nn.Parameter(torch.randn((img_size // patch_size) ** 2, embed_dim))
+        # img_size is an int for square images or (height, width)
+        img_height, img_width = (img_size, img_size) if isinstance(img_size, int) else img_size
+        self.grid_shape = (img_height // patch_size, img_width // patch_size)
+        self.pos_embeds = nn.Parameter(torch.randn(self.grid_shape[0] * self.grid_shape[1], embed_dim))
+
+        # coarser grids for larger patches, each level halving the grid of the one before it
+        self.pos_embed_grid_shapes = [self.grid_shape] + [
+            (max(1, self.grid_shape[0] >> level), max(1, self.grid_shape[1] >> level))
+            for level in range(1, pos_embed_levels)
+        ]
+        self.pos_embed_pyramid = nn.ParameterList([
+            nn.Parameter(torch.randn(grid_height * grid_width, embed_dim))
+            for grid_height, grid_width in self.pos_embed_grid_shapes[1:]
+        ])
 
         self.cls_token = nn.Parameter(torch.randn(1, 1, embed_dim))
 
@@ -39,15 +55,91 @@ class ViT(nn.Module):
         self.norm = nn.LayerNorm(embed_dim)
         self.fc = nn.Linear(embed_dim, 10)
 
+        # recompute the activations of every k-th transformer layer in backward, 0 to keep them all
+        self.checkpoint_every = 0
+
+        # lattice resolution of the positional embedding lookup table used at inference, 0 to
+        # always interpolate. the table is built lazily along with a copy of its source grid
+        self.pos_embed_lut_resolution = 0
+        self.pos_embed_lut = None
+        self.pos_embed_lut_source = None
+
     def forward(self, x, interpolated_pos_embeds=None):
         x = self.patch_embed(x)
-        x += interpolated_pos_embeds if interpolated_pos_embeds is not None else self.pos_embeds
-        cls_tokens = self.cls_token.expand(x.size(0), -1, -1)
-        x = torch.cat((cls_tokens, x), dim=1)
-        x = x.permute(1, 0, 2).contiguous()
-        for layer in self.transformer_layers:
-            x, _ = layer(x)
-        x = x[0]
+        return self.forward_tokens(x, interpolated_pos_embeds)
+
+    def lookup_pos_embeds(self, coords, levels=None):
+        """
+        Positional embeddings at normalized patch coordinates, see interpolate_pos_embeds.
+
+        With pos_embed_levels above 1 and the patch levels given, the embeddings are
+        interpolated across the grid pyramid as well, see interpolate_pos_embed_pyramid.
+        The lookup table below only covers single grids.
+
+        At inference (eval mode without autograd) with pos_embed_lut_resolution set, the
+        grid is upsampled once to a lattice of that resolution and the embeddings are
+        looked up at the nearest lattice point instead. The table is rebuilt whenever
+        pos_embeds differs from the grid it was built from, so it follows optimizer steps,
+        state dict loads, moves and casts. The grid is compared by value rather than by
+        version counter, which fused optimizer steps leave unchanged.
+
+        Shape:
+            - coords: (*, 2)
+            - levels: (*), optional
+            - Output: (*, embed_dim)
+        """
+        if levels is not None and len(self.pos_embed_pyramid):
+            pyramid = [self.pos_embeds, *self.pos_embed_pyramid]
+            return interpolate_pos_embed_pyramid(pyramid, self.pos_embed_grid_shapes, coords, levels)
+
+        if self.training or torch.is_grad_enabled() or not self.pos_embed_lut_resolution:
+            return interpolate_pos_embeds(self.pos_embeds, coords, self.grid_shape)
+
+        resolution, source = self.pos_embed_lut_resolution, self.pos_embed_lut_source
+        if (
+            source is None
+            or self.pos_embed_lut.size(0) != resolution * resolution
+            or source.dtype != self.pos_embeds.dtype
+            or source.device != self.pos_embeds.device
+            or not torch.equal(source, self.pos_embeds)
+        ):
+            self.pos_embed_lut = upsample_pos_embeds(self.pos_embeds, resolution, self.grid_shape)
+            self.pos_embed_lut_source = self.pos_embeds.detach().clone()
+        return lookup_pos_embeds(self.pos_embed_lut, coords.to(self.pos_embed_lut.dtype))
+
+    def build_tokens(self, x, interpolated_pos_embeds=None):
+        """
+        Adds the position embeddings to the patch tokens and prepends the CLS token,
+        in the batch-first layout used all the way to the classifier head.
+
+        Shape:
+            - x: (batch_size, num_patches, embed_dim)
+            - interpolated_pos_embeds: (batch_size, num_patches, embed_dim)
+            - Output: (batch_size, num_patches + 1, embed_dim)
+        """
+        b, n, e = x.size()
+        pos_embeds = interpolated_pos_embeds if interpolated_pos_embeds is not None else self.pos_embeds
+
+        if torch.is_grad_enabled() or torch.jit.is_tracing() or torch.compiler.is_compiling():
+            # the backward of a concatenation only splits the gradient, whereas every write into
+            # a slice of a buffer would clone it. traced and compiled graphs cannot take the
+            # out= write, and compiled graphs allocate the concatenation in place anyway
+            return torch.cat((self.cls_token.expand(b, -1, -1), x + pos_embeds), dim=1)
+
+        # without autograd the tokens are written straight into one preallocated buffer
+        tokens = x.new_empty(b, n + 1, e, dtype=torch.promote_types(x.dtype, pos_embeds.dtype))
+        tokens[:, :1] = self.cls_token
+        torch.add(x, pos_embeds, out=tokens[:, 1:])
+        return tokens
+
+    def forward_tokens(self, x, interpolated_pos_embeds=None):
+        x = self.build_tokens(x, interpolated_pos_embeds)
+        for i, layer in enumerate(self.transformer_layers):
+            if self.checkpoint_every and i % self.checkpoint_every == 0 and torch.is_grad_enabled():
+                x, _ = checkpoint(layer, x, use_reentrant=False)
+            else:
+                x, _ = layer(x)
+        x = x[:, 0]
         x = self.norm(x)
         x = self.fc(x)
         return x
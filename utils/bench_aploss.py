@@ -0,0 +1,216 @@
+import os
+os.environ.setdefault('TQDM_DISABLE', '1')
+
+import torch
+import torch.nn as nn
+from torch.amp.grad_scaler import GradScaler
+from torch.optim.lr_scheduler import LambdaLR
+import apvit_e2e
+from apvit_aploss import APViT, build_optimizer, train
+from modules.PerturbTransformParams import perturb_transform_params, perturb_transform_param_sets
+from modules.ValueScheduler import ValueScheduler
+from utils.benchmark import time_fn, peak_memory
+
+def build_model(embed_mode, device, stochastic_depth=0.15):
+    return APViT(
+        num_patches=16,
+        patch_size=8,
+        hidden_channels=24,
+        embed_dim=256,
+        num_transformer_layers=8,
+        stochastic_depth=stochastic_depth,
+        scaling=None,
+        max_scale=0.4,
+        rotating=False,
+        embed_mode=embed_mode
+    ).to(device)
+
+def looped_patch_sets(model, x, transform_params, perturbed_patch_sets):
+    """
+    The original loop, which perturbs a clone of the params and samples each set
+    separately before concatenating them.
+    """
+    dense_embeds = model.vit.patch_embed.dense_embed(x) if model.embed_mode == 'dense' else None
+    tokens, affine_transforms = model.embed_patches(x, transform_params, dense_embeds)
+    tokens, affine_transforms = [tokens], [affine_transforms]
+    for _ in range(perturbed_patch_sets):
+        params = perturb_transform_params(transform_params.clone().detach())
+        p_tokens, transforms = model.embed_patches(x, params, dense_embeds)
+        tokens.append(p_tokens)
+        affine_transforms.append(transforms)
+    return torch.cat(tokens, dim=0), torch.cat(affine_transforms, dim=0)
+
+def batched_patch_sets(model, x, transform_params, perturbed_patch_sets):
+    perturbed_params = perturb_transform_param_sets(transform_params.detach(), perturbed_patch_sets)
+    params_tensor = torch.cat([transform_params.unsqueeze(0), perturbed_params], dim=0)
+    return model.embed_patches(x, params_tensor)
+
+def train_steps(model, batches, perturbed_patch_sets, no_grad_scoring=True, ap_loss_weight=0.5, lr=0.0, single_backward=False):
+    """
+    Runs apvit_aploss.train over the given (images, labels) batches with a plain fp32
+    scaler and a fixed AP loss weight. With the default lr of 0 the parameters are
+    left unchanged and the gradients of the last step are kept on the model.
+    """
+    device = next(model.parameters()).device
+    optimizers = [build_optimizer(module, lr, 0.00015, device) for module in [model.patch_selector, model.vit]]
+    schedulers = [LambdaLR(optimizer, lr_lambda=lambda epoch: 1.0) for optimizer in optimizers]
+    ap_loss_weight_sched = ValueScheduler(start=ap_loss_weight, end=ap_loss_weight, steps=1)
+
+    return train(
+        model,
+        batches,
+        (nn.MSELoss(), nn.CrossEntropyLoss(reduction='none')),
+        optimizers,
+        schedulers,
+        schedulers,
+        0,
+        0,
+        1,
+        GradScaler(enabled=False),
+        lambda images, labels: (images, labels),
+        ap_loss_weight_sched,
+        perturbed_patch_sets,
+        0.01,
+        0.05,
+        device,
+        no_grad_scoring,
+        single_backward
+    )
+
+def e2e_train_steps(model, batches):
+    """
+    Runs the plain apvit_e2e training loop over the given batches with lr 0.
+    """
+    device = next(model.parameters()).device
+    optimizer = torch.optim.AdamW(model.parameters(), lr=0.0)
+    scheduler = LambdaLR(optimizer, lr_lambda=lambda epoch: 1.0)
+    return apvit_e2e.train(
+        model,
+        batches,
+        nn.CrossEntropyLoss(),
+        optimizer,
+        scheduler,
+        scheduler,
+        0,
+        0,
+        1,
+        GradScaler(enabled=False),
+        lambda images, labels: (images, labels),
+        device
+    )
+
+def check_gradient_equivalence(embed_mode, device, mode):
+    """
+    Runs one training step with the train_steps keyword mode set to False and then
+    True and checks that the accumulated gradients agree. Stochastic depth is disabled so
+    that both runs see the same network. train runs under autocast, so the gradients
+    are compared by relative norm to allow for reduced-precision rounding.
+    """
+    grads = []
+    for enabled in [False, True]:
+        torch.manual_seed(42)
+        model = build_model(embed_mode, device, stochastic_depth=0.0)
+        batches = [(torch.randn(8, 3, 32, 32, device=device), torch.randint(0, 10, (8,), device=device))]
+        train_steps(model, batches, 3, **{mode: enabled})
+        grads.append(torch.cat([p.grad.flatten() for p in model.parameters() if p.grad is not None]))
+
+    error = (grads[1] - grads[0]).norm() / grads[0].norm()
+    assert grads[0].shape == grads[1].shape and error < 1e-2, f'{embed_mode}: {mode} gradients differ ({error:.2e})'
+    print(f"{embed_mode}: {mode} gives the same gradients")
+
+def main():
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    batch_size = 64
+
+    for embed_mode in ['strip', 'fused', 'dense']:
+        torch.manual_seed(42)
+        model = build_model(embed_mode, device)
+        x = torch.randn(batch_size, 3, 32, 32, device=device)
+        with torch.no_grad():
+            transform_params = model.patch_selector(x)
+        transform_params.requires_grad_()
+
+        # embedding stacked sets in one call must match embedding each set on its own
+        params_tensor = torch.cat([transform_params.unsqueeze(0), perturb_transform_param_sets(transform_params.detach(), 3)])
+        tokens, affine_transforms = model.embed_patches(x, params_tensor)
+        expected = [model.embed_patches(x, params) for params in params_tensor]
+        assert torch.allclose(tokens, torch.cat([t for t, _ in expected]), atol=1e-5), f'{embed_mode}: tokens differ'
+        assert torch.allclose(affine_transforms, torch.cat([a for _, a in expected]), atol=1e-6), f'{embed_mode}: affine transforms differ'
+        print(f"{embed_mode}: batched patch sets match the per-set loop")
+
+        print(f"\nPerturbing and embedding K+1 patch sets, {embed_mode} embedding, batch {batch_size}")
+        print(f"{'K':>3} | {'looped fwd ms':>13} | {'batched fwd ms':>14} | {'looped fwd+bwd ms':>17} | {'batched fwd+bwd ms':>18}")
+        for perturbed_patch_sets in [1, 3, 8]:
+            def looped():
+                return looped_patch_sets(model, x, transform_params, perturbed_patch_sets)[0]
+
+            def batched():
+                return batched_patch_sets(model, x, transform_params, perturbed_patch_sets)[0]
+
+            print(
+                f"{perturbed_patch_sets:>3} | {time_fn(looped):>13.2f} | {time_fn(batched):>14.2f} | "
+                f"{time_fn(lambda: looped().sum().backward()):>17.2f} | "
+                f"{time_fn(lambda: batched().sum().backward()):>18.2f}"
+            )
+        print()
+
+    for embed_mode in ['strip', 'fused', 'dense']:
+        check_gradient_equivalence(embed_mode, device, 'no_grad_scoring')
+    check_gradient_equivalence('strip', device, 'single_backward')
+
+    batch_size = 64
+    steps = 3
+    print(f"\nAP-loss training step, strip embedding, batch {batch_size}")
+    print(f"{'K':>3} | {'joint peak MB':>13} | {'no-grad peak MB':>15} | {'joint step ms':>13} | {'no-grad step ms':>15}")
+    for perturbed_patch_sets in [1, 3, 8]:
+        torch.manual_seed(42)
+        model = build_model('strip', device)
+        batches = [
+            (torch.randn(batch_size, 3, 32, 32, device=device), torch.randint(0, 10, (batch_size,), device=device))
+            for _ in range(steps)
+        ]
+
+        def step(no_grad_scoring):
+            return lambda: train_steps(model, batches, perturbed_patch_sets, no_grad_scoring=no_grad_scoring)
+
+        print(
+            f"{perturbed_patch_sets:>3} | {peak_memory(step(False)):>13.1f} | {peak_memory(step(True)):>15.1f} | "
+            f"{time_fn(step(False), warmup=1, iters=2) / steps:>13.1f} | {time_fn(step(True), warmup=1, iters=2) / steps:>15.1f}"
+        )
+
+    print(f"\nDual vs single backward training step, strip embedding, no-grad scoring, batch {batch_size}")
+    print(f"{'K':>3} | {'dual peak MB':>12} | {'single peak MB':>14} | {'dual step ms':>12} | {'single step ms':>14}")
+    for perturbed_patch_sets in [1, 3, 8]:
+        torch.manual_seed(42)
+        model = build_model('strip', device)
+
+        def step(single_backward):
+            return lambda: train_steps(model, batches, perturbed_patch_sets, single_backward=single_backward)
+
+        print(
+            f"{perturbed_patch_sets:>3} | {peak_memory(step(False)):>12.1f} | {peak_memory(step(True)):>14.1f} | "
+            f"{time_fn(step(False), warmup=1, iters=2) / steps:>12.1f} | {time_fn(step(True), warmup=1, iters=2) / steps:>14.1f}"
+        )
+
+    # with a zero AP loss weight the perturbation search is skipped, leaving the ViT forward
+    # of the original set and a single backward pass of the summed AP and ViT losses
+    print(f"\nWarm-up training step with ap_loss_weight 0, batch {batch_size}")
+    print(f"{'loop':>24} | {'step ms':>8}")
+    torch.manual_seed(42)
+    model = build_model('strip', device)
+    e2e_model = apvit_e2e.APViT(
+        num_patches=16,
+        embed_dim=256,
+        num_transformer_layers=8,
+        stochastic_depth=0.15,
+        hidden_channels=24
+    ).to(device)
+    for name, step in [
+        ('aploss, K=3, weight 0.5', lambda: train_steps(model, batches, 3, True, ap_loss_weight=0.5)),
+        ('aploss, K=3, weight 0', lambda: train_steps(model, batches, 3, True, ap_loss_weight=0.0)),
+        ('e2e', lambda: e2e_train_steps(e2e_model, batches))
+    ]:
+        print(f"{name:>24} | {time_fn(step, warmup=1, iters=3) / steps:>8.1f}")
+
+if __name__ == "__main__":
+    main()
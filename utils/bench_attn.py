@@ -0,0 +1,75 @@
+import torch
+import torch.nn as nn
+from modules.MultiheadSelfAttn import MultiheadSelfAttn
+from modules.SelfAttn import SelfAttn
+from utils.benchmark import time_fn
+
+def check_equivalence(attn, reference, x, mask, name):
+    """
+    Compares outputs, averaged attention weights and input gradients against
+    nn.MultiheadAttention with the same state dict.
+    """
+    x = x.detach().requires_grad_()
+    output, weights = attn(x, key_padding_mask=mask, need_weights=True)
+    fast_output, no_weights = attn(x, key_padding_mask=mask)
+    expected_output, expected_weights = reference(x, x, x, key_padding_mask=mask)
+
+    grad_weights = torch.randn_like(output)
+    grad, = torch.autograd.grad((fast_output * grad_weights).sum(), x)
+    expected_grad, = torch.autograd.grad((expected_output * grad_weights).sum(), x)
+
+    assert no_weights is None, f'{name}: weights returned without need_weights'
+    assert torch.allclose(output, expected_output, atol=1e-5), f'{name}: outputs differ'
+    assert torch.allclose(fast_output, expected_output, atol=1e-5), f'{name}: SDPA outputs differ'
+    assert torch.allclose(weights, expected_weights, atol=1e-6), f'{name}: attention weights differ'
+    assert torch.allclose(grad, expected_grad, atol=1e-5), f'{name}: gradients differ'
+    print(f"{name}: outputs, weights and gradients match nn.MultiheadAttention")
+
+def main():
+    torch.manual_seed(42)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    embed_dim, num_heads = 256, 4
+    reference = nn.MultiheadAttention(embed_dim, num_heads, batch_first=True).to(device)
+    attn = MultiheadSelfAttn(embed_dim, num_heads).to(device)
+    attn.load_state_dict(reference.state_dict())
+
+    x = torch.randn(8, 17, embed_dim, device=device)
+    mask = torch.rand(8, 17, device=device) < 0.2
+    mask[:, 0] = False
+    check_equivalence(attn, reference, x, None, "no mask")
+    check_equivalence(attn, reference, x, mask, "key padding mask")
+
+    print(f"\nSelfAttn layer forward+backward, embed_dim {embed_dim}, {num_heads} heads")
+    print(f"{'seq len':>7} | {'batch':>5} | {'MHA weights ms':>14} | {'SDPA ms':>7} | {'MHA fwd ms':>10} | {'SDPA fwd ms':>11}")
+    for seq_len, batch_size in [(17, 256), (17, 1024), (65, 256)]:
+        torch.manual_seed(42)
+        layer = SelfAttn(embed_dim, num_heads).to(device)
+        reference_layer = SelfAttn(embed_dim, num_heads).to(device)
+        reference_layer.attn = nn.MultiheadAttention(embed_dim, num_heads, batch_first=True).to(device)
+        reference_layer.load_state_dict(layer.state_dict())
+        x = torch.randn(batch_size, seq_len, embed_dim, device=device)
+
+        def reference_forward():
+            # the original layer, which always returns averaged attention weights
+            residual = x
+            h = reference_layer.norm(x)
+            attn_output, _ = reference_layer.attn(h, h, h)
+            h = reference_layer.norm(h + attn_output)
+            return residual + reference_layer.fc2(reference_layer.activation(reference_layer.fc1(h)))
+
+        def forward():
+            return layer(x)[0]
+
+        def no_grad(fn):
+            with torch.no_grad():
+                fn()
+
+        print(
+            f"{seq_len:>7} | {batch_size:>5} | {time_fn(lambda: reference_forward().sum().backward()):>14.2f} | "
+            f"{time_fn(lambda: forward().sum().backward()):>7.2f} | "
+            f"{time_fn(lambda: no_grad(reference_forward)):>10.2f} | {time_fn(lambda: no_grad(forward)):>11.2f}"
+        )
+
+if __name__ == "__main__":
+    main()
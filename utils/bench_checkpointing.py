@@ -0,0 +1,72 @@
+import torch
+import torch.nn as nn
+from apvit_e2e import APViT, load_config
+from modules.ActivationCheckpointing import apply_activation_checkpointing
+from utils.benchmark import time_fn, peak_memory
+
+POLICIES = ['none', 'selector', 2, 'all']
+
+def build_model(config, device):
+    torch.manual_seed(42)
+    return APViT(
+        num_patches=16,
+        embed_dim=config.get("attn_embed_dim", 256),
+        num_transformer_layers=config.get("num_transformer_layers", 8),
+        stochastic_depth=config.get("stochastic_depth", 0.15),
+        hidden_channels=config.get("hidden_channels", 24)
+    ).to(device).train()
+
+def train_step(model, images, labels):
+    loss = nn.functional.cross_entropy(model(images), labels)
+    loss.backward()
+    return loss
+
+def check_gradients(config, device):
+    """
+    Checkpointed layers are recomputed with the same random state, so the gradients
+    of every policy must match those of keeping all activations.
+    """
+    images = torch.randn(8, 3, 32, 32, device=device)
+    labels = torch.randint(0, 10, (8,), device=device)
+    grads = {}
+    for policy in POLICIES:
+        model = build_model(config, device)
+        apply_activation_checkpointing(model, policy)
+        torch.manual_seed(0)
+        train_step(model, images, labels)
+        grads[policy] = torch.cat([p.grad.flatten() for p in model.parameters() if p.grad is not None])
+
+    for policy in POLICIES[1:]:
+        assert torch.allclose(grads[policy], grads['none'], atol=1e-6), f'{policy}: gradients differ'
+    print("every checkpointing policy gives the same gradients")
+
+def main():
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    config = load_config("hparams_config.yaml")
+    check_gradients(config, device)
+
+    # peak memory grows linearly with the batch, so two sizes give the per-image cost
+    # and the largest batch that fits in the budget
+    budget_mb = 4096
+    small_batch, large_batch = 32, 64
+    print(f"\nActivation checkpointing, apvit_e2e model from hparams_config.yaml, budget {budget_mb} MB")
+    print(f"{'policy':>8} | {'peak MB @64':>11} | {'MB / image':>10} | {'max batch':>9} | {'step ms @64':>11}")
+    for policy in POLICIES:
+        model = build_model(config, device)
+        apply_activation_checkpointing(model, policy)
+
+        peaks = {}
+        for batch_size in [small_batch, large_batch]:
+            images = torch.randn(batch_size, 3, 32, 32, device=device)
+            labels = torch.randint(0, 10, (batch_size,), device=device)
+            peaks[batch_size] = peak_memory(lambda: train_step(model, images, labels))
+            model.zero_grad(set_to_none=True)
+
+        per_image = (peaks[large_batch] - peaks[small_batch]) / (large_batch - small_batch)
+        max_batch = int(large_batch + (budget_mb - peaks[large_batch]) / per_image)
+        step_ms = time_fn(lambda: train_step(model, images, labels), warmup=1, iters=3)
+
+        print(f"{str(policy):>8} | {peaks[large_batch]:>11.1f} | {per_image:>10.2f} | {max_batch:>9} | {step_ms:>11.1f}")
+
+if __name__ == "__main__":
+    main()
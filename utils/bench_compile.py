@@ -0,0 +1,62 @@
+import time
+import copy
+import torch
+import torch.nn as nn
+import torch._dynamo as dynamo
+from apvit_e2e import APViT
+from utils.benchmark import time_fn
+
+def build_model(embed_mode, device):
+    torch.manual_seed(42)
+    return APViT(
+        num_patches=16,
+        embed_dim=256,
+        num_transformer_layers=8,
+        stochastic_depth=0.15,
+        hidden_channels=24,
+        embed_mode=embed_mode
+    ).to(device)
+
+def main():
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    eval_batch, train_batch = 256, 64
+    x = torch.randn(eval_batch, 3, 32, 32, device=device)
+    labels = torch.randint(0, 10, (train_batch,), device=device)
+
+    print(f"Compiled vs eager APViT, eval batch {eval_batch}, train batch {train_batch}")
+    print(f"{'embed':>5} | {'compile s':>9} | {'eager eval img/s':>16} | {'compiled eval img/s':>19} | {'eager train img/s':>17} | {'compiled train img/s':>20}")
+    for embed_mode in ['strip', 'fused', 'dense']:
+        model = build_model(embed_mode, device)
+        compiled = copy.deepcopy(model)
+        compiled.compile()
+
+        def evaluate(m):
+            m.eval()
+            with torch.no_grad():
+                return m(x)
+
+        def train_step(m):
+            m.train()
+            nn.functional.cross_entropy(m(x[:train_batch]), labels).backward()
+
+        # the first calls of each mode compile the eval and train graphs
+        dynamo.reset()
+        start = time.perf_counter()
+        compiled_output = evaluate(compiled)
+        train_step(compiled)
+        compile_s = time.perf_counter() - start
+
+        assert torch.allclose(compiled_output, evaluate(model), atol=1e-4), f'{embed_mode}: compiled outputs differ'
+
+        eager_eval = eval_batch / time_fn(lambda: evaluate(model), iters=5) * 1000
+        compiled_eval = eval_batch / time_fn(lambda: evaluate(compiled), iters=5) * 1000
+        eager_train = train_batch / time_fn(lambda: train_step(model), iters=5) * 1000
+        compiled_train = train_batch / time_fn(lambda: train_step(compiled), iters=5) * 1000
+
+        print(
+            f"{embed_mode:>5} | {compile_s:>9.1f} | {eager_eval:>16.0f} | {compiled_eval:>19.0f} | "
+            f"{eager_train:>17.0f} | {compiled_train:>20.0f}"
+        )
+
+if __name__ == "__main__":
+    main()
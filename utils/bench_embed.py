@@ -0,0 +1,117 @@
+import torch
+from modules.PatchEmbed import PatchEmbed
+from modules.PatchSamplers import sample_and_embed
+from utils.bench_sampling import build_patch_selector
+from utils.benchmark import time_fn
+
+def sampled_embeds(patch_selector, patch_embed, x, transform_params):
+    """
+    Embeds each sampled patch as its own P x P image.
+    """
+    patches, _ = patch_selector.sample_patches(x, transform_params)
+    b, n, c, p, _ = patches.size()
+    return patch_embed(patches.view(b * n, c, p, p)).view(b, n, -1)
+
+def fused_embeds(patch_selector, patch_embed, x, transform_params):
+    affine_transforms = patch_selector.compute_affine_transforms(transform_params, x.size(2), x.size(3))
+    return sample_and_embed(
+        x,
+        affine_transforms,
+        patch_embed.proj.weight,
+        patch_embed.proj.bias,
+        base_grid=patch_selector.base_grid,
+        translation_only=patch_selector.translation_only
+    )
+
+def dense_embeds(patch_selector, patch_embed, x, transform_params):
+    return patch_embed.gather_embeds(patch_embed.dense_embed(x), transform_params[..., :2])
+
+def check_equivalence(embed_fn, patch_selector, patch_embed, x, name):
+    """
+    Compares tokens and gradients w.r.t. the translation params and the projection
+    weights against embedding each sampled patch separately.
+    """
+    transform_params = patch_selector(x).detach().requires_grad_()
+    embeds = embed_fn(patch_selector, patch_embed, x, transform_params)
+    expected = sampled_embeds(patch_selector, patch_embed, x, transform_params)
+
+    weights = torch.randn_like(embeds)
+    grads = torch.autograd.grad((embeds * weights).sum(), [transform_params, patch_embed.proj.weight])
+    expected_grads = torch.autograd.grad((expected * weights).sum(), [transform_params, patch_embed.proj.weight])
+
+    assert torch.allclose(embeds, expected, atol=1e-4), f'{name}: tokens differ'
+    assert torch.allclose(grads[0][..., :2], expected_grads[0][..., :2], rtol=1e-4, atol=1e-2), f'{name}: param gradients differ'
+    assert torch.allclose(grads[1], expected_grads[1], rtol=1e-4, atol=1e-3), f'{name}: weight gradients differ'
+    print(f"{name}: tokens and gradients match sampled patches")
+
+def main():
+    torch.manual_seed(42)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    patch_embed = PatchEmbed(patch_size=8, in_channels=3, embed_dim=256).to(device)
+    for scaling, rotating in [(None, False), ('anisotropic', True)]:
+        patch_selector = build_patch_selector(scaling, rotating, device)
+        x = torch.randn(8, 3, 32, 32, device=device)
+        check_equivalence(fused_embeds, patch_selector, patch_embed, x, f"fused (scaling={scaling}, rotating={rotating})")
+    patch_selector = build_patch_selector(None, False, device)
+    check_equivalence(dense_embeds, patch_selector, patch_embed, x, "dense gather")
+
+    print("\nStrip vs fused sample-and-embed")
+    print(f"{'batch':>6} | {'strip fwd ms':>12} | {'fused fwd ms':>12} | {'strip fwd+bwd ms':>16} | {'fused fwd+bwd ms':>16}")
+    for batch_size in [1, 32, 256, 1024]:
+        x = torch.randn(batch_size, 3, 32, 32, device=device)
+        with torch.no_grad():
+            transform_params = patch_selector(x)
+        transform_params.requires_grad_()
+
+        def strip():
+            patches, _ = patch_selector.sample_patches(x, transform_params)
+            b, n, c, p, _ = patches.size()
+            return patch_embed(patches.view(b, c, p, p * n))
+
+        def fused():
+            return fused_embeds(patch_selector, patch_embed, x, transform_params)
+
+        def forward(embed_fn):
+            with torch.no_grad():
+                embed_fn()
+
+        print(
+            f"{batch_size:>6} | {time_fn(lambda: forward(strip)):>12.2f} | {time_fn(lambda: forward(fused)):>12.2f} | "
+            f"{time_fn(lambda: strip().sum().backward()):>16.2f} | {time_fn(lambda: fused().sum().backward()):>16.2f}"
+        )
+
+    batch_size = 64
+    x = torch.randn(batch_size, 3, 32, 32, device=device)
+    with torch.no_grad():
+        transform_params = patch_selector(x)
+
+    print(f"\nEmbedding K+1 patch sets, batch {batch_size}")
+    print(f"{'K':>3} | {'sample+embed fwd ms':>19} | {'dense+gather fwd ms':>19} | {'sample+embed fwd+bwd ms':>23} | {'dense+gather fwd+bwd ms':>23}")
+    for perturbed_patch_sets in [0, 1, 3, 8, 32]:
+        param_sets = [transform_params] + [
+            (transform_params + 0.05 * torch.randn_like(transform_params)).clamp(-1, 1)
+            for _ in range(perturbed_patch_sets)
+        ]
+
+        def sample_and_embed():
+            return torch.cat([sampled_embeds(patch_selector, patch_embed, x, params) for params in param_sets])
+
+        def dense_and_gather():
+            # gather all sets in one call so the dense map is only traversed once in backward
+            coords = torch.cat([params[..., :2] for params in param_sets], dim=1) # (B, (K+1)*N, 2)
+            return patch_embed.gather_embeds(patch_embed.dense_embed(x), coords)
+
+        def forward(embed_fn):
+            with torch.no_grad():
+                embed_fn()
+
+        print(
+            f"{perturbed_patch_sets:>3} | {time_fn(lambda: forward(sample_and_embed)):>19.2f} | "
+            f"{time_fn(lambda: forward(dense_and_gather)):>19.2f} | "
+            f"{time_fn(lambda: sample_and_embed().sum().backward()):>23.2f} | "
+            f"{time_fn(lambda: dense_and_gather().sum().backward()):>23.2f}"
+        )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+import os
+import tempfile
+import torch
+from apvit_e2e import APViT, load_config
+from modules.Export import export_program, export_torchscript, export_onnx
+from utils.benchmark import time_fn
+
+# (name, APViT keyword arguments) of the patch selector and embedding configurations
+CONFIGS = [
+    ('strip', dict(embed_mode='strip')),
+    ('fused', dict(embed_mode='fused')),
+    ('dense', dict(embed_mode='dense')),
+    ('strip, anisotropic, rotating', dict(embed_mode='strip', scaling='anisotropic', max_scale=0.4, rotating=True))
+]
+
+def build_model(config, kwargs):
+    torch.manual_seed(42)
+    model = APViT(
+        num_patches=16,
+        embed_dim=config.get("attn_embed_dim", 256),
+        num_transformer_layers=config.get("num_transformer_layers", 8),
+        hidden_channels=config.get("hidden_channels", 24),
+        **kwargs
+    )
+    if os.path.exists("models/apvit_16.pth") and kwargs.get('embed_mode') == config.get("embed_mode", "strip") and 'scaling' not in kwargs:
+        model.load_state_dict(torch.load("models/apvit_16.pth", map_location='cpu'))
+    return model.eval()
+
+def onnx_session(model, example_input, path):
+    """
+    Exports model to ONNX and returns a function running it with onnxruntime, or None
+    if the onnx, onnxscript or onnxruntime packages are not installed.
+    """
+    try:
+        import onnxruntime
+        export_onnx(model, example_input, path)
+    except ImportError:
+        return None
+    session = onnxruntime.InferenceSession(path, providers=['CPUExecutionProvider'])
+    return lambda x: torch.from_numpy(session.run(None, {'x': x.numpy()})[0])
+
+def export_all(model, example_input, directory):
+    """
+    Exports model in every format, saving and loading each one back so that the
+    runtimes measured are those of the shipped files.
+    """
+    program_path = os.path.join(directory, 'apvit.pt2')
+    torch.export.save(export_program(model, example_input), program_path)
+    program = torch.export.load(program_path).module()
+
+    torchscript_path = os.path.join(directory, 'apvit.ts')
+    torch.jit.save(export_torchscript(model, example_input), torchscript_path)
+    torchscript = torch.jit.load(torchscript_path)
+
+    runtimes = {'eager': model, 'torch.export': program, 'torchscript': torchscript}
+    onnx = onnx_session(model, example_input, os.path.join(directory, 'apvit.onnx'))
+    if onnx is not None:
+        runtimes['onnxruntime'] = onnx
+    return runtimes
+
+def check_parity(name, runtimes):
+    """
+    Compares every exported runtime against eager at batch sizes other than that of
+    the example input, checking that the batch dimension stays dynamic.
+    """
+    for batch_size in [1, 7, 64]:
+        x = torch.randn(batch_size, 3, 32, 32)
+        with torch.no_grad():
+            expected = runtimes['eager'](x)
+            for runtime, fn in runtimes.items():
+                error = (fn(x) - expected).abs().max().item()
+                assert error < 1e-4, f'{name}, {runtime}, batch {batch_size}: outputs differ by {error:.2e}'
+    print(f"{name}: {', '.join(list(runtimes)[1:])} match eager at batch 1, 7 and 64")
+
+def main():
+    config = load_config("hparams_config.yaml")
+    example_input = torch.randn(2, 3, 32, 32)
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for name, kwargs in CONFIGS:
+            model = build_model(config, kwargs)
+            runtimes = export_all(model, example_input, directory)
+            check_parity(name, runtimes)
+
+            timings = {}
+            for runtime, fn in runtimes.items():
+                for batch_size in [1, 256]:
+                    x = torch.randn(batch_size, 3, 32, 32)
+                    with torch.no_grad():
+                        timings[runtime, batch_size] = time_fn(lambda: fn(x))
+            results.append((name, timings))
+
+    if 'onnxruntime' not in runtimes:
+        print("onnx: skipped, the onnx, onnxscript and onnxruntime packages are not installed")
+
+    print(f"\nCPU latency of the exported APViT, {torch.get_num_threads()} threads")
+    print(f"{'config':>28} | {'runtime':>12} | {'ms @1':>7} | {'img/s @256':>10}")
+    for name, timings in results:
+        for runtime in runtimes:
+            print(f"{name:>28} | {runtime:>12} | {timings[runtime, 1]:>7.2f} | {256 / timings[runtime, 256] * 1000:>10.0f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+import torch
+import torch.nn.functional as F
+import torchvision
+from torch.utils.data import DataLoader
+from torch.utils.flop_counter import FlopCounterMode
+from timm.data import create_transform
+from utils.benchmark import time_fn, evaluate, synthetic_objects, num_steps, build_selector_model, train_steps, localized_loss, patches_on_object
+
+IMG_SIZE = 256
+OBJECT_SIZE = 32
+
+# (name, APViT keyword arguments) of the patch selectors compared at any image size
+SELECTORS = [
+    ('full resolution', dict()),
+    ('pooled 32x32 features', dict(selector_feature_size=32)),
+    ('thumbnail 32x32', dict(selector_thumbnail_size=32)),
+    ('hierarchical, 1 region', dict(selector_regions=1, selector_region_scale=0.25)),
+    ('hierarchical, 2 regions', dict(selector_regions=2, selector_region_scale=0.25)),
+    ('hierarchical, 4 regions', dict(selector_regions=4, selector_region_scale=0.25)),
+    ('hierarchical, 8 regions', dict(selector_regions=8, selector_region_scale=0.25)),
+]
+
+def selector_flops(img_size, kwargs):
+    """
+    Multiply-accumulates of the patch selector per image, counted on the meta device so
+    that selectors too large to build at an image size can still be counted. Only the
+    matrix products and convolutions are counted, not the resizing or crop sampling.
+    """
+    with torch.device('meta'):
+        model = build_selector_model(img_size=img_size, **kwargs).eval()
+        counter = FlopCounterMode(display=False)
+        with counter, torch.no_grad():
+            model.patch_selector(torch.empty(1, 3, img_size, img_size))
+    return counter.get_total_flops() / 2
+
+def check_region_centers():
+    """
+    Checks that every patch is centered within its region, for translated and for
+    scaled and rotated patches, with the fine stage's biases spread so that patches
+    reach the borders of their regions.
+    """
+    x = torch.randn(8, 3, IMG_SIZE, IMG_SIZE)
+    for name, kwargs in [
+        ('translated', dict()),
+        ('scaled and rotated', dict(scaling='isotropic', max_scale=0.3, rotating=True))
+    ]:
+        selector = build_selector_model(img_size=IMG_SIZE, selector_regions=4, selector_region_scale=0.25, **kwargs).patch_selector
+        torch.nn.init.uniform_(selector.fine.fc2.bias, -3, 3)
+        with torch.no_grad():
+            region_params, _ = selector.coarse(selector.thumbnail(x))
+            region_centers = torch.tanh(region_params) * (1 - selector.region_scale)
+            affine_transforms = selector.compute_affine_transforms(selector(x), IMG_SIZE, IMG_SIZE)
+        offsets = affine_transforms[..., -1] - region_centers.repeat_interleave(selector.num_patches // selector.num_regions, dim=1)
+        error = (offsets.abs() - selector.region_scale).max()
+        assert error < 1e-5, f'{name} patches are centered {error:.2e} outside of their regions'
+        print(f"hierarchical, {name}: patches are centered within their regions, up to {offsets.abs().max() / selector.region_scale:.2f} of the region half size")
+
+def check_autocast():
+    """
+    Checks that a training step with the hierarchical selector runs under CPU autocast,
+    as in the training scripts, with a loss close to that of a float32 step and finite
+    float32 gradients. The gradients themselves are not compared, as those of the
+    selector reach it only through the patch positions and vary with the rounding of
+    the tokens under autocast, for every selector.
+    """
+    x = torch.randn(8, 3, IMG_SIZE, IMG_SIZE)
+    labels = torch.randint(0, 10, (8,))
+    losses = []
+    for enabled in [False, True]:
+        model = build_selector_model(
+            img_size=IMG_SIZE,
+            selector_regions=4,
+            selector_region_scale=0.25,
+            scaling='isotropic',
+            max_scale=0.3,
+            rotating=True
+        )
+        torch.manual_seed(0) # the same stochastic depth in both steps
+        with torch.autocast(device_type='cpu', enabled=enabled):
+            loss = F.cross_entropy(model(x).float(), labels)
+        loss.backward()
+        grads = [p.grad for p in model.parameters() if p.grad is not None]
+        assert all(g.dtype == torch.float32 and g.isfinite().all() for g in grads), 'gradients are not finite float32'
+        losses.append(loss.item())
+    error = abs(losses[1] - losses[0]) / losses[0]
+    assert error < 0.02, f'autocast loss differs by {error:.2e}'
+    print(f"hierarchical, autocast: training step runs, loss within {error:.2e} of float32")
+
+def cifar10(train):
+    # the CIFAR-10 split with the training scripts' test transform, or None if it cannot be loaded
+    transform = create_transform(
+        input_size=32,
+        is_training=False,
+        mean=[0.4914, 0.4822, 0.4465],
+        std=[0.2470, 0.2435, 0.2616]
+    )
+    try:
+        return torchvision.datasets.CIFAR10(root='./data', train=train, download=True, transform=transform)
+    except (RuntimeError, OSError):
+        return None
+
+def main():
+    steps = num_steps()
+    sizes = [32, 64, 128, 256, 512, 1024]
+    check_region_centers()
+    check_autocast()
+
+
+    print("\nPatch selector multiply-accumulates per image (M), 16 patches, conv and matmul only")
+    print(f"{'selector':>23} | " + " | ".join(f"{size:>7}" for size in sizes) + f" | {'params M at 256':>15}")
+    for name, kwargs in SELECTORS:
+        macs = [selector_flops(size, kwargs) / 1e6 for size in sizes]
+        with torch.device('meta'):
+            params = sum(p.numel() for p in build_selector_model(img_size=IMG_SIZE, **kwargs).patch_selector.parameters()) / 1e6
+        print(f"{name:>23} | " + " | ".join(f"{m:>7.1f}" for m in macs) + f" | {params:>15.2f}")
+
+    print(f"\nPatch selector latency (ms) at batch 16, {torch.get_num_threads()} threads")
+    print(f"{'selector':>23} | " + " | ".join(f"{size:>7}" for size in sizes[1:]))
+    for name, kwargs in SELECTORS[1:]:
+        times = []
+        for size in sizes[1:]:
+            selector = build_selector_model(img_size=size, **kwargs).patch_selector.eval()
+            x = torch.randn(16, 3, size, size)
+            with torch.no_grad():
+                times.append(time_fn(lambda: selector(x), warmup=1, iters=5))
+        print(f"{name:>23} | " + " | ".join(f"{ms:>7.1f}" for ms in times))
+
+    # fewer images than in utils.bench_thumbnail, as 256x256 images take 4x the memory
+    train_set = synthetic_objects(2048, IMG_SIZE, OBJECT_SIZE, seed=0)
+    test_loader = DataLoader(synthetic_objects(512, IMG_SIZE, OBJECT_SIZE, seed=1), batch_size=128)
+    x = torch.randn(64, 3, IMG_SIZE, IMG_SIZE)
+    print(
+        f"\n{IMG_SIZE}x{IMG_SIZE} images with one {OBJECT_SIZE}x{OBJECT_SIZE} object each (see utils.benchmark.synthetic_objects), "
+        f"{steps} training steps of batch 32 with the localization loss of utils.benchmark.localized_loss"
+    )
+    print(
+        f"{'selector':>23} | {'patches on object %':>19} | {'accuracy %':>10} | {'selector ms':>11} | "
+        f"{'eval img/s':>10} | {'train img/s':>11}"
+    )
+    for name, kwargs in SELECTORS[1:]:
+        model = build_selector_model(img_size=IMG_SIZE, **kwargs)
+        train_steps(model, train_set, steps, loss_fn=localized_loss)
+        on_object = patches_on_object(model, test_loader)
+        accuracy = evaluate(model, test_loader)[0]
+        with torch.no_grad():
+            selector_ms = time_fn(lambda: model.patch_selector(x), warmup=1, iters=5)
+            eval_ms = time_fn(lambda: model(x), warmup=1, iters=5)
+        model.train()
+        def train_step():
+            model.zero_grad(set_to_none=True)
+            F.cross_entropy(model(x), torch.randint(0, 10, (x.size(0),))).backward()
+        train_ms = time_fn(train_step, warmup=1, iters=3)
+        print(
+            f"{name:>23} | {on_object * 100:>19.1f} | {accuracy * 100:>10.1f} | {selector_ms:>11.2f} | "
+            f"{x.size(0) / eval_ms * 1000:>10.0f} | {x.size(0) / train_ms * 1000:>11.0f}"
+        )
+
+    train_set, test_set = cifar10(train=True), cifar10(train=False)
+    if train_set is None or test_set is None:
+        print("\nCIFAR-10 unavailable, skipping the CIFAR-10 comparison")
+        return
+    test_loader = DataLoader(test_set, batch_size=256)
+    print(f"\nCIFAR-10, {steps} training steps of batch 32, 32x32 images")
+    print(f"{'selector':>23} | {'accuracy %':>10}")
+    # 16x16 regions of the 32x32 images, cropped at full resolution
+    for name, kwargs in [
+        ('full resolution', dict()),
+        ('hierarchical, 1 region', dict(selector_regions=1, selector_region_scale=0.5)),
+        ('hierarchical, 4 regions', dict(selector_regions=4, selector_region_scale=0.5))
+    ]:
+        model = train_steps(build_selector_model(img_size=32, **kwargs), train_set, steps)
+        print(f"{name:>23} | {evaluate(model, test_loader)[0] * 100:>10.1f}")
+
+if __name__ == "__main__":
+    main()
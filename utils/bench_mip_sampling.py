@@ -0,0 +1,168 @@
+import math
+import torch
+import torch.nn.functional as F
+from apvit_e2e import APViT
+from modules.PatchSamplers import grid_sample_patches, mip_sample_patches, make_base_grid, patch_grid, sample_and_embed
+from utils.benchmark import time_fn
+
+IMG_SIZE = 224
+PATCH_SIZE = 8
+
+def supersample_patches(x, affine_transforms, patch_size, factor):
+    """
+    Samples every patch on a grid factor times finer along each axis and box filters
+    it back down to patch_size x patch_size, at factor^2 times the bilinear cost.
+    """
+    b, c = x.size(0), x.size(1)
+    n = affine_transforms.size(1)
+    fine = grid_sample_patches(x, affine_transforms, make_base_grid(patch_size * factor).to(x))
+    fine = fine.view(b, c * n, patch_size * factor, patch_size * factor)
+    return F.avg_pool2d(fine, factor).view(b, c, n * patch_size, patch_size)
+
+def random_transforms(batch_size, num_patches, scale, generator):
+    # rotated square patches of the given scale, kept within the image
+    theta = (torch.rand(batch_size, num_patches, generator=generator) * 2 - 1) * math.pi
+    rotation = torch.stack([theta.cos(), -theta.sin(), theta.sin(), theta.cos()], dim=-1).view(batch_size, num_patches, 2, 2)
+    translation = (torch.rand(batch_size, num_patches, 2, 1, generator=generator) * 2 - 1) * (1 - scale * math.sqrt(2))
+    return torch.cat([scale * rotation, translation], dim=-1)
+
+def num_levels(scale):
+    return 1 + max(0, math.ceil(math.log2(scale * IMG_SIZE / PATCH_SIZE)))
+
+def test_images(batch_size, generator):
+    """
+    White noise, the worst case for aliasing, and a zone plate, whose frequency rises
+    from the center to the corners.
+    """
+    noise = torch.randn(batch_size, 3, IMG_SIZE, IMG_SIZE, generator=generator)
+    coords = torch.linspace(-1, 1, IMG_SIZE)
+    grid_y, grid_x = torch.meshgrid(coords, coords, indexing='ij')
+    zone_plate = torch.cos(math.pi * IMG_SIZE / 4 * (grid_x ** 2 + grid_y ** 2)).expand(batch_size, 3, -1, -1)
+    return [('white noise', noise), ('zone plate', zone_plate.contiguous())]
+
+def check_levels():
+    """
+    Checks that patches at whole levels match bilinear sampling of that level of the
+    pyramid, including samples outside the image, and that fractional levels blend
+    the two levels around them.
+    """
+    torch.manual_seed(42)
+    x = torch.randn(2, 3, 64, 48)
+    base_grid = make_base_grid(PATCH_SIZE)
+    transforms = torch.zeros(2, 5, 2, 3)
+    transforms[..., 0, 0] = PATCH_SIZE / 48
+    transforms[..., 1, 1] = PATCH_SIZE / 64
+    transforms[..., :, 2] = torch.rand(2, 5, 2) * 2.4 - 1.2
+
+    levels = [x]
+    for _ in range(3):
+        levels.append(F.avg_pool2d(levels[-1], 2))
+    for level in [0, 1, 1.5, 2, 5]:
+        scaled = transforms.clone()
+        scaled[..., :2] *= 2 ** level
+        grid = patch_grid(scaled, base_grid)
+        lower, upper = levels[min(int(level), 3)], levels[min(math.ceil(level), 3)]
+        expected = torch.lerp(F.grid_sample(lower, grid, align_corners=False), F.grid_sample(upper, grid, align_corners=False), level % 1)
+        error = (mip_sample_patches(x, scaled, base_grid, 4) - expected).abs().max()
+        assert error < 1e-4, f'level {level}: outputs differ by {error:.2e}'
+    assert torch.equal(mip_sample_patches(x, transforms, base_grid, 1), grid_sample_patches(x, transforms, base_grid))
+    print("mip sampling: whole levels match the pooled images, fractional levels blend them, beyond the top level clamps")
+
+def check_autocast():
+    """
+    Checks that under CPU autocast mip sampling picks the same levels and samples the
+    same points as in float32, as the levels and atlas coordinates are taken from a
+    float32 grid, in value and in gradient w.r.t. the affine transforms, both for
+    mip_sample_patches and for sample_and_embed, which calls it.
+    """
+    generator = torch.Generator().manual_seed(42)
+    x = torch.rand(4, 3, IMG_SIZE, IMG_SIZE, generator=generator)
+    base_grid = make_base_grid(PATCH_SIZE)
+    affine_transforms = torch.cat([random_transforms(4, 4, scale, generator) for scale in [0.05, 0.1, 0.2, 0.3]], dim=1)
+    weight = torch.randn(16, 3, PATCH_SIZE, PATCH_SIZE, generator=generator)
+
+    for name, sample in [
+        ('mip_sample_patches', lambda a: mip_sample_patches(x, a, base_grid, 4)),
+        ('sample_and_embed', lambda a: sample_and_embed(x, a, weight, base_grid=base_grid, mip_levels=4).float())
+    ]:
+        outputs, grads = [], []
+        for enabled in [False, True]:
+            a = affine_transforms.clone().requires_grad_()
+            with torch.autocast(device_type='cpu', enabled=enabled):
+                output = sample(a)
+            output.sum().backward()
+            outputs.append(output)
+            grads.append(a.grad)
+        # the token projection of sample_and_embed itself runs in bfloat16 under autocast
+        tolerance = 1e-6 if name == 'mip_sample_patches' else 0.02
+        error = ((outputs[1] - outputs[0]).abs().max() / outputs[0].abs().max()).item()
+        grad_error = ((grads[1] - grads[0]).norm() / grads[0].norm()).item()
+        assert outputs[1].dtype == torch.float32 and error <= tolerance, f'{name}: autocast outputs differ by {error:.2e}'
+        assert grad_error <= tolerance, f'{name}: autocast gradients differ by {grad_error:.2e}'
+    print("mip sampling under autocast: patches and gradients match float32")
+
+def main():
+    check_levels()
+    check_autocast()
+    generator = torch.Generator().manual_seed(42)
+    batch_size, num_patches = 8, 16
+    base_grid = make_base_grid(PATCH_SIZE)
+
+    samplers = [
+        ('bilinear', lambda x, a, scale: grid_sample_patches(x, a, base_grid)),
+        ('supersample 2x2', lambda x, a, scale: supersample_patches(x, a, PATCH_SIZE, 2)),
+        ('supersample 4x4', lambda x, a, scale: supersample_patches(x, a, PATCH_SIZE, 4)),
+        ('mip trilinear', lambda x, a, scale: mip_sample_patches(x, a, base_grid, num_levels(scale)))
+    ]
+
+    print(f"\nAliasing of {PATCH_SIZE}x{PATCH_SIZE} patches from {IMG_SIZE}x{IMG_SIZE} images, RMS error against 16x16 supersampling, relative to its RMS")
+    print(f"{'image':>12} | {'scale':>5} | {'px/sample':>9} | " + " | ".join(f"{name:>15}" for name, _ in samplers))
+    for image_name, x in test_images(batch_size, generator):
+        for scale in [0.1, 0.2, 0.4, 0.7]:
+            transforms = random_transforms(batch_size, num_patches, scale, generator)
+            reference = supersample_patches(x, transforms, PATCH_SIZE, 16)
+            errors = [(sampler(x, transforms, scale) - reference).pow(2).mean().sqrt() / reference.pow(2).mean().sqrt() for _, sampler in samplers]
+            print(
+                f"{image_name:>12} | {scale:>5.1f} | {scale * IMG_SIZE / PATCH_SIZE:>9.1f} | "
+                + " | ".join(f"{error:>15.3f}" for error in errors)
+            )
+
+    batch_size, scale = 32, 0.4
+    x = torch.randn(batch_size, 3, IMG_SIZE, IMG_SIZE)
+    transforms = random_transforms(batch_size, num_patches, scale, generator)
+    print(f"\nSampling cost, batch {batch_size}, {num_patches} patches of scale {scale}, {torch.get_num_threads()} threads")
+    print(f"{'sampler':>15} | {'fwd ms':>7} | {'fwd+bwd ms':>10}")
+    for name, sampler in samplers:
+        def forward_backward():
+            a = transforms.clone().requires_grad_()
+            sampler(x, a, scale).sum().backward()
+        with torch.no_grad():
+            forward_ms = time_fn(lambda: sampler(x, transforms, scale), iters=5)
+        print(f"{name:>15} | {forward_ms:>7.2f} | {time_fn(forward_backward, iters=5):>10.2f}")
+
+    print(f"\nAPViT at {IMG_SIZE}x{IMG_SIZE}, isotropic scaling up to 0.5, 32x32 pooled selector, batch {batch_size}")
+    print(f"{'sampler':>15} | {'eval img/s':>10} | {'train img/s':>11}")
+    for mip_sampling in [False, True]:
+        torch.manual_seed(42)
+        model = APViT(
+            img_size=IMG_SIZE,
+            num_patches=num_patches,
+            embed_dim=256,
+            num_transformer_layers=8,
+            hidden_channels=24,
+            scaling='isotropic',
+            max_scale=0.5,
+            selector_feature_size=32,
+            mip_sampling=mip_sampling
+        )
+        with torch.no_grad():
+            eval_ms = time_fn(lambda: model.eval()(x), warmup=1, iters=3)
+        def train_step():
+            model.zero_grad(set_to_none=True)
+            F.cross_entropy(model.train()(x), torch.randint(0, 10, (batch_size,))).backward()
+        train_ms = time_fn(train_step, warmup=1, iters=3)
+        name = 'mip trilinear' if mip_sampling else 'bilinear'
+        print(f"{name:>15} | {batch_size / eval_ms * 1000:>10.0f} | {batch_size / train_ms * 1000:>11.0f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+import torch
+from apvit_aploss import APViT, build_optimizer, load_config
+from utils.benchmark import time_fn
+
+def shared_optimizers(model, lr, weight_decay):
+    """
+    The original setup, two default AdamW instances over every parameter.
+    """
+    return [
+        torch.optim.AdamW([
+            {'params': [p for n, p in model.named_parameters() if 'bias' not in n]},
+            {'params': [p for n, p in model.named_parameters() if 'bias' in n], 'weight_decay': 0.0}
+        ], lr=lr, weight_decay=weight_decay)
+        for _ in range(2)
+    ]
+
+def partitioned_optimizers(model, lr, weight_decay):
+    device = next(model.parameters()).device
+    return [build_optimizer(module, lr, weight_decay, device) for module in [model.patch_selector, model.vit]]
+
+def state_memory(optimizers):
+    """
+    Returns the memory in MB held by the optimizer states.
+    """
+    return sum(
+        tensor.numel() * tensor.element_size()
+        for optimizer in optimizers
+        for state in optimizer.state.values()
+        for tensor in state.values()
+        if torch.is_tensor(tensor)
+    ) / 2**20
+
+def main():
+    torch.manual_seed(42)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    config = load_config("hparams_config.yaml")
+
+    model = APViT(
+        num_patches=16,
+        patch_size=8,
+        hidden_channels=config.get("hidden_channels", 16),
+        embed_dim=config.get("attn_embed_dim", 256),
+        num_transformer_layers=config.get("num_transformer_layers", 6),
+        stochastic_depth=config.get("stochastic_depth", 0.15),
+        scaling=None,
+        max_scale=0.4,
+        rotating=False
+    ).to(device)
+    for param in model.parameters():
+        param.grad = torch.randn_like(param)
+
+    num_params = sum(p.numel() for p in model.parameters())
+    print(f"hparams_config.yaml model: {num_params / 1e6:.2f}M parameters, {num_params * 4 / 2**20:.1f} MB")
+    print(f"{'optimizers':>24} | {'state MB':>8} | {'step ms':>7}")
+    for name, build in [('shared AdamW x2', shared_optimizers), ('partitioned fused AdamW', partitioned_optimizers)]:
+        optimizers = build(model, 0.0005, config.get("weight_decay", 0.00015))
+
+        def step():
+            for optimizer in optimizers:
+                optimizer.step()
+
+        step_ms = time_fn(step, iters=20)
+        print(f"{name:>24} | {state_memory(optimizers):>8.1f} | {step_ms:>7.2f}")
+
+if __name__ == "__main__":
+    main()
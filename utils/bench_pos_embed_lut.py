@@ -0,0 +1,97 @@
+import torch
+import torch.nn as nn
+from apvit_e2e import APViT, load_config
+from modules.InterpolatePosEmbeds import interpolate_pos_embeds, upsample_pos_embeds, lookup_pos_embeds
+from utils.benchmark import time_fn, get_test_loader, load_weights, evaluate
+
+def build_model(config):
+    return APViT(
+        num_patches=16,
+        embed_dim=config.get("attn_embed_dim", 256),
+        num_transformer_layers=config.get("num_transformer_layers", 8),
+        hidden_channels=config.get("hidden_channels", 24),
+        embed_mode=config.get("embed_mode", "strip")
+    )
+
+def check_invalidation(config):
+    """
+    Checks that the lookup table follows pos_embeds through an optimizer step and
+    a state dict load, comparing each lookup against a freshly upsampled table.
+    """
+    torch.manual_seed(42)
+    model = build_model(config)
+    model.vit.pos_embed_lut_resolution = 64
+    coords = torch.rand(8, 16, 2) * 2 - 1
+
+    def check(stage):
+        model.eval()
+        with torch.no_grad():
+            looked_up = model.vit.lookup_pos_embeds(coords)
+            expected = lookup_pos_embeds(upsample_pos_embeds(model.vit.pos_embeds, 64), coords)
+        assert torch.equal(looked_up, expected), f'{stage}: stale lookup table'
+
+    check("first lookup")
+
+    model.train()
+    optimizer = torch.optim.AdamW(model.parameters(), lr=0.01, fused=True)
+    nn.functional.cross_entropy(model(torch.randn(8, 3, 32, 32)), torch.randint(0, 10, (8,))).backward()
+    optimizer.step()
+    check("after an optimizer step")
+
+    model.load_state_dict(build_model(config).state_dict())
+    check("after load_state_dict")
+    print("the lookup table is rebuilt after optimizer steps and state dict loads")
+
+def main():
+    config = load_config("hparams_config.yaml")
+    check_invalidation(config)
+
+    torch.manual_seed(42)
+    model = build_model(config)
+    weights = load_weights(model, "models/apvit_16.pth")
+    model.eval()
+    test_loader, data_name = get_test_loader(256)
+
+    # coords as the patch selector produces them on the test images
+    with torch.no_grad():
+        images = next(iter(test_loader))[0]
+        _, affine_transforms = model.embed_patches(images, model.patch_selector(images))
+        coords = affine_transforms[..., -1]
+        interpolated = interpolate_pos_embeds(model.vit.pos_embeds, coords)
+    embed_norm = interpolated.norm(dim=-1).mean()
+
+    accuracy, predictions = evaluate(model, test_loader)
+    print(f"\nPositional embedding lookup table, apvit_e2e ({weights}), accuracy on the {data_name}")
+    print(f"{'resolution':>10} | {'table KB':>8} | {'max rel error':>13} | {'accuracy %':>10} | {'top-1 agreement %':>17}")
+    print(f"{'interp':>10} | {'':>8} | {'':>13} | {accuracy * 100:>10.2f} | {100:>17.2f}")
+    for resolution in [16, 32, 64, 128]:
+        with torch.no_grad():
+            lut = upsample_pos_embeds(model.vit.pos_embeds, resolution)
+            error = (lookup_pos_embeds(lut, coords) - interpolated).norm(dim=-1).max() / embed_norm
+
+        model.vit.pos_embed_lut_resolution = resolution
+        lut_accuracy, lut_predictions = evaluate(model, test_loader)
+        model.vit.pos_embed_lut_resolution = 0
+        agreement = lut_predictions.eq(predictions).float().mean().item()
+        print(
+            f"{resolution:>10} | {lut.numel() * lut.element_size() / 2**10:>8.0f} | {error:>13.4f} | "
+            f"{lut_accuracy * 100:>10.2f} | {agreement * 100:>17.2f}"
+        )
+
+    print(f"\nInference latency, batch {images.size(0)}")
+    print(f"{'stage':>20} | {'interp ms':>9} | {'lookup ms':>9}")
+    with torch.no_grad():
+        lut = upsample_pos_embeds(model.vit.pos_embeds, 64)
+        stage_times = [
+            time_fn(lambda: interpolate_pos_embeds(model.vit.pos_embeds, coords), iters=50),
+            time_fn(lambda: lookup_pos_embeds(lut, coords), iters=50)
+        ]
+        model_times = []
+        for resolution in [0, 64]:
+            model.vit.pos_embed_lut_resolution = resolution
+            model_times.append(time_fn(lambda: model(images)))
+    print(f"{'pos embeds':>20} | {stage_times[0]:>9.3f} | {stage_times[1]:>9.3f}")
+    print(f"{'model forward':>20} | {model_times[0]:>9.2f} | {model_times[1]:>9.2f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+import torch
+from modules.InterpolatePosEmbeds import interpolate_pos_embeds
+from utils.benchmark import time_fn
+
+def four_gather_interpolate(pos_embeds, coords):
+    """
+    The original interpolation, with a separate advanced-indexing gather per corner.
+    """
+    num_embeds, embedding_dim = pos_embeds.size()
+    grid_size = int(num_embeds ** 0.5)
+    pos_embeds = pos_embeds.view(grid_size, grid_size, embedding_dim)
+
+    coords = (coords + 1) * (grid_size - 1) / 2
+    coords_floor = torch.floor(coords)
+    delta = coords - coords_floor
+
+    x0y0 = coords_floor.long().clamp(0, grid_size - 1)
+    x1y1 = (x0y0 + 1).clamp(0, grid_size - 1)
+
+    embed00 = pos_embeds[x0y0[..., 1], x0y0[..., 0]]
+    embed01 = pos_embeds[x1y1[..., 1], x0y0[..., 0]]
+    embed10 = pos_embeds[x0y0[..., 1], x1y1[..., 0]]
+    embed11 = pos_embeds[x1y1[..., 1], x1y1[..., 0]]
+
+    delta_x, delta_y = delta[..., 0:1], delta[..., 1:2]
+    return (1 - delta_x) * (1 - delta_y) * embed00 + (1 - delta_x) * delta_y * embed01 \
+        + delta_x * (1 - delta_y) * embed10 + delta_x * delta_y * embed11
+
+def check_equivalence(pos_embeds, coords, name):
+    """
+    Compares the outputs, with and without gradients, and the gradients w.r.t.
+    pos_embeds and coords against the four-gather interpolation.
+    """
+    pos_embeds = pos_embeds.detach().requires_grad_()
+    coords = coords.detach().requires_grad_()
+    expected = four_gather_interpolate(pos_embeds, coords)
+    grad_weights = torch.randn_like(expected)
+    expected_grads = torch.autograd.grad((expected * grad_weights).sum(), [pos_embeds, coords])
+
+    output = interpolate_pos_embeds(pos_embeds, coords)
+    grads = torch.autograd.grad((output * grad_weights).sum(), [pos_embeds, coords])
+    with torch.no_grad():
+        no_grad_output = interpolate_pos_embeds(pos_embeds, coords)
+
+    assert torch.allclose(output, expected, atol=1e-5), f'{name}: outputs differ'
+    assert torch.allclose(no_grad_output, expected, atol=1e-5), f'{name}: no-grad outputs differ'
+    assert torch.allclose(grads[0], expected_grads[0], atol=1e-4), f'{name}: pos_embeds gradients differ'
+    assert torch.allclose(grads[1], expected_grads[1], rtol=1e-4, atol=1e-3), f'{name}: coords gradients differ'
+    print(f"{name}: outputs and gradients match the four-gather interpolation")
+
+def main():
+    torch.manual_seed(42)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    pos_embeds = torch.randn(16, 256, device=device)
+    coords = torch.rand(8, 16, 2, device=device) * 2 - 1
+    check_equivalence(pos_embeds, coords, "(B, N, 2) coords")
+    check_equivalence(pos_embeds, torch.rand(4, 8, 16, 2, device=device) * 2 - 1, "(K+1, B, N, 2) coords")
+    # grids beyond MAX_DENSE_EMBEDS gather the corner embeddings instead
+    check_equivalence(torch.randn(1024, 256, device=device), coords, "(B, N, 2) coords, 1024 embeds")
+    # coords on the grid border, where the corner indices are clamped
+    check_equivalence(pos_embeds, torch.tensor([[[-1.0, 1.0], [1.0, -1.0], [-1.0, -1.0], [1.0, 1.0], [1.0, 0.3]]], device=device), "border coords")
+
+    batch_size = 64
+    print(f"\nPositional embedding interpolation, batch {batch_size}, N coords per image on an N embedding grid")
+    print(f"{'N':>5} | {'D':>5} | {'4-gather fwd ms':>15} | {'stacked fwd ms':>14} | {'4-gather fwd+bwd ms':>19} | {'stacked fwd+bwd ms':>18}")
+    for num_patches in [16, 256, 1024]:
+        for embed_dim in [256, 512, 1024]:
+            pos_embeds = torch.randn(num_patches, embed_dim, device=device, requires_grad=True)
+            coords = (torch.rand(batch_size, num_patches, 2, device=device) * 2 - 1).requires_grad_()
+
+            def forward(interpolate):
+                with torch.no_grad():
+                    interpolate(pos_embeds, coords)
+
+            print(
+                f"{num_patches:>5} | {embed_dim:>5} | {time_fn(lambda: forward(four_gather_interpolate), iters=5):>15.2f} | "
+                f"{time_fn(lambda: forward(interpolate_pos_embeds), iters=5):>14.2f} | "
+                f"{time_fn(lambda: four_gather_interpolate(pos_embeds, coords).sum().backward(), iters=5):>19.2f} | "
+                f"{time_fn(lambda: interpolate_pos_embeds(pos_embeds, coords).sum().backward(), iters=5):>18.2f}"
+            )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+import torch
+from apvit_e2e import APViT, load_config
+from std_vit import STD_ViT
+from modules.Quantization import quantize_for_inference
+from utils.benchmark import time_fn, get_test_loader, load_weights, evaluate
+
+def main():
+    torch.manual_seed(42)
+    config = load_config("hparams_config.yaml")
+    embed_dim = config.get("attn_embed_dim", 256)
+    num_transformer_layers = config.get("num_transformer_layers", 8)
+    test_loader, data_name = get_test_loader(256)
+
+    models = [
+        ('apvit_e2e', APViT(
+            num_patches=16,
+            embed_dim=embed_dim,
+            num_transformer_layers=num_transformer_layers,
+            hidden_channels=config.get("hidden_channels", 24),
+            embed_mode=config.get("embed_mode", "strip")
+        ), 'models/apvit_16.pth'),
+        ('std_vit', STD_ViT(
+            embed_dim=embed_dim,
+            num_transformer_layers=num_transformer_layers
+        ), 'models/std_vit.pth')
+    ]
+
+    results = []
+    for name, model, weights_path in models:
+        weights = load_weights(model, weights_path)
+        model.eval()
+        quantized = quantize_for_inference(model)
+
+        fp32_accuracy, fp32_predictions = evaluate(model, test_loader)
+        int8_accuracy, int8_predictions = evaluate(quantized, test_loader)
+        agreement = fp32_predictions.eq(int8_predictions).float().mean().item()
+
+        timings = []
+        for batch_size in [1, 256]:
+            x = torch.randn(batch_size, 3, 32, 32)
+            for m in [model, quantized]:
+                with torch.no_grad():
+                    timings.append(time_fn(lambda: m(x)))
+        results.append((name, weights, fp32_accuracy, int8_accuracy, agreement, timings))
+
+    print(f"Int8 dynamic quantization, accuracy on the {data_name}")
+    print(f"{'model':>9} | {'weights':>20} | {'fp32 acc %':>10} | {'int8 acc %':>10} | {'delta':>6} | {'top-1 agreement %':>17}")
+    for name, weights, fp32_accuracy, int8_accuracy, agreement, _ in results:
+        print(
+            f"{name:>9} | {weights:>20} | {fp32_accuracy * 100:>10.2f} | {int8_accuracy * 100:>10.2f} | "
+            f"{(int8_accuracy - fp32_accuracy) * 100:>+6.2f} | {agreement * 100:>17.2f}"
+        )
+
+    print(f"\nCPU latency and throughput, {torch.get_num_threads()} threads")
+    print(f"{'model':>9} | {'fp32 ms @1':>10} | {'int8 ms @1':>10} | {'fp32 img/s @256':>15} | {'int8 img/s @256':>15} | {'speedup @256':>12}")
+    for name, _, _, _, _, (fp32_ms, int8_ms, fp32_batch_ms, int8_batch_ms) in results:
+        print(
+            f"{name:>9} | {fp32_ms:>10.2f} | {int8_ms:>10.2f} | {256 / fp32_batch_ms * 1000:>15.0f} | "
+            f"{256 / int8_batch_ms * 1000:>15.0f} | {fp32_batch_ms / int8_batch_ms:>11.2f}x"
+        )
+
+if __name__ == "__main__":
+    main()
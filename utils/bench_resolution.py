@@ -0,0 +1,114 @@
+import torch
+import torch.nn.functional as F
+from apvit_e2e import APViT, load_config
+from modules.InterpolatePosEmbeds import interpolate_pos_embeds, interpolate_pos_embed_pyramid
+from utils.benchmark import time_fn
+
+# input sizes as (height, width), 128x96 being 128 wide and 96 tall
+SIZES = [(64, 64), (96, 128), (224, 224)]
+
+# (name, APViT keyword arguments) of the configurations timed at every size
+CONFIGS = [
+    ('strip', dict(embed_mode='strip')),
+    ('isotropic, 3 levels', dict(embed_mode='strip', scaling='isotropic', max_scale=0.5, pos_embed_levels=3))
+]
+
+def grid_interpolate(pos_embeds, coords, grid_shape):
+    """
+    Bilinear interpolation indexing the (grid_height, grid_width, D) grid directly,
+    as a reference for rectangular grids.
+    """
+    grid_height, grid_width = grid_shape
+    pos_embeds = pos_embeds.view(grid_height, grid_width, -1)
+    x = (coords[..., 0] + 1) * (grid_width - 1) / 2
+    y = (coords[..., 1] + 1) * (grid_height - 1) / 2
+    x0 = x.floor().long().clamp(0, grid_width - 1)
+    y0 = y.floor().long().clamp(0, grid_height - 1)
+    x1 = (x0 + 1).clamp(0, grid_width - 1)
+    y1 = (y0 + 1).clamp(0, grid_height - 1)
+    delta_x = (x - x.floor()).unsqueeze(-1)
+    delta_y = (y - y.floor()).unsqueeze(-1)
+    return (1 - delta_x) * (1 - delta_y) * pos_embeds[y0, x0] + (1 - delta_x) * delta_y * pos_embeds[y1, x0] \
+        + delta_x * (1 - delta_y) * pos_embeds[y0, x1] + delta_x * delta_y * pos_embeds[y1, x1]
+
+def check_grids():
+    """
+    Checks rectangular grids against direct grid indexing, that the pyramid reduces to
+    a single grid at integer levels, and that square grids are interpolated as before.
+    """
+    torch.manual_seed(42)
+    coords = torch.rand(8, 16, 2) * 2 - 1
+    for grid_shape in [(12, 16), (16, 12), (28, 28)]:
+        pos_embeds = torch.randn(grid_shape[0] * grid_shape[1], 64)
+        expected = grid_interpolate(pos_embeds, coords, grid_shape)
+        assert torch.allclose(interpolate_pos_embeds(pos_embeds, coords, grid_shape), expected, atol=1e-5), f'{grid_shape} grid: outputs differ'
+    print("rectangular grids: outputs match direct grid indexing")
+
+    grid_shapes = [(12, 16), (6, 8), (3, 4)]
+    pyramid = [torch.randn(h * w, 64) for h, w in grid_shapes]
+    for level, (pos_embeds, grid_shape) in enumerate(zip(pyramid, grid_shapes)):
+        levels = torch.full(coords.shape[:-1], float(level))
+        output = interpolate_pos_embed_pyramid(pyramid, grid_shapes, coords, levels)
+        assert torch.allclose(output, interpolate_pos_embeds(pos_embeds, coords, grid_shape), atol=1e-5), f'level {level}: outputs differ'
+    halfway = interpolate_pos_embed_pyramid(pyramid, grid_shapes, coords, torch.full(coords.shape[:-1], 0.5))
+    expected = (interpolate_pos_embeds(pyramid[0], coords, grid_shapes[0]) + interpolate_pos_embeds(pyramid[1], coords, grid_shapes[1])) / 2
+    assert torch.allclose(halfway, expected, atol=1e-5), 'level 0.5: outputs differ'
+    print("pyramid: integer levels match their grid, fractional levels blend the two around them")
+
+    pos_embeds = torch.randn(16, 64)
+    assert torch.equal(interpolate_pos_embeds(pos_embeds, coords), interpolate_pos_embeds(pos_embeds, coords, (4, 4)))
+    assert APViT().vit.pos_embeds.shape == (16, 256), 'the default 32x32 grid changed'
+    print("square grids: interpolated as before, the default model is unchanged")
+
+def build_model(config, img_size, kwargs):
+    torch.manual_seed(42)
+    return APViT(
+        img_size=img_size,
+        num_patches=16,
+        embed_dim=config.get("attn_embed_dim", 256),
+        num_transformer_layers=config.get("num_transformer_layers", 8),
+        hidden_channels=config.get("hidden_channels", 24),
+        **kwargs
+    )
+
+def throughput(model, x, resize):
+    """
+    Eval and training (forward and backward) images per second, resizing the
+    images to the model's 32x32 input first if resize is set.
+    """
+    def forward():
+        inputs = F.interpolate(x, size=(32, 32), mode='bilinear', antialias=True) if resize else x
+        return model(inputs)
+
+    def train_step():
+        model.zero_grad(set_to_none=True)
+        F.cross_entropy(forward(), torch.randint(0, 10, (x.size(0),))).backward()
+
+    model.eval()
+    with torch.no_grad():
+        eval_ms = time_fn(forward, warmup=1, iters=3)
+    model.train()
+    train_ms = time_fn(train_step, warmup=1, iters=3)
+    return x.size(0) / eval_ms * 1000, x.size(0) / train_ms * 1000
+
+def main():
+    config = load_config("hparams_config.yaml")
+    check_grids()
+
+    batch_size = 32
+    print(f"\nAPViT throughput, batch {batch_size}, {torch.get_num_threads()} threads, native input vs resized to 32x32")
+    print(f"{'input':>9} | {'config':>20} | {'mode':>7} | {'params M':>8} | {'eval img/s':>10} | {'train img/s':>11}")
+    for height, width in SIZES:
+        x = torch.randn(batch_size, 3, height, width)
+        for name, kwargs in CONFIGS:
+            for mode in ['native', 'resized']:
+                model = build_model(config, (height, width) if mode == 'native' else 32, kwargs)
+                params = sum(p.numel() for p in model.parameters()) / 1e6
+                eval_throughput, train_throughput = throughput(model, x, mode == 'resized')
+                print(
+                    f"{f'{width}x{height}':>9} | {name:>20} | {mode:>7} | {params:>8.1f} | "
+                    f"{eval_throughput:>10.0f} | {train_throughput:>11.0f}"
+                )
+
+if __name__ == "__main__":
+    main()
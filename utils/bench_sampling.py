@@ -0,0 +1,201 @@
+import torch
+import torch.nn as nn
+from modules.AdaptivePatching import AdaptivePatching
+from modules.PatchSamplers import gather_windows, interpolate_windows, grid_sample_patches, make_base_grid, patch_grid
+from utils.benchmark import time_fn, peak_memory, saved_tensor_memory
+
+def expanded_sample_patches(patch_selector, x, transform_params):
+    """
+    The original sampler, which expands the input into one copy per patch.
+    """
+    b, c, h, w = x.size()
+    n, p = patch_selector.num_patches, patch_selector.patch_size
+    _, affine_transforms = patch_selector.sample_affine_patches(x, transform_params)
+    grid = nn.functional.affine_grid(
+        affine_transforms.view(-1, 2, 3),
+        [b * n, 1, p, p],
+        align_corners=False
+    )
+    patches = nn.functional.grid_sample(
+        x.unsqueeze(1).expand(-1, n, -1, -1, -1).reshape(-1, c, h, w),
+        grid,
+        align_corners=False
+    ).view(b, n, c, p, p)
+    return patches, affine_transforms
+
+def autograd_translated_patches(patch_selector, x, transform_params):
+    """
+    The translation-only sampler differentiated by plain autograd, which keeps the
+    gathered windows and intermediate interpolations alive for backward.
+    """
+    b, c, h, w = x.size()
+    p = patch_selector.patch_size
+    affine_transforms = patch_selector.translated_affine_transforms(transform_params, h, w)
+    offsets = (affine_transforms[..., 2] + 1) * affine_transforms.new_tensor([w / 2, h / 2]) - p / 2
+    windows, _, delta = gather_windows(x, offsets, p)
+    return interpolate_windows(windows, delta), affine_transforms
+
+def check_equivalence(sample_fn, reference_fn, x, transform_params, name):
+    """
+    Compares patches, affine transforms and gradients with respect to the
+    translation params between two samplers.
+    """
+    transform_params = transform_params.detach().requires_grad_()
+    patches, affine_transforms = sample_fn(x, transform_params)
+    expected_patches, expected_transforms = reference_fn(x, transform_params)
+
+    weights = torch.randn_like(patches)
+    grad, = torch.autograd.grad((patches * weights).sum(), transform_params)
+    expected_grad, = torch.autograd.grad((expected_patches * weights).sum(), transform_params)
+
+    assert torch.allclose(patches, expected_patches, atol=1e-5), f'{name}: patches differ'
+    assert torch.allclose(affine_transforms, expected_transforms, atol=1e-6), f'{name}: affine transforms differ'
+    assert torch.allclose(grad[..., :2], expected_grad[..., :2], rtol=1e-4, atol=1e-3), f'{name}: gradients differ'
+    print(f"{name}: patches, transforms and gradients match")
+
+def check_autocast(device):
+    """
+    Checks that under autocast AffinePatchSampler samples a lower precision input at
+    float32 grid points and differentiates at those same points, matching grid_sample
+    on the input cast to float32, as for the selector features that feed it in the
+    hierarchical selector.
+    """
+    dtype = torch.bfloat16 if device.type == 'cpu' else torch.float16
+    x = torch.randn(4, 3, 32, 32, device=device).to(dtype).requires_grad_()
+    affine_transforms = (torch.randn(4, 16, 2, 3, device=device) * 0.4).requires_grad_()
+    base_grid = make_base_grid(8).to(device)
+    with torch.autocast(device_type=device.type, dtype=dtype):
+        patches = grid_sample_patches(x, affine_transforms, base_grid)
+    weights = torch.randn_like(patches)
+    grad_x, grad_transforms = torch.autograd.grad((patches * weights).sum(), [x, affine_transforms])
+
+    expected_x = x.detach().float().requires_grad_()
+    expected_transforms = affine_transforms.detach().requires_grad_()
+    expected = nn.functional.grid_sample(expected_x, patch_grid(expected_transforms, base_grid), align_corners=False)
+    expected_grad_x, expected_grad_transforms = torch.autograd.grad((expected * weights).sum(), [expected_x, expected_transforms])
+
+    assert patches.dtype == torch.float32 and grad_x.dtype == dtype, 'autocast: unexpected dtypes'
+    assert torch.allclose(patches, expected, atol=1e-5), 'autocast: patches differ'
+    assert torch.allclose(grad_transforms, expected_grad_transforms, rtol=1e-4, atol=1e-3), 'autocast: gradients differ'
+    assert torch.allclose(grad_x.float(), expected_grad_x, rtol=1e-2, atol=1e-2), 'autocast: input gradients differ'
+    print(f"affine under autocast ({dtype}): patches and gradients match float32 grid_sample")
+
+def build_patch_selector(scaling, rotating, device):
+    return AdaptivePatching(
+        in_channels=3,
+        hidden_channels=24,
+        channel_height=32,
+        channel_width=32,
+        num_patches=16,
+        patch_size=8,
+        scaling=scaling,
+        max_scale=0.4,
+        rotating=rotating
+    ).to(device).eval()
+
+def main():
+    torch.manual_seed(42)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    for scaling, rotating in [(None, False), ('isotropic', False), ('anisotropic', True)]:
+        patch_selector = build_patch_selector(scaling, rotating, device)
+        x = torch.randn(8, 3, 32, 32, device=device)
+        with torch.no_grad():
+            transform_params = patch_selector(x)
+
+        check_equivalence(
+            patch_selector.sample_affine_patches,
+            lambda x, params: expanded_sample_patches(patch_selector, x, params),
+            x, transform_params, f"affine (scaling={scaling}, rotating={rotating})"
+        )
+        if patch_selector.translation_only:
+            check_equivalence(
+                patch_selector.sample_translated_patches,
+                patch_selector.sample_affine_patches,
+                x, transform_params, "translated"
+            )
+            check_equivalence(
+                patch_selector.sample_translated_patches,
+                lambda x, params: autograd_translated_patches(patch_selector, x, params),
+                x, transform_params, "translated (autograd)"
+            )
+
+    check_autocast(device)
+
+    perturbed_patch_sets = 3
+    patch_selector = build_patch_selector(None, False, device)
+
+    print("\nExpanded vs per-image affine sampling")
+    print(f"{'batch':>6} | {'expanded ms':>11} | {'per-image ms':>12} | {'expanded MB':>11} | {'per-image MB':>12}")
+    for batch_size in [32, 128, 256 * (perturbed_patch_sets + 1)]:
+        x = torch.randn(batch_size, 3, 32, 32, device=device)
+        with torch.no_grad():
+            transform_params = patch_selector(x)
+            expanded = lambda: expanded_sample_patches(patch_selector, x, transform_params)
+            per_image = lambda: patch_selector.sample_affine_patches(x, transform_params)
+            print(
+                f"{batch_size:>6} | {time_fn(expanded):>11.2f} | {time_fn(per_image):>12.2f} | "
+                f"{peak_memory(expanded):>11.1f} | {peak_memory(per_image):>12.1f}"
+            )
+
+    print("\nAffine vs translation-only sampling")
+    print(f"{'batch':>6} | {'affine fwd ms':>13} | {'translated fwd ms':>17} | {'affine fwd+bwd ms':>17} | {'translated fwd+bwd ms':>21}")
+    for batch_size in [1, 8, 32, 128, 256, 512]:
+        x = torch.randn(batch_size, 3, 32, 32, device=device)
+        with torch.no_grad():
+            transform_params = patch_selector(x)
+        transform_params.requires_grad_()
+
+        def forward(sample_fn):
+            with torch.no_grad():
+                sample_fn(x, transform_params)
+
+        def step(sample_fn):
+            patches, _ = sample_fn(x, transform_params)
+            patches.sum().backward()
+
+        print(
+            f"{batch_size:>6} | {time_fn(lambda: forward(patch_selector.sample_affine_patches)):>13.2f} | "
+            f"{time_fn(lambda: forward(patch_selector.sample_translated_patches)):>17.2f} | "
+            f"{time_fn(lambda: step(patch_selector.sample_affine_patches)):>17.2f} | "
+            f"{time_fn(lambda: step(patch_selector.sample_translated_patches)):>21.2f}"
+        )
+
+    # activations saved by the sampler per training step of hparams_config.yaml:
+    # batch 256 with the predicted patch set and 3 perturbed sets, excluding the input
+    # images which are saved by the selector's first convolution regardless
+    print("\nSampler activations saved for backward per training step (batch 256, 4 patch sets)")
+    x = torch.randn(256, 3, 32, 32, device=device)
+    with torch.no_grad():
+        transform_params = patch_selector(x)
+    transform_params.requires_grad_()
+
+    def saved_memory(sample_fn):
+        return saved_tensor_memory(
+            lambda: [sample_fn(x, transform_params) for _ in range(perturbed_patch_sets + 1)],
+            exclude=[x]
+        )
+
+    samplers = [
+        ("expanded grid_sample", lambda x, params: expanded_sample_patches(patch_selector, x, params)),
+        ("affine custom autograd", patch_selector.sample_affine_patches),
+        ("translated autograd", lambda x, params: autograd_translated_patches(patch_selector, x, params)),
+        ("translated custom autograd", patch_selector.sample_translated_patches)
+    ]
+    for name, sample_fn in samplers:
+        print(f"{name:>26} | {saved_memory(sample_fn):>7.2f} MB")
+
+    print("\nPer-call latency of the selector head and sampler")
+    print(f"{'config':>34} | {'batch':>5} | {'forward ms':>10} | {'sample_patches ms':>17}")
+    for scaling, rotating in [(None, False), ('anisotropic', True)]:
+        patch_selector = build_patch_selector(scaling, rotating, device)
+        for batch_size in [1, 256]:
+            x = torch.randn(batch_size, 3, 32, 32, device=device)
+            with torch.no_grad():
+                transform_params = patch_selector(x)
+                forward_ms = time_fn(lambda: patch_selector(x), iters=50)
+                sample_ms = time_fn(lambda: patch_selector.sample_patches(x, transform_params), iters=50)
+            print(f"{f'scaling={scaling}, rotating={rotating}':>34} | {batch_size:>5} | {forward_ms:>10.3f} | {sample_ms:>17.3f}")
+
+if __name__ == "__main__":
+    main()
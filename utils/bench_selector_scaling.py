@@ -0,0 +1,113 @@
+import torch
+import torch.nn.functional as F
+from torch.utils.flop_counter import FlopCounterMode
+from apvit_e2e import APViT, load_config
+from modules.AdaptivePatching import AdaptivePatching
+from utils.benchmark import time_fn
+
+SIZES = [32, 64, 128, 224, 384, 512]
+
+# largest selector built at the image size, the fc1 of a 384x384 one alone would hold 1.3B params
+MAX_SELECTOR_PARAMS = 200e6
+
+def build_selector(config, img_size, feature_size=None):
+    torch.manual_seed(42)
+    return AdaptivePatching(
+        in_channels=3,
+        hidden_channels=config.get("hidden_channels", 24),
+        channel_height=img_size,
+        channel_width=img_size,
+        num_patches=16,
+        patch_size=8,
+        feature_size=feature_size
+    )
+
+def size_dependent_params(img_size):
+    # parameters of the selector layers sized by the image: fc1, fc2 predicting the two
+    # translation params, the norms and the encode and decode layers of both ConvSelfAttn blocks
+    channel, half_channel = img_size ** 2, (img_size // 2) ** 2
+    embed_dim = 8 * 8 * 3
+    return sum([
+        half_channel * (half_channel // 2) + half_channel // 2,
+        2 * (half_channel // 2),
+        2 * channel + 2 * half_channel,
+        2 * channel * embed_dim + channel,
+        2 * half_channel * embed_dim + half_channel
+    ])
+
+def selector_params(config, img_size):
+    # parameter count of a selector built at img_size, without allocating it
+    return sum(p.numel() for p in build_selector(config, 32).parameters()) \
+        + size_dependent_params(img_size) - size_dependent_params(32)
+
+def flops_per_image(fn, batch_size):
+    with FlopCounterMode(display=False) as counter:
+        fn()
+    return counter.get_total_flops() / batch_size
+
+def check_equivalence(config):
+    """
+    A selector pooled to the size it was trained at predicts the same params from
+    images of that size as the selector it was trained as, and loads its weights.
+    """
+    selector = build_selector(config, 32).eval()
+    pooled = build_selector(config, 32, feature_size=32).eval()
+    pooled.load_state_dict(selector.state_dict())
+    x = torch.randn(8, 3, 32, 32)
+    with torch.no_grad():
+        assert torch.equal(selector(x), pooled(x)), 'pooled selector differs at its feature size'
+    print("pooled selector: loads the weights of the 32x32 selector and matches it on 32x32 images")
+
+def main():
+    config = load_config("hparams_config.yaml")
+    check_equivalence(config)
+    batch_size = 16
+
+    pooled = build_selector(config, 32, feature_size=32).eval()
+    model = APViT(
+        num_patches=16,
+        embed_dim=config.get("attn_embed_dim", 256),
+        num_transformer_layers=config.get("num_transformer_layers", 8),
+        hidden_channels=config.get("hidden_channels", 24),
+        selector_feature_size=32
+    )
+    model.patch_selector = pooled
+
+    print(f"\nPatch selector cost by input size, batch {batch_size}, {torch.get_num_threads()} threads")
+    print(
+        f"{'input':>7} | {'params M':>8} | {'pooled params M':>15} | {'GFLOP/img':>9} | {'pooled GFLOP/img':>16} | "
+        f"{'fwd ms':>7} | {'pooled fwd ms':>13} | {'pooled share of APViT fwd %':>27} | {'APViT train img/s':>17}"
+    )
+    for img_size in SIZES:
+        x = torch.randn(batch_size, 3, img_size, img_size)
+        params = selector_params(config, img_size)
+
+        if params <= MAX_SELECTOR_PARAMS:
+            selector = build_selector(config, img_size).eval()
+            with torch.no_grad():
+                flops = f"{flops_per_image(lambda: selector(x), batch_size) / 1e9:>9.3f}"
+                ms = f"{time_fn(lambda: selector(x), warmup=1, iters=3):>7.2f}"
+            del selector
+        else:
+            flops, ms = f"{'-':>9}", f"{'-':>7}"
+
+        model.eval()
+        with torch.no_grad():
+            pooled_flops = flops_per_image(lambda: pooled(x), batch_size)
+            pooled_ms = time_fn(lambda: pooled(x), warmup=1, iters=3)
+            model_ms = time_fn(lambda: model(x), warmup=1, iters=3)
+
+        model.train()
+        def train_step():
+            model.zero_grad(set_to_none=True)
+            F.cross_entropy(model(x), torch.randint(0, 10, (batch_size,))).backward()
+        train_ms = time_fn(train_step, warmup=1, iters=3)
+
+        print(
+            f"{img_size:>7} | {params / 1e6:>8.1f} | {sum(p.numel() for p in pooled.parameters()) / 1e6:>15.2f} | "
+            f"{flops} | {pooled_flops / 1e9:>16.3f} | {ms} | {pooled_ms:>13.2f} | "
+            f"{pooled_ms / model_ms * 100:>27.0f} | {batch_size / train_ms * 1000:>17.0f}"
+        )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.utils.data import DataLoader
+from apvit_e2e import APViT
+from utils.benchmark import time_fn, evaluate, synthetic_objects, num_steps, build_selector_model, train_steps, localized_loss, patches_on_object
+
+IMG_SIZE = 128
+OBJECT_SIZE = 32
+
+# (name, APViT keyword arguments) of the patch selectors compared, all sampling patches
+# from the full 128x128 images but for the last, which is given images resized to 32x32
+CONFIGS = [
+    ('full 128x128 selector', dict(img_size=IMG_SIZE)),
+    ('pooled 32x32 features', dict(img_size=IMG_SIZE, selector_feature_size=32)),
+    ('thumbnail 64x64', dict(img_size=IMG_SIZE, selector_thumbnail_size=64)),
+    ('thumbnail 32x32', dict(img_size=IMG_SIZE, selector_thumbnail_size=32)),
+    ('thumbnail 16x16', dict(img_size=IMG_SIZE, selector_thumbnail_size=16)),
+    ('thumbnail 8x8', dict(img_size=IMG_SIZE, selector_thumbnail_size=8)),
+    ('resized input 32x32', dict(img_size=32))
+]
+
+class Resized(nn.Module):
+    # resizes the images to the model's input size before classifying them
+    def __init__(self, model, size):
+        super(Resized, self).__init__()
+        self.model = model
+        self.size = size
+
+    def forward(self, x):
+        return self.model(F.interpolate(x, size=self.size, mode='bilinear', align_corners=False, antialias=True))
+
+def build_model(kwargs):
+    model = build_selector_model(**kwargs)
+    return model if kwargs['img_size'] == IMG_SIZE else Resized(model, kwargs['img_size'])
+
+def main():
+    steps = num_steps()
+    train_set = synthetic_objects(8192, IMG_SIZE, OBJECT_SIZE, seed=0)
+    test_loader = DataLoader(synthetic_objects(1024, IMG_SIZE, OBJECT_SIZE, seed=1), batch_size=128)
+    x = torch.randn(64, 3, IMG_SIZE, IMG_SIZE)
+
+    print(
+        f"Patch selector thumbnails, {IMG_SIZE}x{IMG_SIZE} images with one {OBJECT_SIZE}x{OBJECT_SIZE} object each "
+        f"(see utils.benchmark.synthetic_objects), {steps} training steps of batch 32"
+    )
+    print(f"{torch.get_num_threads()} threads, latency and throughput at batch 64")
+    print(
+        f"{'selector':>22} | {'selector params M':>17} | {'patches on object %':>19} | {'accuracy %':>10} | "
+        f"{'selector ms':>11} | {'eval img/s':>10} | {'train img/s':>11}"
+    )
+    for name, kwargs in CONFIGS:
+        model = build_model(kwargs)
+        if isinstance(model, APViT):
+            train_steps(model, train_set, steps, loss_fn=localized_loss)
+            on_object = f"{patches_on_object(model, test_loader) * 100:>19.1f}"
+            selector, selector_input = model.patch_selector, x
+        else:
+            # the 16 patches of a 32x32 image tile all of it
+            train_steps(model, train_set, steps)
+            on_object = f"{'-':>19}"
+            selector = model.model.patch_selector
+            selector_input = F.interpolate(x, size=model.size, mode='bilinear', align_corners=False, antialias=True)
+        accuracy = evaluate(model, test_loader)[0]
+
+        with torch.no_grad():
+            selector_ms = time_fn(lambda: selector(selector_input), warmup=1, iters=5)
+            eval_ms = time_fn(lambda: model(x), warmup=1, iters=5)
+        model.train()
+        def train_step():
+            model.zero_grad(set_to_none=True)
+            F.cross_entropy(model(x), torch.randint(0, 10, (x.size(0),))).backward()
+        train_ms = time_fn(train_step, warmup=1, iters=3)
+
+        print(
+            f"{name:>22} | {sum(p.numel() for p in selector.parameters()) / 1e6:>17.2f} | {on_object} | "
+            f"{accuracy * 100:>10.1f} | {selector_ms:>11.2f} | {x.size(0) / eval_ms * 1000:>10.0f} | "
+            f"{x.size(0) / train_ms * 1000:>11.0f}"
+        )
+
+if __name__ == "__main__":
+    main()
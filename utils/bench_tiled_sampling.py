@@ -0,0 +1,180 @@
+import os
+import shutil
+import sys
+import tempfile
+import time
+import numpy as np
+import torch
+from apvit_e2e import APViT
+from modules.PatchSamplers import grid_sample_patches, make_base_grid
+from modules.TiledImage import TiledImage, sample_tiled_patches
+from utils.bench_mip_sampling import random_transforms
+
+PATCH_SIZE = 8
+NUM_PATCHES = 16
+TILE_SIZE = 256
+THUMBNAIL_SIZE = 64
+
+class SyntheticImage:
+    """
+    A large image generated a region at a time when sliced, smooth color gradients
+    with noise, so that it can be written as a TiledImage without ever being held in
+    memory whole.
+    """
+    def __init__(self, height, width, seed=0):
+        self.shape = (3, height, width)
+        self.seed = seed
+
+    def __getitem__(self, index):
+        _, rows, cols = index
+        y = torch.arange(rows.start, min(rows.stop, self.shape[1]), dtype=torch.float32).view(-1, 1) / self.shape[1]
+        x = torch.arange(cols.start, min(cols.stop, self.shape[2]), dtype=torch.float32).view(1, -1) / self.shape[2]
+        generator = torch.Generator().manual_seed(self.seed * 1_000_003 + rows.start * 7919 + cols.start)
+        noise = torch.rand(3, y.size(0), x.size(1), generator=generator)
+        gradients = torch.stack([x.expand(y.size(0), -1), y.expand(-1, x.size(1)), (x + y) / 2])
+        return (0.7 * gradients + 0.3 * noise).numpy()
+
+def open_cold(path):
+    # drops the tiles from the page cache so that the next reads come from disk
+    fd = os.open(os.path.join(path, 'tiles.npy'), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+    return TiledImage(path)
+
+def check_exact(directory):
+    """
+    Checks that sampling from the tiles matches grid_sample_patches on the whole image,
+    in value and in gradient, for rotated and scaled patches, patches straddling the
+    image border and patches entirely outside of it, and that APViT.forward_tiled
+    matches APViT.forward.
+    """
+    torch.manual_seed(42)
+    x = (torch.rand(3, 1000, 700) * 255).round() / 255 # as stored in uint8
+    source = TiledImage.write(os.path.join(directory, 'check'), x, tile_size=128)
+    base_grid = make_base_grid(PATCH_SIZE)
+
+    generator = torch.Generator().manual_seed(42)
+    transforms = torch.cat([
+        random_transforms(1, 16, 0.01, generator),
+        random_transforms(1, 16, 0.2, generator),
+        random_transforms(1, 16, 0.3, generator) * torch.tensor([1, 1, 2.5]) # partly or entirely outside
+    ], dim=1)
+    expected = grid_sample_patches(x.unsqueeze(0), transforms, base_grid).view(1, 3, -1, PATCH_SIZE, PATCH_SIZE).transpose(1, 2)
+    sampled = sample_tiled_patches(source, transforms[0], base_grid).unsqueeze(0)
+    error = (sampled - expected).abs().max()
+    assert error < 1e-4, f'tiled patches differ by {error:.2e}'
+
+    weights = torch.randn_like(expected)
+    grads = []
+    for sample in [
+        lambda a: grid_sample_patches(x.unsqueeze(0), a, base_grid).view(1, 3, -1, PATCH_SIZE, PATCH_SIZE).transpose(1, 2),
+        lambda a: sample_tiled_patches(source, a[0], base_grid).unsqueeze(0)
+    ]:
+        a = transforms.clone().requires_grad_()
+        (sample(a) * weights).sum().backward()
+        grads.append(a.grad)
+    error = (grads[0] - grads[1]).abs().max() / grads[0].abs().max()
+    assert error < 1e-4, f'tiled gradients differ by {error:.2e} relative to their largest'
+
+    model = APViT(
+        img_size=(1000, 700),
+        num_patches=NUM_PATCHES,
+        embed_dim=64,
+        num_transformer_layers=2,
+        hidden_channels=8,
+        scaling='isotropic',
+        rotating=True,
+        selector_thumbnail_size=THUMBNAIL_SIZE
+    ).eval()
+    source.thumbnail = model.patch_selector.thumbnail(x.unsqueeze(0))[0] # the thumbnail forward computes
+    source.reset_stats()
+    with torch.no_grad():
+        error = (model.forward_tiled([source]) - model(x.unsqueeze(0))).abs().max()
+    assert error < 1e-4, f'forward_tiled differs by {error:.2e}'
+    print(f"tiled sampling: patches and gradients match grid_sample_patches, {source.stats['tiles']} of {source.tiles.shape[0] * source.tiles.shape[1]} tiles read")
+
+def main():
+    # the side of the synthetic image in pixels, 16384 by default, and the number of images timed per row
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 16384
+    num_images = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    directory = tempfile.mkdtemp()
+    try:
+        check_exact(directory)
+
+        start = time.perf_counter()
+        path = os.path.join(directory, 'image')
+        source = TiledImage.write(path, SyntheticImage(size, size), tile_size=TILE_SIZE, thumbnail_size=THUMBNAIL_SIZE)
+        image_mb = size * size * 3 / 2 ** 20
+        num_tiles = source.tiles.shape[0] * source.tiles.shape[1]
+        print(
+            f"\n{size}x{size} image, {image_mb:.0f} MB as uint8 in {num_tiles} tiles of {TILE_SIZE}x{TILE_SIZE}, "
+            f"written in {time.perf_counter() - start:.0f} s"
+        )
+
+        del source
+        source = open_cold(path)
+        start = time.perf_counter()
+        whole = np.array(source.tiles)
+        whole_ms = (time.perf_counter() - start) * 1000
+        del whole, source
+        print(f"loading the whole image from a cold cache: {image_mb:.0f} MB in {whole_ms:.0f} ms, before any decoding or resizing")
+
+        base_grid = make_base_grid(PATCH_SIZE)
+        generator = torch.Generator().manual_seed(42)
+        print(f"\nSampling {NUM_PATCHES} rotated {PATCH_SIZE}x{PATCH_SIZE} patches per image from a cold cache, mean per image over {num_images}")
+        print(f"{'patch side px':>13} | {'tiles':>6} | {'MB read':>7} | {'% of image':>10} | {'read ms':>7} | {'sample ms':>9} | {'total ms':>8}")
+        for scale in [PATCH_SIZE / size, 0.01, 0.05]:
+            totals = {'tiles': 0, 'bytes': 0, 'read_seconds': 0.0, 'total_seconds': 0.0}
+            for _ in range(num_images):
+                source = open_cold(path)
+                transforms = random_transforms(1, NUM_PATCHES, scale, generator)[0]
+                start = time.perf_counter()
+                sample_tiled_patches(source, transforms, base_grid)
+                totals['total_seconds'] += time.perf_counter() - start
+                for key, value in source.stats.items():
+                    totals[key] += value
+                del source
+            mb = totals['bytes'] / num_images / 2 ** 20
+            read_ms = totals['read_seconds'] / num_images * 1000
+            total_ms = totals['total_seconds'] / num_images * 1000
+            print(
+                f"{scale * size:>13.0f} | {totals['tiles'] / num_images:>6.1f} | {mb:>7.1f} | {mb / image_mb * 100:>10.3f} | "
+                f"{read_ms:>7.1f} | {total_ms - read_ms:>9.1f} | {total_ms:>8.1f}"
+            )
+
+        # the selector sees the thumbnail, so the model is built at the thumbnail size and
+        # positional embeddings are looked up at normalized patch centers as usual
+        model = APViT(
+            img_size=THUMBNAIL_SIZE,
+            num_patches=NUM_PATCHES,
+            embed_dim=128,
+            num_transformer_layers=4,
+            hidden_channels=16,
+            scaling='isotropic',
+            max_scale=0.05,
+            rotating=True
+        ).eval()
+        print(f"\nAPViT.forward_tiled, untrained, isotropic scaling up to 0.05, from a cold cache, per image over {num_images}")
+        print(f"{'tiles':>6} | {'MB read':>7} | {'read ms':>7} | {'total ms':>8}")
+        totals = {'tiles': 0, 'bytes': 0, 'read_seconds': 0.0, 'total_seconds': 0.0}
+        for _ in range(num_images):
+            source = open_cold(path)
+            start = time.perf_counter()
+            with torch.no_grad():
+                model.forward_tiled([source])
+            totals['total_seconds'] += time.perf_counter() - start
+            for key, value in source.stats.items():
+                totals[key] += value
+            del source
+        print(
+            f"{totals['tiles'] / num_images:>6.1f} | {totals['bytes'] / num_images / 2 ** 20:>7.1f} | "
+            f"{totals['read_seconds'] / num_images * 1000:>7.1f} | {totals['total_seconds'] / num_images * 1000:>8.1f}"
+        )
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == "__main__":
+    main()
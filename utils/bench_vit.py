@@ -0,0 +1,47 @@
+import torch
+from modules.ViT import ViT
+from utils.benchmark import time_fn
+
+def sequence_first_tokens(vit, x, interpolated_pos_embeds):
+    """
+    The original token assembly, which concatenates the CLS token and copies the
+    tokens into the sequence-first layout of nn.MultiheadAttention.
+    """
+    x = x + interpolated_pos_embeds
+    cls_tokens = vit.cls_token.expand(x.size(0), -1, -1)
+    x = torch.cat((cls_tokens, x), dim=1)
+    return x.permute(1, 0, 2).contiguous()
+
+def main():
+    torch.manual_seed(42)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    vit = ViT(embed_dim=256, num_transformer_layers=8).to(device)
+    num_patches, embed_dim = 16, 256
+
+    print("Token assembly before the transformer layers")
+    print(f"{'batch':>6} | {'seq-first fwd ms':>16} | {'batch-first fwd ms':>18} | {'seq-first fwd+bwd ms':>20} | {'batch-first fwd+bwd ms':>22} | {'copy saved MB':>13}")
+    for batch_size in [256, 1024, 4096]:
+        x = torch.randn(batch_size, num_patches, embed_dim, device=device, requires_grad=True)
+        pos_embeds = torch.randn(batch_size, num_patches, embed_dim, device=device)
+
+        def sequence_first(x, pos_embeds):
+            return sequence_first_tokens(vit, x, pos_embeds)
+
+        def forward(assemble):
+            with torch.no_grad():
+                assemble(x, pos_embeds)
+
+        # the permute copy reads and writes every token once more in forward, and again in backward
+        copy_mb = 2 * batch_size * (num_patches + 1) * embed_dim * x.element_size() / 2**20
+
+        print(
+            f"{batch_size:>6} | {time_fn(lambda: forward(sequence_first)):>16.2f} | "
+            f"{time_fn(lambda: forward(vit.build_tokens)):>18.2f} | "
+            f"{time_fn(lambda: sequence_first(x, pos_embeds).sum().backward()):>20.2f} | "
+            f"{time_fn(lambda: vit.build_tokens(x, pos_embeds).sum().backward()):>22.2f} | "
+            f"{copy_mb:>13.1f}"
+        )
+
+if __name__ == "__main__":
+    main()
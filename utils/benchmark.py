@@ -0,0 +1,251 @@
+import ctypes
+import multiprocessing
+import os
+import resource
+import sys
+import time
+import torch
+import torchvision
+from torch.utils.data import DataLoader, TensorDataset
+from timm.data import create_transform
+from apvit_e2e import APViT
+
+def time_fn(fn, warmup=3, iters=10):
+    """
+    Returns the mean wall-clock time of fn() in milliseconds.
+    """
+    for _ in range(warmup):
+        fn()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(iters):
+        fn()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / iters * 1000
+
+def _release_heap():
+    # return memory cached by glibc from earlier work in the parent, and keep large
+    # allocations mmap'd so that every allocation made by fn() shows up in the RSS
+    try:
+        libc = ctypes.CDLL("libc.so.6")
+    except OSError:
+        return
+    libc.mallopt(-3, 128 * 1024) # M_MMAP_THRESHOLD, also disables the dynamic threshold
+    libc.malloc_trim(0)
+
+def _rss_kb(field):
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith(field):
+                return int(line.split()[1])
+
+def _peak_rss_worker(fn, queue):
+    _release_heap()
+    try:
+        # reset the peak resident set size, which is otherwise inherited from the parent
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+        baseline = _rss_kb("VmRSS:")
+        fn()
+        queue.put(_rss_kb("VmHWM:") - baseline)
+    except OSError:
+        baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        fn()
+        queue.put(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline)
+
+def peak_memory(fn):
+    """
+    Returns the peak memory in MB allocated while running fn().
+
+    On CUDA this reads the allocator statistics. On CPU fn() is run in a forked
+    process and the growth of its peak resident set size is reported, which is
+    a close proxy as large tensors are mmap'd and returned to the OS when freed.
+    """
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        before = torch.cuda.memory_allocated()
+        fn()
+        torch.cuda.synchronize()
+        return (torch.cuda.max_memory_allocated() - before) / 2**20
+
+    ctx = multiprocessing.get_context('fork')
+    queue = ctx.Queue()
+    process = ctx.Process(target=_peak_rss_worker, args=(fn, queue))
+    process.start()
+    peak = queue.get()
+    process.join()
+    return peak / 2**10
+
+def saved_tensor_memory(fn, exclude=()):
+    """
+    Returns the memory in MB of tensors saved for backward while running fn(),
+    counting each underlying storage once and skipping those of the tensors in
+    exclude.
+    """
+    storages = {}
+    excluded = {tensor.untyped_storage().data_ptr() for tensor in exclude}
+
+    def pack(tensor):
+        storage = tensor.untyped_storage()
+        if storage.data_ptr() not in excluded:
+            storages[storage.data_ptr()] = storage.nbytes()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        fn()
+
+    return sum(storages.values()) / 2**20
+
+def get_test_loader(batch_size):
+    """
+    The CIFAR-10 test set with the training scripts' test transform, or random images
+    if the dataset cannot be loaded, in which case only the agreement between the
+    predictions of two models is meaningful.
+    """
+    test_transform = create_transform(
+        input_size=32,
+        is_training=False,
+        mean=[0.4914, 0.4822, 0.4465],
+        std=[0.2470, 0.2435, 0.2616]
+    )
+    try:
+        testset = torchvision.datasets.CIFAR10(root='./data', train=False, download=True, transform=test_transform)
+        name = 'CIFAR-10 test set'
+    except (RuntimeError, OSError):
+        testset = TensorDataset(torch.randn(2048, 3, 32, 32), torch.randint(0, 10, (2048,)))
+        name = 'random images, CIFAR-10 unavailable'
+    return DataLoader(testset, batch_size=batch_size, shuffle=False), name
+
+def load_weights(model, weights_path):
+    if os.path.exists(weights_path):
+        model.load_state_dict(torch.load(weights_path, map_location='cpu'))
+        return weights_path
+    return 'random init'
+
+def evaluate(model, test_loader):
+    """
+    Returns the accuracy and the predictions of model over the test loader.
+    """
+    correct = 0
+    predictions = []
+    with torch.no_grad():
+        for inputs, labels, *_ in test_loader:
+            predicted = model(inputs).argmax(1)
+            correct += predicted.eq(labels).sum().item()
+            predictions.append(predicted)
+    predictions = torch.cat(predictions)
+    return correct / predictions.size(0), predictions
+
+def synthetic_objects(num_images, img_size, object_size=32, seed=0):
+    """
+    Noise images holding one object each at a random position, of one of 5 colors and
+    textured with a horizontal or vertical grating, which make up its class. Finding
+    the object and its color takes little resolution, but the 4 pixel grating period
+    averages out in images downsampled 4x, leaving half of the classes to chance.
+
+    Returns the images, the labels and the top-left pixel corner of each object as (x, y).
+    """
+    img_height, img_width = (img_size, img_size) if isinstance(img_size, int) else img_size
+    colors = torch.tensor([[1.5, 0, 0], [0, 1.5, 0], [0, 0, 1.5], [1.5, 1.5, 0], [0, 1.5, 1.5]]).view(5, 1, 3, 1, 1)
+    grating = torch.cos(torch.arange(object_size) * torch.pi / 2)
+    gratings = torch.stack([grating.view(1, -1).expand(object_size, -1), grating.view(-1, 1).expand(-1, object_size)])
+    patterns = (colors * (1 + 0.8 * gratings.view(1, 2, 1, object_size, object_size))).flatten(0, 1) # (10, 3, S, S)
+
+    generator = torch.Generator().manual_seed(seed)
+    images = torch.randn(num_images, 3, img_height, img_width, generator=generator) * 0.5
+    labels = torch.randint(0, 10, (num_images,), generator=generator)
+    ys = torch.randint(0, img_height - object_size + 1, (num_images,), generator=generator)
+    xs = torch.randint(0, img_width - object_size + 1, (num_images,), generator=generator)
+    for image, label, y, x in zip(images, labels, ys, xs):
+        image[:, y:y + object_size, x:x + object_size] = patterns[label]
+    return TensorDataset(images, labels, torch.stack([xs, ys], dim=-1))
+
+def num_steps(default=400):
+    # the number of training steps per configuration, from the first command line argument
+    return int(sys.argv[1]) if len(sys.argv) > 1 else default
+
+def build_selector_model(**kwargs):
+    """
+    The small APViT the patch selector benchmarks train, seeded so that every
+    configuration starts from the same weights. kwargs set the image size and the
+    patch selector.
+    """
+    torch.manual_seed(42)
+    return APViT(
+        num_patches=16,
+        embed_dim=128,
+        num_transformer_layers=4,
+        hidden_channels=16,
+        **kwargs
+    )
+
+def train_steps(model, dataset, steps, batch_size=32, lr=3e-4, seed=0, loss_fn=None):
+    """
+    Trains model for a fixed number of steps over shuffled batches of dataset with
+    AdamW and a cosine schedule, for quick comparisons between configurations.
+    loss_fn(model, inputs, labels, *rest) replaces the cross-entropy of the logits,
+    where rest holds any further tensors of the dataset.
+    """
+    torch.manual_seed(seed)
+    loader = DataLoader(dataset, batch_size=batch_size, shuffle=True, drop_last=True)
+    optimizer = torch.optim.AdamW(model.parameters(), lr=lr, weight_decay=0.05)
+    scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, steps)
+    model.train()
+    step = 0
+    while step < steps:
+        for inputs, labels, *rest in loader:
+            optimizer.zero_grad(set_to_none=True)
+            if loss_fn is None:
+                loss = torch.nn.functional.cross_entropy(model(inputs), labels)
+            else:
+                loss = loss_fn(model, inputs, labels, *rest)
+            loss.backward()
+            optimizer.step()
+            scheduler.step()
+            step += 1
+            if step == steps:
+                break
+    model.eval()
+    return model
+
+def tile_centers(corners, img_size, object_size=32):
+    """
+    Normalized centers of the 4x4 patches tiling each object of synthetic_objects, in
+    the patch order.
+
+    Shape:
+        - corners: (batch_size, 2), top-left pixel corners of the objects as (x, y)
+        - Output: (batch_size, 16, 2)
+    """
+    steps = (torch.arange(4, dtype=torch.float32) + 0.5) * object_size / 4
+    grid_y, grid_x = torch.meshgrid(steps, steps, indexing='ij')
+    offsets = torch.stack([grid_x, grid_y], dim=-1).view(1, 16, 2)
+    return (corners.unsqueeze(1) + offsets) * 2 / img_size - 1
+
+def localized_loss(model, inputs, labels, corners, object_size=32):
+    """
+    Cross-entropy along with the squared distance of the patch centers to the tiles of
+    the object, for square synthetic_objects images. The patch selector does not learn
+    to find the objects within the few hundred steps trained in the benchmarks from the
+    classification loss alone, so the localization loss, weighted to outweigh the
+    cross-entropy, compares how well each selector can locate them instead.
+    """
+    transform_params = model.patch_selector(inputs)
+    tokens, affine_transforms = model.embed_patches(inputs, transform_params)
+    logits = model.vit.forward_tokens(tokens, model.vit.lookup_pos_embeds(affine_transforms[..., -1]))
+    targets = tile_centers(corners, inputs.size(-1), object_size)
+    return torch.nn.functional.cross_entropy(logits, labels) + 10 * torch.nn.functional.mse_loss(affine_transforms[..., -1], targets)
+
+def patches_on_object(model, test_loader, object_size=32):
+    # fraction of the patches centered on the object of their synthetic_objects image
+    on_object = []
+    with torch.no_grad():
+        for inputs, _, corners in test_loader:
+            transform_params = model.patch_selector(inputs)
+            _, affine_transforms = model.embed_patches(inputs, transform_params)
+            centers = (affine_transforms[..., -1] + 1) * inputs.size(-1) / 2 - corners.unsqueeze(1) # (B, N, 2)
+            on_object.append(((centers >= 0) & (centers < object_size)).all(dim=-1).float().flatten())
+    return torch.cat(on_object).mean().item()
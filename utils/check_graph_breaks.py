@@ -0,0 +1,121 @@
+import sys
+import torch
+import torch._dynamo as dynamo
+from torch._dynamo.utils import counters
+import apvit_e2e
+import apvit_aploss
+from modules.ActivationCheckpointing import apply_activation_checkpointing
+
+# (name, APViT keyword arguments) of every patch selector and embedding configuration
+CONFIGS = [
+    ('strip', dict(embed_mode='strip')),
+    ('fused', dict(embed_mode='fused')),
+    ('dense', dict(embed_mode='dense')),
+    ('strip, anisotropic, rotating', dict(embed_mode='strip', scaling='anisotropic', max_scale=0.4, rotating=True)),
+    ('fused, anisotropic, rotating', dict(embed_mode='fused', scaling='anisotropic', max_scale=0.4, rotating=True)),
+    ('fused, isotropic', dict(embed_mode='fused', scaling='isotropic', max_scale=0.4)),
+    ('strip, isotropic, mip', dict(embed_mode='strip', scaling='isotropic', max_scale=0.4, mip_sampling=True)),
+    ('strip, isotropic, hierarchical', dict(embed_mode='strip', scaling='isotropic', max_scale=0.4, selector_regions=4, selector_region_scale=0.5))
+]
+
+def build_e2e_model(kwargs, checkpointing='none'):
+    model = apvit_e2e.APViT(
+        num_patches=16,
+        embed_dim=256,
+        num_transformer_layers=2,
+        hidden_channels=24,
+        **kwargs
+    )
+    apply_activation_checkpointing(model, checkpointing)
+    return model
+
+def build_aploss_model(kwargs):
+    kwargs = {'scaling': None, 'max_scale': 0.4, 'rotating': False, **kwargs}
+    return apvit_aploss.APViT(
+        num_patches=16,
+        patch_size=8,
+        hidden_channels=24,
+        embed_dim=256,
+        num_transformer_layers=2,
+        stochastic_depth=0.1,
+        **kwargs
+    )
+
+def count_graphs(fn, *args):
+    """
+    Traces fn with dynamo and returns the number of graphs and of graph breaks,
+    along with the reason of each break.
+    """
+    dynamo.reset()
+    explanation = dynamo.explain(fn)(*args)
+    reasons = [f'{b.reason} ({b.user_stack[-1] if b.user_stack else "unknown"})' for b in explanation.break_reasons]
+    return explanation.graph_count, explanation.graph_break_count, reasons
+
+def count_recompiles(model, inputs, autocast=False):
+    """
+    Compiles model with dynamic shapes and the eager backend, runs forward and backward
+    over the given inputs, under CPU autocast as in the training scripts if autocast is
+    set, and returns the number of graphs compiled, which is 1 when no guard depends on
+    the batch size.
+    """
+    dynamo.reset()
+    counters.clear()
+    compiled = torch.compile(model, backend='eager', dynamic=True, fullgraph=True)
+    for x in inputs:
+        with torch.autocast(device_type='cpu', enabled=autocast):
+            loss = compiled(x).float().sum()
+        loss.backward()
+    return counters['stats']['unique_graphs']
+
+def main():
+    torch.manual_seed(42)
+    x = torch.randn(4, 3, 32, 32)
+    failures = []
+
+    def check(name, graphs, breaks, reasons):
+        ok = graphs == 1 and breaks == 0
+        print(f"{name:>54} | {graphs:>6} | {breaks:>6} | {'ok' if ok else 'FAIL'}")
+        for reason in reasons:
+            print(f"{'':>54}   {reason}")
+        if not ok:
+            failures.append(name)
+
+    print(f"{'function':>54} | {'graphs':>6} | {'breaks':>6} |")
+    for name, kwargs in CONFIGS:
+        model = build_e2e_model(kwargs)
+        check(f'e2e forward, {name}, train', *count_graphs(model.train(), x))
+        check(f'e2e forward, {name}, eval', *count_graphs(model.eval(), x))
+        with torch.no_grad():
+            check(f'e2e forward, {name}, no grad', *count_graphs(model, x))
+
+        model = build_aploss_model(kwargs).train()
+        params = model.patch_selector(x).detach()
+        check(f'aploss selector, {name}', *count_graphs(model.patch_selector, x))
+        check(f'aploss forward, {name}, 1 set', *count_graphs(model, x, params))
+        check(f'aploss forward, {name}, 4 sets', *count_graphs(model, x, params.expand(4, -1, -1, -1)))
+
+    model = build_e2e_model({'selector_feature_size': 32}).train()
+    check('e2e forward, pooled selector, 224x224', *count_graphs(model, torch.randn(4, 3, 224, 224)))
+
+    for policy in ['all', 2, 'selector']:
+        model = build_e2e_model({}, policy).train()
+        check(f'e2e forward, checkpointing {policy}', *count_graphs(model, x))
+
+    # reduced precision features reach the affine sampler and the hierarchical selector's crops
+    for name, kwargs in CONFIGS[3:]:
+        model = build_e2e_model(kwargs).train()
+        check(f'e2e fwd+bwd, {name}, autocast', count_recompiles(model, [x], autocast=True), 0, [])
+
+    # the last CIFAR-10 batches of an epoch at batch size 256 hold 80 train and 16 test
+    # images, which must not recompile. conv2d itself guards on batches below 16
+    model = build_e2e_model({}).train()
+    batches = [torch.randn(b, 3, 32, 32) for b in [256, 80, 16]]
+    check('e2e fwd+bwd, batch 256, 80 and 16', count_recompiles(model, batches), 0, [])
+
+    if failures:
+        print(f"\n{len(failures)} function(s) do not compile to a single graph")
+        sys.exit(1)
+    print("\nevery function compiles to a single graph")
+
+if __name__ == "__main__":
+    main()